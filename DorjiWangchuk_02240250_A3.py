@@ -1,8 +1,43 @@
+import asyncio
+import base64
+import csv
+import hashlib
+import heapq
+import hmac
+import json
+import lzma
+import mmap
+import multiprocessing
+import queue
 import random
 import os
+import re
+import secrets
+import shutil
+import socketserver
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
 import tkinter as tk
+import weakref
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from concurrent.futures import Future, ThreadPoolExecutor
 from tkinter import messagebox, simpledialog
 
+try:
+    import numpy
+except ImportError:  # optional: end_of_day falls back to array loops
+    numpy = None
+
 class BankError(Exception):
     """Base error for banking operations"""
     pass
@@ -23,217 +58,4355 @@ class WrongPasswordError(BankError):
     """For incorrect login attempts"""
     pass
 
+class AccountsExhaustedError(BankError):
+    """When every account number in the range is taken"""
+    pass
+
+class ShardUnavailableError(BankError):
+    """When a shard process died; it is restarted, so the call can be retried"""
+    pass
+
+class TooManyAttemptsError(BankError):
+    """When an account is locked out after repeated failed logins"""
+    pass
+
+# Transaction op codes
+OP_ADD = 1
+OP_TAKE = 2
+OP_SENT = 3
+OP_GOT = 4
+OP_PHONE = 5
+OP_INTEREST = 6
+OP_FEE = 7
+OP_EXPIRED = 8
+
+_OP_TEXT = {
+    OP_ADD: "Added {amount}",
+    OP_TAKE: "Took {amount}",
+    OP_SENT: "Sent {amount} to {counterparty}",
+    OP_GOT: "Got {amount} from {counterparty}",
+    OP_PHONE: "Phone +{amount}",
+    OP_INTEREST: "Interest {amount}",
+    OP_FEE: "Fee {amount}",
+    OP_EXPIRED: "Phone -{amount} expired",
+}
+
+_OP_NAMES = {"Added": OP_ADD, "Took": OP_TAKE, "Sent": OP_SENT, "Got": OP_GOT,
+             "Phone": OP_PHONE, "Interest": OP_INTEREST, "Fee": OP_FEE, "Expired": OP_EXPIRED}
+
+_LEGACY_ENTRY = re.compile(
+    r"^(Added|Took|Sent|Got|Phone \+)\s*([0-9.]+)(?: (?:to|from) (\d+))?$")
+_LEGACY_OPS = {"Added": OP_ADD, "Took": OP_TAKE, "Sent": OP_SENT,
+               "Got": OP_GOT, "Phone +": OP_PHONE}
+
+MAX_CENTS = 2 ** 63 - 1  # largest amount a binary record or column can hold
+
+def _parse_amount(text):
+    """Read an amount typed or stored as text into an exact Decimal"""
+    try:
+        amount = Decimal(str(text).strip())
+    except InvalidOperation:
+        raise BadInputError("Please enter numbers only")
+    if not amount.is_finite():
+        raise BadInputError("Please enter numbers only")
+    if abs(amount).scaleb(2) > MAX_CENTS:
+        raise BadInputError("Amount is too large")
+    return amount
+
+def _to_cents(amount):
+    """Convert an amount in currency units to whole cents
+    
+    Takes ints, Decimals, text and (for old data) floats; anything finer
+    than a cent is rounded half to even.
+    """
+    if type(amount) is int:
+        cents = amount * 100
+    elif isinstance(amount, str):
+        whole, _, frac = amount.strip().partition('.')
+        if whole.isascii() and whole.isdigit() and len(frac) <= 2 and (not frac or frac.isdigit()):
+            cents = int(whole) * 100 + int(frac.ljust(2, '0'))
+        else:
+            cents = _to_cents(_parse_amount(amount))
+    elif isinstance(amount, float):
+        cents = _to_cents(_parse_amount(repr(amount)))
+    elif isinstance(amount, Decimal):
+        cents = int(amount.scaleb(2).to_integral_value(ROUND_HALF_EVEN))
+    else:
+        cents = _to_cents(_parse_amount(amount))
+    if abs(cents) > MAX_CENTS:
+        raise BadInputError("Amount is too large")
+    return cents
+
+def _from_cents(cents):
+    """Exact Decimal amount for a number of cents"""
+    return Decimal(cents).scaleb(-2)
+
+def _format_cents(cents):
+    """Show whole amounts without decimals, others with two"""
+    whole, frac = divmod(abs(cents), 100)
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{whole}" if frac == 0 else f"{sign}{whole}.{frac:02d}"
+
+def _format_money(amount):
+    """Format an amount in currency units the way history shows it"""
+    return _format_cents(_to_cents(amount))
+
+PASSWORD_SCHEME = "pbkdf2_sha256"
+SESSION_PREFIX = "session:"
+
+def hash_password(pwd, iterations=100_000, salt=None):
+    """Salted PBKDF2 hash stored as scheme$iterations$salt$digest"""
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', str(pwd).encode(), salt, iterations)
+    return f"{PASSWORD_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def is_password_hash(stored):
+    """True for a hash from hash_password, False for a legacy plaintext one"""
+    return stored.startswith(PASSWORD_SCHEME + "$")
+
+def verify_password(pwd, stored):
+    """Check a password against a stored hash or legacy plaintext password"""
+    if pwd is None:
+        return False
+    pwd = str(pwd).encode()
+    if not is_password_hash(stored):
+        return hmac.compare_digest(pwd, stored.encode())
+    _, iterations, salt, digest = stored.split('$')
+    check = hashlib.pbkdf2_hmac('sha256', pwd, bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(check.hex(), digest)
+
+def _account_key(num):
+    """Account number as an int for binary records (0 if not numeric)"""
+    return int(num) if str(num).isdigit() else 0
+
+class Transaction(namedtuple('Transaction', 'op amount counterparty timestamp seq')):
+    """One history entry: op code, amount in cents, other account, time, sequence"""
+    
+    __slots__ = ()
+    
+    def __str__(self):
+        return _OP_TEXT[self.op].format(amount=_format_cents(self.amount),
+                                        counterparty=self.counterparty)
+
+class _HistoryBase:
+    """Shared behaviour for histories stored as packed transaction records
+    
+    Iterating yields the readable text of each entry, so callers that join
+    or search history strings keep working.
+    """
+    
+    __slots__ = ()
+    
+    RECORD = struct.Struct('<BqQII')  # op, cents, counterparty, unix time, seq
+    PREFIX = "b64:"
+    
+    def record(self, op, amount, counterparty=0):
+        """Append a typed entry for an amount in currency units"""
+        self.record_cents(op, _to_cents(amount), counterparty)
+    
+    def record_cents(self, op, cents, counterparty=0):
+        """Append a typed entry for an amount already in cents"""
+        raw = self.RECORD.pack(op, cents, _account_key(counterparty),
+                               int(time.time()), self.next_seq())
+        self._append_raw(raw)
+    
+    def append(self, entry):
+        """Append a Transaction, or migrate a legacy text entry"""
+        if isinstance(entry, Transaction):
+            self._append_raw(self.RECORD.pack(*entry))
+            return
+        match = _LEGACY_ENTRY.match(entry.strip())
+        if not match:
+            raise BadInputError(f"Unrecognised history entry: {entry!r}")
+        op, amount, counterparty = match.groups()
+        self._append_raw(self.RECORD.pack(
+            _LEGACY_OPS[op], _to_cents(amount), int(counterparty or 0), 0, self.next_seq()))
+    
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+    
+    def next_seq(self):
+        """Sequence number for the next entry, carrying on past archived ones"""
+        last = self.tail(1)
+        return last[0].seq + 1 if last else 1
+    
+    def records(self):
+        """Iterate Transaction tuples, oldest first"""
+        for raw in self.raw_records():
+            yield Transaction._make(self.RECORD.unpack(raw))
+    
+    def page(self, offset=0, limit=None):
+        """Transactions from offset (oldest first), at most limit of them"""
+        entries = list(self.records())
+        end = None if limit is None else offset + limit
+        return entries[offset:end]
+    
+    def tail(self, count):
+        """The newest count transactions, oldest first"""
+        return self.page(max(len(self) - count, 0)) if count > 0 else []
+    
+    def encode(self):
+        """Text-safe form of the packed records for the data file"""
+        data = b''.join(self.raw_records())
+        return self.PREFIX + base64.b64encode(data).decode() if data else ''
+    
+    def __iter__(self):
+        return (str(txn) for txn in self.records())
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [str(txn) for txn in self.page()[index]]
+        return str(self.page()[index])
+    
+    def __bool__(self):
+        return len(self) > 0
+    
+    def __eq__(self, other):
+        return list(self) == list(other)
+    
+    def __repr__(self):
+        return repr(list(self))
+
+class History(_HistoryBase):
+    """Transaction history kept as fixed-width records in one bytearray"""
+    
+    __slots__ = ('_data',)
+    
+    def __init__(self, entries=()):
+        self._data = bytearray()
+        self.extend(entries)
+    
+    @classmethod
+    def from_raw(cls, raws):
+        """History holding already packed records"""
+        history = cls()
+        history._data = bytearray(b''.join(raws))
+        return history
+    
+    @classmethod
+    def from_field(cls, text):
+        """Parse a stored history field, migrating ';'-joined legacy text"""
+        history = cls()
+        if text.startswith(cls.PREFIX):
+            history._data = bytearray(base64.b64decode(text[len(cls.PREFIX):]))
+        elif text:
+            history.extend(text.split(';'))
+        return history
+    
+    def _append_raw(self, raw):
+        self._data += raw
+    
+    def raw_records(self):
+        size = self.RECORD.size
+        data = bytes(self._data)
+        return (data[i:i + size] for i in range(0, len(data), size))
+    
+    def page(self, offset=0, limit=None):
+        size = self.RECORD.size
+        count = len(self)
+        end = count if limit is None else min(count, offset + limit)
+        return [Transaction._make(self.RECORD.unpack_from(self._data, i * size))
+                for i in range(max(offset, 0), end)]
+    
+    def truncate(self, count):
+        """Drop entries after the first count"""
+        del self._data[count * self.RECORD.size:]
+    
+    def __len__(self):
+        return len(self._data) // self.RECORD.size
+
+class LockTable:
+    """Fixed pool of re-entrant locks shared out by account number
+    
+    Locks are striped so millions of accounts don't each need a lock
+    object. Several accounts are always locked in stripe order, which
+    keeps two opposite transfers from deadlocking. Inside pinned(), an
+    operation should take all its accounts in its first holding() call.
+    """
+    
+    def __init__(self, stripes=1024):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+        self._local = threading.local()
+        self.watchers = []  # called with the numbers about to change (None: all)
+    
+    def index(self, num):
+        return hash(str(num)) % len(self._locks)
+    
+    @contextmanager
+    def _held(self, locks):
+        for lock in locks:
+            lock.acquire()
+        pins = getattr(self._local, 'pins', None)
+        if pins is not None:
+            pins.extend(locks)  # released when the pinned() block ends
+        try:
+            yield
+        finally:
+            if pins is None:
+                for lock in reversed(locks):
+                    lock.release()
+    
+    @contextmanager
+    def holding(self, *nums):
+        """Hold the locks for all the given account numbers"""
+        with self._held([self._locks[i] for i in sorted({self.index(num) for num in nums})]):
+            for watcher in tuple(self.watchers):
+                watcher(nums)
+            yield
+    
+    @contextmanager
+    def reading(self, *nums):
+        """Hold the given accounts' locks without changing them"""
+        with self._held([self._locks[i] for i in sorted({self.index(num) for num in nums})]):
+            yield
+    
+    @contextmanager
+    def pinned(self):
+        """Keep every lock this thread takes in the block until the block ends
+        
+        Used to journal an operation before anyone else can touch its
+        accounts.
+        """
+        if getattr(self._local, 'pins', None) is not None:
+            yield
+            return
+        pins = self._local.pins = []
+        try:
+            yield
+        finally:
+            self._local.pins = None
+            for lock in reversed(pins):
+                lock.release()
+    
+    @contextmanager
+    def holding_all(self):
+        """Hold every stripe to change any account"""
+        with self.reading_all():
+            for watcher in tuple(self.watchers):
+                watcher(None)
+            yield
+    
+    @contextmanager
+    def reading_all(self):
+        """Hold every stripe without changing anything, freezing all
+        accounts for a consistent read"""
+        with self._held(self._locks):
+            yield
+
+ACCOUNT_LOCKS = LockTable()  # for accounts that don't belong to a bank
+
 class Account:
     """Base account class with core banking features"""
     
+    __slots__ = ('number', 'password', 'type', '_cents', '_phone_cents',
+                 '_history', '_lazy_history', '_locks')
+    
     def __init__(self, num, pwd, kind, money=0):
         """Initialize account with number, password, type and balance"""
+        self._locks = ACCOUNT_LOCKS  # the bank's own table once stored in one
         self.number = num
         self.password = pwd
         self.type = kind
-        self.balance = money
-        self.phone_credit = 0
-        self.history = []
+        self._cents = _to_cents(money)
+        self._phone_cents = 0
+        self.history = History()
+    
+    @property
+    def balance(self):
+        """Balance as an exact Decimal; stored as whole cents"""
+        return _from_cents(self._cents)
+    
+    @balance.setter
+    def balance(self, money):
+        self._cents = _to_cents(money)
+    
+    @property
+    def phone_credit(self):
+        return _from_cents(self._phone_cents)
+    
+    @phone_credit.setter
+    def phone_credit(self, amount):
+        self._phone_cents = _to_cents(amount)
+    
+    @property
+    def history(self):
+        """Transaction history, read from disk on first access when loaded lazily"""
+        if self._history is None:
+            source, offset, length = self._lazy_history
+            self._history = History.from_field(source.read(offset, length))
+            self._lazy_history = None
+        return self._history
+    
+    @history.setter
+    def history(self, entries):
+        self._history = entries if isinstance(entries, History) else History(entries)
+        self._lazy_history = None
+    
+    @property
+    def history_loaded(self):
+        """False while the history is still only a file offset"""
+        return self._history is not None
     
     def add_money(self, amount):
         """Deposit money into account"""
-        if amount <= 0:
-            raise BadInputError("Amount must be positive")
-        self.balance += amount
-        self.history.append(f"Added {amount}")
+        self._add_cents(_to_cents(amount))
     
     def take_money(self, amount):
         """Withdraw money from account"""
-        if amount <= 0:
-            raise BadInputError("Amount must be positive")
-        if amount > self.balance:
-            raise NotEnoughMoneyError("Not enough funds")
-        self.balance -= amount
-        self.history.append(f"Took {amount}")
+        self._take_cents(_to_cents(amount))
     
     def send_money(self, amount, other_account):
         """Transfer to another account"""
-        self.take_money(amount)
-        other_account.add_money(amount)
-        self.history.append(f"Sent {amount} to {other_account.number}")
-        other_account.history.append(f"Got {amount} from {self.number}")
+        cents = _to_cents(amount)
+        with self._locks.holding(self.number, other_account.number):
+            if other_account._cents + cents > MAX_CENTS:
+                raise BadInputError("Amount is too large")
+            self._take_cents(cents)
+            other_account._add_cents(cents)
+            self.history.record_cents(OP_SENT, cents, other_account.number)
+            other_account.history.record_cents(OP_GOT, cents, self.number)
+    
+    def add_phone_credit(self, amount):
+        """Top up mobile balance"""
+        cents = _to_cents(amount)
+        with self._locks.holding(self.number):
+            if self._phone_cents + cents > MAX_CENTS:
+                raise BadInputError("Amount is too large")
+            self._take_cents(cents)
+            self._phone_cents += cents
+            self.history.record_cents(OP_PHONE, cents)
+    
+    def _add_cents(self, cents):
+        if cents <= 0:
+            raise BadInputError("Amount must be positive")
+        with self._locks.holding(self.number):
+            if self._cents + cents > MAX_CENTS:
+                raise BadInputError("Amount is too large")
+            self._cents += cents
+            self.history.record_cents(OP_ADD, cents)
+    
+    def _take_cents(self, cents):
+        if cents <= 0:
+            raise BadInputError("Amount must be positive")
+        with self._locks.holding(self.number):
+            if cents > self._cents:
+                raise NotEnoughMoneyError("Not enough funds")
+            self._cents -= cents
+            self.history.record_cents(OP_TAKE, cents)
+
+class _HistorySource:
+    """Open handle on a data file that lazily loaded histories read from"""
+    
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+    
+    def read(self, offset, length):
+        """Return the history field stored at offset"""
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length).decode()
+    
+    def close(self):
+        self._file.close()
+    
+    def __del__(self):
+        self._file.close()
+
+def _fsync_dir(path):
+    """Make a rename inside path's directory durable where the OS allows it"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class PersonalAccount(Account):
+    """Account for individual customers"""
+    __slots__ = ()
+    
+    def __init__(self, num, pwd, money=0):
+        super().__init__(num, pwd, "Personal", money)
+
+class BusinessAccount(Account):
+    """Account for business customers"""
+    __slots__ = ()
+    
+    def __init__(self, num, pwd, money=0):
+        super().__init__(num, pwd, "Business", money)
+
+class _ArenaHistory(_HistoryBase):
+    """History view of one account's records in a shared history arena"""
+    
+    __slots__ = ('_store', '_row')
+    
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+    
+    def _append_raw(self, raw):
+        self._store._append_history(self._row, raw)
+    
+    def raw_records(self):
+        return iter(self._store._read_history(self._row))
+    
+    def truncate(self, count):
+        """Drop entries after the first count"""
+        self._store._truncate_history(self._row, count)
+    
+    def tail(self, count):
+        return [Transaction._make(self.RECORD.unpack(raw))
+                for raw in self._store._read_history(self._row, count)]
+    
+    def __len__(self):
+        return self._store._history_len(self._row)
+
+class AccountView(Account):
+    """Account interface over one row of a CompactAccountStore"""
+    
+    __slots__ = ('_store', '_row')
+    
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+    
+    @property
+    def _locks(self):
+        return self._store.locks
+    
+    @property
+    def number(self):
+        return str(self._store._numbers[self._row])
+    
+    @property
+    def password(self):
+        return self._store._get_password(self._row)
+    
+    @password.setter
+    def password(self, pwd):
+        self._store._set_password(self._row, pwd)
+    
+    @property
+    def type(self):
+        return CompactAccountStore.KINDS[self._store._kinds[self._row]]
+    
+    @property
+    def _cents(self):
+        return self._store._balances[self._row]
+    
+    @_cents.setter
+    def _cents(self, cents):
+        self._store._balances[self._row] = cents
+    
+    @property
+    def _phone_cents(self):
+        return self._store._phone[self._row]
+    
+    @_phone_cents.setter
+    def _phone_cents(self, cents):
+        self._store._phone[self._row] = cents
+    
+    @property
+    def history(self):
+        return _ArenaHistory(self._store, self._row)
+    
+    @history.setter
+    def history(self, entries):
+        self._store._clear_history(self._row)
+        if not isinstance(entries, _HistoryBase):
+            entries = History(entries)
+        for raw in list(entries.raw_records()):
+            self._store._append_history(self._row, raw)
+    
+    @property
+    def history_loaded(self):
+        return True
+
+class AccountDict(dict):
+    """Plain account mapping that points stored accounts at its lock table"""
+    
+    def __init__(self, locks):
+        super().__init__()
+        self.locks = locks
+    
+    def __setitem__(self, num, acc):
+        acc._locks = self.locks
+        super().__setitem__(num, acc)
+
+class CompactAccountStore(MutableMapping):
+    """Columnar account storage: one array per field, histories in one arena
+    
+    Rows are addressed by account number. Reading an account hands out an
+    AccountView, so Account methods and the GUI work unchanged.
+    """
+    
+    KINDS = ("Personal", "Business")
+    _LINK = struct.Struct('<q')  # offset of the row's previous record
+    
+    def __init__(self, locks=None):
+        self.locks = ACCOUNT_LOCKS if locks is None else locks
+        self._rows = {}
+        self._free = []
+        self._numbers = array('q')
+        self._kinds = array('b')
+        self._balances = array('q')  # cents
+        self._phone = array('q')
+        self._pwd_off = array('q')
+        self._pwd_len = array('H')
+        self._pwd_arena = bytearray()
+        self._hist_tail = array('q')
+        self._hist_len = array('l')
+        self._hist_arena = bytearray()
+        self._lock = threading.RLock()  # guards row allocation and arena growth
+    
+    @staticmethod
+    def _key(num):
+        try:
+            return int(num)
+        except (TypeError, ValueError):
+            raise KeyError(num)
+    
+    def __getitem__(self, num):
+        key = self._key(num)
+        if key not in self._rows:
+            raise KeyError(num)
+        return AccountView(self, self._rows[key])
+    
+    def __setitem__(self, num, acc):
+        if not str(num).isdigit():
+            raise BadInputError("Account numbers must be numeric")
+        key = self._key(num)
+        if isinstance(acc, AccountView) and acc._store is self and self._rows.get(key) == acc._row:
+            return
+        records = list(acc.history.raw_records())
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = self._new_row()
+            self._numbers[row] = key
+            self._kinds[row] = self.KINDS.index(acc.type) if acc.type in self.KINDS else 0
+            self._balances[row] = acc._cents
+            self._phone[row] = acc._phone_cents
+            self._set_password(row, acc.password)
+            self._clear_history(row)
+            for raw in records:
+                self._append_history(row, raw)
+            self._rows[key] = row
+    
+    def __delitem__(self, num):
+        with self._lock:
+            row = self._rows.pop(self._key(num))
+            self._numbers[row] = -1
+            self._kinds[row] = -1
+            self._balances[row] = 0
+            self._phone[row] = 0
+            self._clear_history(row)
+            self._free.append(row)
+    
+    def __contains__(self, num):
+        try:
+            return int(num) in self._rows
+        except (TypeError, ValueError):
+            return False
+    
+    def __iter__(self):
+        return (str(key) for key in list(self._rows))
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def _new_row(self):
+        """Reuse a deleted row or grow every column by one"""
+        if self._free:
+            return self._free.pop()
+        for column in (self._numbers, self._pwd_off, self._hist_tail):
+            column.append(-1)
+        for column in (self._kinds, self._pwd_len, self._hist_len):
+            column.append(0)
+        self._balances.append(0)
+        self._phone.append(0)
+        return len(self._numbers) - 1
+    
+    def _get_password(self, row):
+        start = self._pwd_off[row]
+        return self._pwd_arena[start:start + self._pwd_len[row]].decode()
+    
+    def _set_password(self, row, pwd):
+        data = pwd.encode()
+        with self._lock:
+            self._pwd_off[row] = len(self._pwd_arena)
+            self._pwd_len[row] = len(data)
+            self._pwd_arena += data
+    
+    def _append_history(self, row, raw):
+        """Link a packed record onto the row's chain in the shared arena"""
+        with self._lock:
+            offset = len(self._hist_arena)
+            self._hist_arena += self._LINK.pack(self._hist_tail[row])
+            self._hist_arena += raw
+            self._hist_tail[row] = offset
+            self._hist_len[row] += 1
+    
+    def _append_many(self, entries):
+        """Link (row, packed record) pairs onto their chains with one arena write"""
+        step = self._LINK.size + _HistoryBase.RECORD.size
+        with self._lock:
+            offset = len(self._hist_arena)
+            chunks = []
+            for row, raw in entries:
+                chunks.append(self._LINK.pack(self._hist_tail[row]))
+                chunks.append(raw)
+                self._hist_tail[row] = offset
+                self._hist_len[row] += 1
+                offset += step
+            self._hist_arena += b''.join(chunks)
+    
+    def _history_len(self, row):
+        return self._hist_len[row]
+    
+    def _clear_history(self, row):
+        self._hist_tail[row] = -1
+        self._hist_len[row] = 0
+    
+    def _truncate_history(self, row, count):
+        """Unlink the newest records until count remain"""
+        while self._hist_len[row] > count:
+            self._hist_tail[row] = self._LINK.unpack_from(self._hist_arena, self._hist_tail[row])[0]
+            self._hist_len[row] -= 1
+    
+    def _read_history(self, row, count=None):
+        """Walk the row's chain backwards and return packed records oldest first
+        
+        With count set, only the newest count records are read.
+        """
+        entries = []
+        offset = self._hist_tail[row]
+        link = self._LINK.size
+        size = _HistoryBase.RECORD.size
+        arena = self._hist_arena
+        while offset >= 0 and (count is None or len(entries) < count):
+            entries.append(bytes(arena[offset + link:offset + link + size]))
+            offset = self._LINK.unpack_from(arena, offset)[0]
+        entries.reverse()
+        return entries
+    
+    def vacuum(self):
+        """Rebuild the arenas, dropping space left by deleted accounts"""
+        with self.locks.holding_all(), self._lock:
+            histories = {row: self._read_history(row) for row in self._rows.values()}
+            passwords = {row: self._get_password(row) for row in self._rows.values()}
+            self._pwd_arena = bytearray()
+            self._hist_arena = bytearray()
+            for row in self._rows.values():
+                self._set_password(row, passwords[row])
+                self._clear_history(row)
+                for entry in histories[row]:
+                    self._append_history(row, entry)
+
+class MappedAccountView(AccountView):
+    """Account interface over one record of a MappedAccountStore"""
+    
+    __slots__ = ()
+    
+    @property
+    def number(self):
+        return str(self._store._get(self._row, MappedAccountStore.NUMBER))
+    
+    @property
+    def type(self):
+        store = self._store
+        return CompactAccountStore.KINDS[store._map[store._offset(self._row) + store.KIND]]
+    
+    @property
+    def _cents(self):
+        return self._store._get(self._row, MappedAccountStore.BALANCE)
+    
+    @_cents.setter
+    def _cents(self, cents):
+        self._store._put(self._row, MappedAccountStore.BALANCE, cents)
+    
+    @property
+    def _phone_cents(self):
+        return self._store._get(self._row, MappedAccountStore.PHONE)
+    
+    @_phone_cents.setter
+    def _phone_cents(self, cents):
+        self._store._put(self._row, MappedAccountStore.PHONE, cents)
+
+class MappedAccountStore(MutableMapping):
+    """Accounts in a memory-mapped file of fixed-width binary records
+    
+    Three files sit side by side: path holds a header and the records,
+    path.idx an open-addressing hash table from account number to record,
+    and path.hist every account's history as a chain of packed records
+    (the same layout CompactAccountStore keeps in memory). Opening only
+    maps the files, so startup does not depend on the number of accounts,
+    and reading or updating a balance touches the one page holding it.
+    """
+    
+    MAGIC = b'BANKMAP1'
+    HEADER = struct.Struct('<8sqqqq')  # magic, capacity, used, live, free head
+    HEADER_SIZE = 64
+    RECORD = struct.Struct('<qqqqqBBH128s')  # number, balance, phone, history tail/len, kind, live, pwd
+    NUMBER, BALANCE, PHONE, TAIL, HIST_LEN, KIND, LIVE, PWD_LEN, PWD = 0, 8, 16, 24, 32, 40, 41, 42, 44
+    INDEX_MAGIC = b'BANKIDX1'
+    INDEX_HEADER = struct.Struct('<8sqq')  # magic, slots, used slots
+    SLOT = struct.Struct('<qq')  # account number, record + 1 (0 once deleted)
+    _Q = struct.Struct('<q')
+    _H = struct.Struct('<H')
+    _LINK = struct.Struct('<q')
+    
+    def __init__(self, path, capacity=1024, locks=None):
+        self.path = path
+        self.locks = ACCOUNT_LOCKS if locks is None else locks
+        self._lock = threading.RLock()
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, capacity, 0, 0, -1).ljust(self.HEADER_SIZE, b'\0'))
+                f.truncate(self.HEADER_SIZE + capacity * self.RECORD.size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self._capacity, self._used, self._live, self._free = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise BankError(f"{path} is not a binary bank data file")
+        if not os.path.exists(path + ".hist"):
+            open(path + ".hist", 'wb').close()
+        self._hist = open(path + ".hist", 'r+b')
+        self._hist_end = self._hist.seek(0, os.SEEK_END)
+        self._idx_file = None
+        self._index = None  # (map, slots, shift), replaced whole by a rebuild
+        if os.path.exists(path + ".idx"):
+            self._open_index()
+        else:
+            self.rebuild_index()
+    
+    # Record fields
+    
+    def _offset(self, row):
+        return self.HEADER_SIZE + row * self.RECORD.size
+    
+    def _get(self, row, field):
+        return self._Q.unpack_from(self._map, self._offset(row) + field)[0]
+    
+    def _put(self, row, field, value):
+        self._Q.pack_into(self._map, self._offset(row) + field, value)
+    
+    def _write_header(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self._capacity,
+                              self._used, self._live, self._free)
+    
+    def _get_password(self, row):
+        start = self._offset(row)
+        length = self._H.unpack_from(self._map, start + self.PWD_LEN)[0]
+        return self._map[start + self.PWD:start + self.PWD + length].decode()
+    
+    def _set_password(self, row, pwd):
+        data = pwd.encode()
+        if len(data) > 128:
+            raise BadInputError("Password too long for the binary format")
+        start = self._offset(row)
+        self._H.pack_into(self._map, start + self.PWD_LEN, len(data))
+        self._map[start + self.PWD:start + self.PWD + len(data)] = data
+    
+    # Hash index
+    
+    def _open_index(self):
+        self._idx_file = open(self.path + ".idx", 'r+b')
+        idx = mmap.mmap(self._idx_file.fileno(), 0)
+        magic, slots, self._slots_used = self.INDEX_HEADER.unpack_from(idx, 0)
+        if magic != self.INDEX_MAGIC:
+            raise BankError(f"{self.path}.idx is not a bank index file")
+        self._index = (idx, slots, 64 - (slots.bit_length() - 1))
+    
+    def _probe(self, key, index=None):
+        """Slot holding key, or the empty slot where it would go; and its record
+        
+        Lookups take no lock, so the index is read once and a rebuild
+        going on meanwhile can't mix an old map with a new size.
+        """
+        idx, slots, shift = index or self._index
+        base = self.INDEX_HEADER.size
+        mask = slots - 1
+        i = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> shift
+        while True:
+            slot_key, ref = self.SLOT.unpack_from(idx, base + i * self.SLOT.size)
+            if slot_key == key or slot_key == 0:
+                return i, ref - 1
+            i = (i + 1) & mask
+    
+    def _set_slot(self, i, key, row, index=None):
+        idx = (index or self._index)[0]
+        self.SLOT.pack_into(idx, self.INDEX_HEADER.size + i * self.SLOT.size, key, row + 1)
+    
+    def rebuild_index(self, slots=None):
+        """Write a fresh index from the records, e.g. after a crash lost it
+        
+        Holds every account stripe, so no operation is running on the
+        accounts while the index is replaced.
+        """
+        with self.locks.reading_all():
+            self._rebuild_index(slots)
+    
+    def _rebuild_index(self, slots=None):
+        """Build the new index in full beside the old one, then swap it in
+        
+        Growing the index mid-write comes here directly, since the writer
+        already holds its stripe and the store lock. The old map is not
+        closed: a lookup may still be probing it, and it goes once unused.
+        """
+        with self._lock:
+            slots = slots or 1024
+            while slots < self._live * 4:
+                slots *= 2
+            tmp = self.path + ".idx.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, slots, 0))
+                f.truncate(self.INDEX_HEADER.size + slots * self.SLOT.size)
+            idx_file = open(tmp, 'r+b')
+            index = (mmap.mmap(idx_file.fileno(), 0), slots, 64 - (slots.bit_length() - 1))
+            used = 0
+            for row in range(self._used):
+                if self._map[self._offset(row) + self.LIVE]:
+                    key = self._get(row, self.NUMBER)
+                    self._set_slot(self._probe(key, index)[0], key, row, index)
+                    used += 1
+            self.INDEX_HEADER.pack_into(index[0], 0, self.INDEX_MAGIC, slots, used)
+            os.replace(tmp, self.path + ".idx")
+            old_file = self._idx_file
+            self._idx_file, self._slots_used = idx_file, used
+            self._index = index
+            if old_file is not None:
+                old_file.close()
+    
+    # Mapping interface
+    
+    _key = staticmethod(CompactAccountStore._key)
+    
+    def __getitem__(self, num):
+        key = self._key(num)
+        if key <= 0:
+            raise KeyError(num)
+        row = self._probe(key)[1]
+        if row < 0:
+            raise KeyError(num)
+        return MappedAccountView(self, row)
+    
+    def __setitem__(self, num, acc):
+        if not str(num).isdigit() or int(num) == 0:
+            raise BadInputError("Account numbers must be numeric")
+        key = self._key(num)
+        if isinstance(acc, MappedAccountView) and acc._store is self and self._probe(key)[1] == acc._row:
+            return
+        records = list(acc.history.raw_records())
+        with self._lock:
+            slot, row = self._probe(key)
+            if row < 0:
+                row = self._new_row()
+                if (self._slots_used + 1) * 2 > self._index[1]:
+                    self._rebuild_index(self._index[1] * 2)
+                    slot = self._probe(key)[0]
+                if self.SLOT.unpack_from(self._index[0], self.INDEX_HEADER.size + slot * self.SLOT.size)[0] == 0:
+                    self._slots_used += 1
+                self._live += 1
+            start = self._offset(row)
+            self._put(row, self.NUMBER, key)
+            self._put(row, self.BALANCE, acc._cents)
+            self._put(row, self.PHONE, acc._phone_cents)
+            kind = CompactAccountStore.KINDS.index(acc.type) if acc.type in CompactAccountStore.KINDS else 0
+            self._map[start + self.KIND] = kind
+            self._map[start + self.LIVE] = 1
+            self._set_password(row, acc.password)
+            self._clear_history(row)
+            for raw in records:
+                self._append_history(row, raw)
+            self._set_slot(slot, key, row)
+            self._write_header()
+            idx, slots, _ = self._index
+            self.INDEX_HEADER.pack_into(idx, 0, self.INDEX_MAGIC, slots, self._slots_used)
+    
+    def __delitem__(self, num):
+        key = self._key(num)
+        with self._lock:
+            slot, row = self._probe(key)
+            if row < 0:
+                raise KeyError(num)
+            self._set_slot(slot, key, -1)  # tombstone keeps later probes going
+            self._map[self._offset(row) + self.LIVE] = 0
+            self._put(row, self.BALANCE, 0)
+            self._put(row, self.NUMBER, self._free)  # deleted records chain the free list
+            self._free = row
+            self._live -= 1
+            self._write_header()
+    
+    def __contains__(self, num):
+        try:
+            key = int(num)
+        except (TypeError, ValueError):
+            return False
+        return key > 0 and self._probe(key)[1] >= 0
+    
+    def __iter__(self):
+        for row in range(self._used):
+            if self._map[self._offset(row) + self.LIVE]:
+                yield str(self._get(row, self.NUMBER))
+    
+    def __len__(self):
+        return self._live
+    
+    def _new_row(self):
+        """Reuse a deleted record or take the next one, growing the file"""
+        if self._free >= 0:
+            row = self._free
+            self._free = self._get(row, self.NUMBER)
+            return row
+        if self._used == self._capacity:
+            self._capacity *= 2
+            # Readers may still hold the old map; it stays valid until dropped
+            self._file.truncate(self.HEADER_SIZE + self._capacity * self.RECORD.size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used += 1
+        return self._used - 1
+    
+    # History chains
+    
+    def _history_len(self, row):
+        return self._get(row, self.HIST_LEN)
+    
+    def _clear_history(self, row):
+        self._put(row, self.TAIL, -1)
+        self._put(row, self.HIST_LEN, 0)
+    
+    def _append_history(self, row, raw):
+        with self._lock:
+            offset = self._hist_end
+            self._hist.seek(offset)
+            self._hist.write(self._LINK.pack(self._get(row, self.TAIL)) + raw)
+            self._hist_end = self._hist.tell()
+            self._put(row, self.TAIL, offset)
+            self._put(row, self.HIST_LEN, self._get(row, self.HIST_LEN) + 1)
+    
+    def _append_many(self, entries):
+        """Link (row, packed record) pairs onto their chains with one file write"""
+        step = self._LINK.size + _HistoryBase.RECORD.size
+        with self._lock:
+            offset = self._hist_end
+            chunks = []
+            for row, raw in entries:
+                chunks.append(self._LINK.pack(self._get(row, self.TAIL)))
+                chunks.append(raw)
+                self._put(row, self.TAIL, offset)
+                self._put(row, self.HIST_LEN, self._get(row, self.HIST_LEN) + 1)
+                offset += step
+            self._hist.seek(self._hist_end)
+            self._hist.write(b''.join(chunks))
+            self._hist_end = offset
+    
+    def _truncate_history(self, row, count):
+        with self._lock:
+            while self._get(row, self.HIST_LEN) > count:
+                self._hist.seek(self._get(row, self.TAIL))
+                self._put(row, self.TAIL, self._LINK.unpack(self._hist.read(self._LINK.size))[0])
+                self._put(row, self.HIST_LEN, self._get(row, self.HIST_LEN) - 1)
+    
+    def _read_history(self, row, count=None):
+        """Packed records oldest first; with count, only the newest count"""
+        entries = []
+        link = self._LINK.size
+        size = _HistoryBase.RECORD.size
+        with self._lock:
+            offset = self._get(row, self.TAIL)
+            while offset >= 0 and (count is None or len(entries) < count):
+                self._hist.seek(offset)
+                data = self._hist.read(link + size)
+                entries.append(data[link:])
+                offset = self._LINK.unpack_from(data)[0]
+        entries.reverse()
+        return entries
+    
+    def flush(self):
+        """Make every change so far durable"""
+        with self._lock:
+            self._hist.flush()
+            os.fsync(self._hist.fileno())
+            self._map.flush()
+            self._index[0].flush()
+    
+    def close(self):
+        with self._lock:
+            index = getattr(self, '_index', None)
+            for handle in (self._map, self._file, index and index[0],
+                           getattr(self, '_idx_file', None), getattr(self, '_hist', None)):
+                if handle is not None and not handle.closed:
+                    handle.close()
+
+def convert_text_to_binary(text_path, binary_path):
+    """Write the binary files for binary_path from a text data file"""
+    if os.path.exists(text_path + BankManager.JOURNAL_SUFFIX):
+        raise BankError("Fold the journal into the data file before converting")
+    for suffix in ("", ".idx", ".hist"):
+        if os.path.exists(binary_path + suffix):
+            os.remove(binary_path + suffix)
+    tmp = binary_path + ".tmp"
+    with open(text_path) as f:
+        lines = [line for line in f if line.count('|') >= 4 and not line.startswith('#')]
+    store = MappedAccountStore(tmp, capacity=max(len(lines), 1024))
+    try:
+        for line in lines:
+            acc = BankManager._parse_line(line)
+            store[acc.number] = acc
+        store.flush()
+    finally:
+        store.close()
+    os.replace(tmp + ".hist", binary_path + ".hist")
+    os.replace(tmp + ".idx", binary_path + ".idx")
+    os.replace(tmp, binary_path)  # last, so a half-done conversion is never opened
+    return len(lines)
+
+def convert_binary_to_text(binary_path, text_path):
+    """Write a text data file from the binary files at binary_path"""
+    store = MappedAccountStore(binary_path)
+    try:
+        count = 0
+        with open(text_path + ".tmp", 'w') as f:
+            for acc in store.values():
+                f.write(BankManager._format_line(acc, acc.history.encode()))
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        store.close()
+    os.replace(text_path + ".tmp", text_path)
+    return count
+
+class StorageBackend:
+    """Where a BankManager keeps accounts between runs
+    
+    Account fields and transactions are written separately, so a backend
+    can store just what an operation changed. Writes made inside one
+    transaction() block land together.
+    """
+    
+    def load_accounts(self):
+        """Iterate every stored account, histories included"""
+        raise NotImplementedError
+    
+    def load_account(self, num):
+        """One stored account, or None"""
+        raise NotImplementedError
+    
+    def upsert_account(self, acc):
+        """Store an account's number, password, type and balances"""
+        raise NotImplementedError
+    
+    def append_transactions(self, num, transactions):
+        """Add Transaction records to the end of an account's history"""
+        raise NotImplementedError
+    
+    def delete_account(self, num):
+        """Remove an account and its history"""
+        raise NotImplementedError
+    
+    @contextmanager
+    def transaction(self):
+        yield
+    
+    def close(self):
+        pass
+
+class TextFileBackend(StorageBackend):
+    """The '|' separated data file; each transaction rewrites the whole file"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._rows = None  # number -> [password, type, cents, phone cents, History]
+        self._depth = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+    
+    def _load(self):
+        if self._rows is None:
+            self._rows = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        if line.count('|') >= 4 and not line.startswith('#'):
+                            acc = BankManager._parse_line(line)
+                            self._rows[acc.number] = [acc.password, acc.type, acc._cents,
+                                                      acc._phone_cents, acc.history]
+        return self._rows
+    
+    def _account(self, num, row):
+        acc = BankManager._make_account(num, row[0], row[1], 0, 0)
+        acc._cents, acc._phone_cents = row[2], row[3]
+        acc.history = History(row[4].records())
+        return acc
+    
+    def load_accounts(self):
+        with self._lock:
+            rows = list(self._load().items())
+        return (self._account(num, row) for num, row in rows)
+    
+    def load_account(self, num):
+        with self._lock:
+            row = self._load().get(num)
+            return None if row is None else self._account(num, row)
+    
+    def upsert_account(self, acc):
+        with self.transaction():
+            row = self._load().get(acc.number)
+            if row is None:
+                self._rows[acc.number] = [acc.password, acc.type, acc._cents, acc._phone_cents, History()]
+            else:
+                row[:4] = [acc.password, acc.type, acc._cents, acc._phone_cents]
+            self._dirty = True
+    
+    def append_transactions(self, num, transactions):
+        with self.transaction():
+            self._load()[num][4].extend(transactions)
+            self._dirty = True
+    
+    def delete_account(self, num):
+        with self.transaction():
+            self._load().pop(num, None)
+            self._dirty = True
+    
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            if self._depth == 0 and self._dirty:
+                self._write()
+    
+    def _write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            for num, (pwd, kind, cents, phone, history) in self._rows.items():
+                f.write(f"{num}|{pwd}|{kind}|{_format_cents(cents)}|"
+                        f"{_format_cents(phone)}|{history.encode()}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        _fsync_dir(self.path)
+        self._dirty = False
+
+class SqliteBackend(StorageBackend):
+    """Accounts and transactions in a SQLite database in WAL mode
+    
+    Every statement is fixed SQL with parameters, so sqlite3 prepares each
+    one once and reuses it from its statement cache. Both tables are keyed
+    by account number.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS accounts (
+            number TEXT PRIMARY KEY, password TEXT NOT NULL, kind TEXT NOT NULL,
+            cents INTEGER NOT NULL, phone_cents INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS transactions (
+            number TEXT NOT NULL, seq INTEGER NOT NULL, op INTEGER NOT NULL,
+            cents INTEGER NOT NULL, counterparty INTEGER NOT NULL, time INTEGER NOT NULL,
+            PRIMARY KEY (number, seq)) WITHOUT ROWID;
+    """
+    UPSERT = ("INSERT INTO accounts VALUES (?, ?, ?, ?, ?) ON CONFLICT(number) DO UPDATE SET "
+              "password = excluded.password, kind = excluded.kind, "
+              "cents = excluded.cents, phone_cents = excluded.phone_cents")
+    APPEND = "INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?)"
+    
+    def __init__(self, path, synchronous="FULL"):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._depth = 0
+    
+    def _history(self, rows):
+        history = History()
+        for seq, op, cents, counterparty, when in rows:
+            history.append(Transaction(op, cents, counterparty, when, seq))
+        return history
+    
+    def _account(self, row, history):
+        acc = BankManager._make_account(row[0], row[1], row[2], 0, 0)
+        acc._cents, acc._phone_cents = row[3], row[4]
+        acc.history = history
+        return acc
+    
+    def load_accounts(self):
+        with self._lock:
+            accounts = self._conn.execute("SELECT * FROM accounts ORDER BY number").fetchall()
+            txns = self._conn.execute(
+                "SELECT number, seq, op, cents, counterparty, time FROM transactions "
+                "ORDER BY number, seq").fetchall()
+        i = 0
+        for row in accounts:
+            while i < len(txns) and txns[i][0] < row[0]:
+                i += 1  # rows left behind by an account that is gone
+            start = i
+            while i < len(txns) and txns[i][0] == row[0]:
+                i += 1
+            yield self._account(row, self._history(t[1:] for t in txns[start:i]))
+    
+    def load_account(self, num):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM accounts WHERE number = ?", (num,)).fetchone()
+            if row is None:
+                return None
+            txns = self._conn.execute(
+                "SELECT seq, op, cents, counterparty, time FROM transactions "
+                "WHERE number = ? ORDER BY seq", (num,)).fetchall()
+        return self._account(row, self._history(txns))
+    
+    def upsert_account(self, acc):
+        with self.transaction():
+            self._conn.execute(self.UPSERT, (acc.number, acc.password, acc.type,
+                                             acc._cents, acc._phone_cents))
+    
+    def append_transactions(self, num, transactions):
+        with self.transaction():
+            self._conn.executemany(self.APPEND, [
+                (num, t.seq, t.op, t.amount, t.counterparty, t.timestamp) for t in transactions])
+    
+    def delete_account(self, num):
+        with self.transaction():
+            self._conn.execute("DELETE FROM accounts WHERE number = ?", (num,))
+            self._conn.execute("DELETE FROM transactions WHERE number = ?", (num,))
+    
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute("COMMIT")
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def migrate(source, target):
+    """Copy every account and its history from one backend to another"""
+    count = 0
+    with target.transaction():
+        for acc in source.load_accounts():
+            target.delete_account(acc.number)
+            target.upsert_account(acc)
+            target.append_transactions(acc.number, list(acc.history.records()))
+            count += 1
+    return count
+
+class HistoryArchive:
+    """Old history in compressed segments, one append-only file per account
+    
+    Each segment is a header (codec, record count, compressed size and
+    the first record, uncompressed) followed by its packed records,
+    compressed with zlib or lzma. A segment is written before its records
+    leave the hot history; if the hot history still starts with a
+    segment's first record, that archive run never finished and the
+    segment is ignored. Segment headers are read once per account and
+    cached until this archive appends to or removes its file.
+    """
+    
+    CODECS = ('zlib', 'lzma')
+    SEGMENT = struct.Struct('<BII' + _HistoryBase.RECORD.format[1:])
+    
+    def __init__(self, directory, codec='zlib'):
+        if codec not in self.CODECS:
+            raise BadInputError(f"Unknown archive codec: {codec}")
+        self.directory = directory
+        self.codec = self.CODECS.index(codec)
+        self._lock = threading.Lock()
+        self._cache = {}  # account -> segments in its file
+    
+    def _path(self, num):
+        return os.path.join(self.directory, f"{num}.arc")
+    
+    def accounts(self):
+        """Numbers of the accounts that have an archive file"""
+        if not os.path.isdir(self.directory):
+            return set()
+        return {name[:-4] for name in os.listdir(self.directory) if name.endswith(".arc")}
+    
+    def _segments(self, num, history):
+        """(data offset, codec, records, size, first record) per finished segment, oldest first"""
+        segments = self._cache.get(num)
+        if segments is None:
+            with self._lock:
+                segments = self._cache.get(num)
+                if segments is None:
+                    segments = self._cache[num] = self._read(num)
+        return self._finished(segments, history)
+    
+    @staticmethod
+    def _finished(segments, history):
+        if segments and history and history.page(0, 1)[0] == segments[-1][4]:
+            return segments[:-1]
+        return segments
+    
+    def _read(self, num):
+        """Every segment in num's file, read from its headers"""
+        path = self._path(num)
+        if not os.path.exists(path):
+            return []
+        segments = []
+        with open(path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            offset = 0
+            while offset + self.SEGMENT.size <= end:
+                f.seek(offset)
+                codec, count, size, *first = self.SEGMENT.unpack(f.read(self.SEGMENT.size))
+                offset += self.SEGMENT.size
+                if offset + size > end:
+                    break  # torn append
+                segments.append((offset, codec, count, size, tuple(first)))
+                offset += size
+        return segments
+    
+    def count(self, num, history):
+        """Number of archived entries for num"""
+        return sum(segment[2] for segment in self._segments(num, history))
+    
+    def append(self, num, raws, history):
+        """Store the oldest packed records of history as a new segment and make it durable"""
+        data = b''.join(raws)
+        packed = zlib.compress(data, 9) if self.codec == 0 else lzma.compress(data)
+        header = self.SEGMENT.pack(self.codec, len(raws), len(packed), *History.RECORD.unpack(raws[0]))
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(num)
+            segments = self._finished(self._read(num), history)
+            end = segments[-1][0] + segments[-1][3] if segments else 0
+            self._cache.pop(num, None)
+            with open(path, 'ab') as f:
+                if f.tell() != end:
+                    f.truncate(end)  # drop a torn or unfinished segment
+                f.write(header + packed)
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def records(self, num, history, offset=0, limit=None):
+        """Stream archived Transactions from offset, decompressing only segments needed"""
+        segments = self._segments(num, history)
+        if not segments or (limit is not None and limit <= 0):
+            return
+        size = History.RECORD.size
+        with open(self._path(num), 'rb') as f:
+            for start, codec, count, length, _ in segments:
+                if offset >= count:
+                    offset -= count
+                    continue
+                f.seek(start)
+                data = f.read(length)
+                data = zlib.decompress(data) if codec == 0 else lzma.decompress(data)
+                for i in range(offset * size, len(data), size):
+                    yield Transaction._make(History.RECORD.unpack_from(data, i))
+                    if limit is not None:
+                        limit -= 1
+                        if limit == 0:
+                            return
+                offset = 0
+    
+    def remove(self, num):
+        """Forget a deleted account's archive"""
+        with self._lock:
+            self._cache.pop(num, None)
+            if os.path.exists(self._path(num)):
+                os.remove(self._path(num))
+
+class AccountNumberAllocator:
+    """Hands out unused account numbers in random order in O(1)
+    
+    Works as a lazy Fisher-Yates shuffle over [low, high]: only swapped
+    positions are remembered, so memory grows with the numbers handed out
+    rather than with the size of the range.
+    """
+    
+    def __init__(self, low=10000, high=99999, rng=None):
+        if high < low:
+            raise BadInputError("Account number range is empty")
+        self.low = low
+        self.high = high
+        self._size = high - low + 1
+        self._next = 0
+        self._swaps = {}
+        self._drawn = set()  # numbers the shuffle has handed out
+        self._reserved = set()
+        self._released = []
+        self._rng = rng or random.SystemRandom()
+        self._lock = threading.RLock()
+    
+    def available(self):
+        """How many numbers can still be handed out"""
+        return self._size - self._next - len(self._reserved) + len(self._released)
+    
+    def reserve(self, num):
+        """Mark a number as taken, e.g. by an account loaded from disk
+        
+        A released number leaves the pool again; one the shuffle already
+        handed out is taken already and changes nothing.
+        """
+        num = int(num)
+        if self.low <= num <= self.high:
+            with self._lock:
+                if num in self._released:
+                    self._released.remove(num)
+                elif num not in self._drawn:
+                    self._reserved.add(num)
+    
+    def release(self, num):
+        """Return a deleted account's number to the pool"""
+        num = int(num)
+        if not self.low <= num <= self.high:
+            return
+        with self._lock:
+            if num in self._reserved:
+                self._reserved.discard(num)
+            else:
+                self._released.append(num)
+    
+    def allocate(self):
+        """Return one unused number"""
+        with self._lock:
+            return self._draw()
+    
+    def _draw(self):
+        while True:
+            available = self.available()
+            if available <= 0:
+                raise AccountsExhaustedError("No account numbers left")
+            
+            released = len(self._released)
+            if released and self._rng.random() * available < released:
+                i = self._rng.randrange(released)
+                self._released[i], self._released[-1] = self._released[-1], self._released[i]
+                return self._released.pop()
+            
+            # Swap a random undrawn position into slot _next and take it
+            j = self._rng.randrange(self._next, self._size)
+            head = self._swaps.pop(self._next, self._next)
+            if j == self._next:
+                value = head
+            else:
+                value = self._swaps.get(j, j)
+                self._swaps[j] = head
+            self._next += 1
+            value += self.low
+            self._drawn.add(value)
+            if value in self._reserved:
+                self._reserved.discard(value)
+                continue
+            return value
+    
+    def allocate_many(self, count):
+        """Return count unused numbers, or raise before taking any"""
+        with self._lock:
+            if count > self.available():
+                raise AccountsExhaustedError(
+                    f"Only {self.available()} account numbers left, {count} requested")
+            return [self._draw() for _ in range(count)]
+
+class TTLCache:
+    """Mapping whose entries expire ttl seconds after they are stored
+    
+    Every entry lives for the same ttl, so insertion order is expiry order
+    and expired entries are dropped from the front on each call. With
+    max_size set, the oldest entries also make room for new ones.
+    """
+    
+    def __init__(self, ttl, max_size=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (value, expires), oldest first
+        self._lock = threading.Lock()
+    
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            key, (value, expires) = next(iter(entries.items()))
+            if expires > now:
+                break
+            entries.popitem(last=False)
+    
+    def put(self, key, value):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now + self.ttl)
+            if self.max_size is not None and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._entries.get(key)
+        return default if entry is None else entry[0]
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+    
+    def discard_values(self, value):
+        """Drop every entry holding value"""
+        with self._lock:
+            for key in [k for k, (v, _) in self._entries.items() if v == value]:
+                del self._entries[key]
+    
+    def __len__(self):
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._entries)
+
+class LoginRateLimiter:
+    """Lock an account out after too many failed logins in a short window"""
+    
+    def __init__(self, max_failures=5, window=60, lockout=300, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self._clock = clock
+        self._failures = {}  # account -> deque of failure times
+        self._locked = {}  # account -> time the lockout ends
+        self._lock = threading.Lock()
+    
+    def check(self, num):
+        """Raise TooManyAttemptsError while num is locked out"""
+        if not self._locked:
+            return
+        with self._lock:
+            until = self._locked.get(num)
+            if until is None:
+                return
+            if self._clock() < until:
+                raise TooManyAttemptsError("Too many failed logins, try again later")
+            del self._locked[num]
+    
+    def failed(self, num):
+        """Note a failed login; start a lockout once the limit is reached"""
+        with self._lock:
+            now = self._clock()
+            times = self._failures.setdefault(num, deque())
+            times.append(now)
+            while times and times[0] <= now - self.window:
+                times.popleft()
+            if len(times) >= self.max_failures:
+                del self._failures[num]
+                self._locked[num] = now + self.lockout
+    
+    def succeeded(self, num):
+        """Forget earlier failures after a good login"""
+        if num in self._failures:
+            with self._lock:
+                self._failures.pop(num, None)
+    
+    def forget(self, num):
+        with self._lock:
+            self._failures.pop(num, None)
+            self._locked.pop(num, None)
+
+class Statement:
+    """Rendered history lines and per-op totals (in cents) for one account"""
+    
+    __slots__ = ('lines', 'totals', 'count', 'last', 'size', '_text')
+    
+    LINE_OVERHEAD = 64  # rough bytes per cached str beyond its characters
+    
+    def __init__(self):
+        self.lines = []
+        self.totals = dict.fromkeys(_OP_TEXT, 0)
+        self.count = 0
+        self.last = None
+        self.size = 0
+        self._text = None
+    
+    def add(self, entries):
+        """Fold newly appended transactions into the statement"""
+        start = len(self.lines)
+        for txn in entries:
+            line = str(txn)
+            self.lines.append(line)
+            self.totals[txn.op] += txn.amount
+            self.size += len(line) + self.LINE_OVERHEAD
+        if entries:
+            self.count += len(entries)
+            self.last = entries[-1]
+            if self._text is not None:
+                # Only the new lines are joined; with no other reference to
+                # the old text, CPython grows it in place instead of copying
+                text, self._text = self._text, None
+                text += ("\n" if start else "") + "\n".join(self.lines[start:])
+                self._text = text
+    
+    @property
+    def text(self):
+        """The whole history, one entry per line"""
+        if self._text is None:
+            self._text = "\n".join(self.lines)
+        return self._text
+    
+    def page(self, offset=0, limit=None):
+        end = None if limit is None else offset + limit
+        return self.lines[max(offset, 0):end]
+
+class StatementCache:
+    """Statements for recently read accounts, capped in memory
+    
+    An entry remembers how many transactions it covers and the newest one.
+    When the history has grown past that, only the new transactions are
+    rendered; if it was cut back instead, the entry is rebuilt. The least
+    recently read entries are dropped once max_bytes is exceeded.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # account -> Statement, least recent first
+        self._lock = threading.Lock()
+    
+    def get(self, num, history):
+        """The statement for num's current history"""
+        with self._lock:
+            statement = self._entries.get(num)
+            if statement is not None:
+                self._entries.move_to_end(num)
+                statement = self._catch_up(num, statement, history)
+            if statement is not None:
+                self.hits += 1
+                return statement
+            self.misses += 1
+        
+        statement = Statement()
+        statement.add(history.page())
+        with self._lock:
+            if statement.size <= self.max_bytes:
+                self._store(num, statement)
+        return statement
+    
+    def _catch_up(self, num, statement, history):
+        """Extend statement with new transactions, or drop it if it went stale"""
+        grown = len(history) - statement.count
+        if grown >= 0:
+            entries = history.tail(grown + 1)
+            if statement.count == 0 or (entries and entries[0] == statement.last):
+                old_size = statement.size
+                statement.add(entries[1:] if statement.count else entries)
+                self.size += statement.size - old_size
+                self._trim()
+                return statement
+        self._discard(num)
+        return None
+    
+    def _store(self, num, statement):
+        self._discard(num)
+        self._entries[num] = statement
+        self.size += statement.size
+        self._trim()
+    
+    def _trim(self):
+        while self.size > self.max_bytes and self._entries:
+            _, statement = self._entries.popitem(last=False)
+            self.size -= statement.size
+    
+    def _discard(self, num):
+        statement = self._entries.pop(num, None)
+        if statement is not None:
+            self.size -= statement.size
+    
+    def discard(self, num):
+        """Forget num's statement, e.g. after its history was rewritten"""
+        with self._lock:
+            self._discard(num)
+    
+    def __len__(self):
+        return len(self._entries)
+
+class AccountSnapshot(namedtuple('AccountSnapshot', 'number type cents phone_cents')):
+    """One account's values as they were when a Snapshot was taken"""
+    
+    __slots__ = ()
+    
+    @property
+    def balance(self):
+        return _from_cents(self.cents)
+    
+    @property
+    def phone_credit(self):
+        return _from_cents(self.phone_cents)
+
+class Snapshot:
+    """Read-only, point-in-time view of a bank's accounts
+    
+    Nothing is copied up front: taking one only waits for writes already
+    in progress to finish. After that, a writer saves an account's values
+    here the first time it locks that account. Readers take no account
+    locks. Close it (or use it in a with block) so writers stop saving
+    values for it; one that is dropped unclosed stops when collected.
+    """
+    
+    _MISSING = object()
+    
+    def __init__(self, bank):
+        self._bank = bank
+        self._saved = {}  # account -> AccountSnapshot, or None if it didn't exist yet
+        ref = weakref.ref(self)
+        
+        def before_write(nums):
+            snapshot = ref()
+            if snapshot is not None:
+                snapshot._before_write(nums)
+        
+        watchers = bank.locks.watchers
+        with bank.locks.reading_all():
+            # A write that already holds its locks would never be seen
+            self.taken = time.time()
+            watchers.append(before_write)
+        self._unwatch = weakref.finalize(self, watchers.remove, before_write)
+    
+    @staticmethod
+    def _freeze(acc):
+        return AccountSnapshot(acc.number, acc.type, acc._cents, acc._phone_cents)
+    
+    def _before_write(self, nums):
+        """Save accounts' current values before they first change; runs under their locks"""
+        accounts = self._bank.accounts
+        saved = self._saved
+        for num in (list(accounts) if nums is None else nums):
+            if num not in saved:
+                acc = accounts.get(num)
+                saved[num] = None if acc is None else self._freeze(acc)
+    
+    def _scan(self, keys):
+        accounts = self._bank.accounts
+        saved = self._saved
+        for num in keys:
+            value = saved.get(num, self._MISSING)
+            if value is self._MISSING:
+                acc = accounts.get(num)
+                live = None if acc is None else self._freeze(acc)
+                # A writer saves first, so a change during the read shows up here
+                value = saved.get(num, live)
+            if value is not None:
+                yield value
+    
+    def _removed(self, keys):
+        """Accounts deleted before the scan listed the live ones"""
+        keys = set(keys)
+        for num, value in list(self._saved.items()):
+            if value is not None and num not in keys:
+                yield value
+    
+    def parts(self, count):
+        """Split the snapshot into count iterables that can be scanned in parallel"""
+        keys = list(self._bank.accounts)
+        size = max(-(-len(keys) // max(count, 1)), 1)
+        parts = [self._scan(keys[i:i + size]) for i in range(0, len(keys), size)]
+        parts.append(self._removed(keys))
+        return parts
+    
+    def __iter__(self):
+        for part in self.parts(1):
+            yield from part
+    
+    def get(self, num, default=None):
+        """One account's snapshot values"""
+        return next(self._scan([num]), default)
+    
+    def close(self):
+        self._unwatch()
+        self._saved = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class _RecordSnapshot(Snapshot):
+    """Snapshot of each account's data file line, for compact()
+    
+    Values are (account, lazy history or None, line). A lazily loaded
+    history is left out of the line and read from its file at render time.
+    """
+    
+    @staticmethod
+    def _freeze(acc):
+        lazy = None if acc.history_loaded else acc._lazy_history
+        history = '' if lazy is not None else acc.history.encode()
+        return acc, lazy, BankManager._format_line(acc, history)
+
+class LedgerIndex:
+    """Secondary indexes over every account's transactions, archived ones included
+    
+    Postings are listed per account, counterparty and op, and sorted by
+    amount and by time, so a query starts from whichever index narrows it
+    most. Everything is indexed on the first query. After that the index
+    watches the account locks, and only accounts locked for a change
+    since are caught up.
+    """
+    
+    def __init__(self, locks, archive=None):
+        self.built = False
+        self._locks = locks
+        self._archive = archive
+        self._lock = threading.Lock()
+        self._marks = threading.Lock()  # _dirty and _forgotten; taken under account locks
+        self._dirty = set()
+        self._forgotten = set()
+        self._reset()
+    
+    def _reset(self):
+        self._postings = []  # (account, Transaction), None once dropped
+        self._dead = 0
+        self._counts = {}  # account -> hot entries indexed
+        self._by_account = {}
+        self._by_counterparty = {}
+        self._by_op = {}
+        self._by_amount = []  # (cents, posting id), sorted
+        self._by_time = []  # (timestamp, posting id), sorted
+    
+    def touch(self, *nums):
+        """Note accounts whose history grew"""
+        if self.built:
+            with self._marks:
+                self._dirty.update(nums)
+    
+    def _changing(self, nums):
+        """Account lock watcher; changes to every account come through touch()"""
+        if nums is not None:
+            self.touch(*nums)
+    
+    def forget(self, num):
+        """Re-index num from scratch, e.g. after its history was archived or deleted"""
+        if self.built:
+            with self._marks:
+                self._forgotten.add(num)
+    
+    def close(self):
+        """Stop watching the account locks"""
+        if self._changing in self._locks.watchers:
+            self._locks.watchers.remove(self._changing)
+    
+    def _drop(self, num):
+        ids = self._by_account.pop(num, [])
+        for pid in ids:
+            self._postings[pid] = None
+        self._counts.pop(num, None)
+        self._dead += len(ids)
+    
+    def _add(self, num, history, bulk=False):
+        """Index num's new hot entries, or its archived and hot ones if it
+        isn't indexed yet"""
+        start = self._counts.get(num)
+        if start is not None and len(history) < start:
+            self._drop(num)
+            start = None
+        if start is None:
+            entries = history.page()
+            if self._archive is not None:
+                entries = list(self._archive.records(num, history)) + entries
+        else:
+            entries = history.page(start)
+        ids = self._by_account.setdefault(num, [])
+        for txn in entries:
+            pid = len(self._postings)
+            self._postings.append((num, txn))
+            ids.append(pid)
+            if txn.counterparty:
+                self._by_counterparty.setdefault(txn.counterparty, []).append(pid)
+            self._by_op.setdefault(txn.op, []).append(pid)
+            if bulk:
+                self._by_amount.append((txn.amount, pid))
+                self._by_time.append((txn.timestamp, pid))
+            else:
+                insort(self._by_amount, (txn.amount, pid))
+                insort(self._by_time, (txn.timestamp, pid))
+        self._counts[num] = len(history)
+    
+    def _catch_up(self, accounts):
+        if not self.built:
+            self._locks.watchers.append(self._changing)
+            self.built = True
+        with self._marks:
+            dirty, self._dirty = self._dirty, set()
+            forgotten, self._forgotten = self._forgotten, set()
+        if self._dead > len(self._postings) // 2 or not self._counts:
+            self._reset()
+            for num in list(accounts):
+                with self._locks.reading(num):
+                    acc = accounts.get(num)
+                    if acc is not None:
+                        self._add(num, acc.history, bulk=True)
+            self._by_amount.sort()
+            self._by_time.sort()
+            return
+        for num in forgotten:
+            self._drop(num)
+        for num in dirty | forgotten:
+            with self._locks.reading(num):
+                acc = accounts.get(num)
+                if acc is None:
+                    self._drop(num)
+                else:
+                    self._add(num, acc.history)
+    
+    @staticmethod
+    def _range(index, low, high):
+        """Posting ids whose key lies in [low, high]"""
+        lo = 0 if low is None else bisect_left(index, (low, -1))
+        hi = len(index) if high is None else bisect_right(index, (high, float('inf')))
+        return (pid for _, pid in index[lo:hi]), hi - lo
+    
+    def query(self, accounts, num=None, op=None, counterparty=None,
+              min_cents=None, max_cents=None, since=None, until=None):
+        """Generator of (account, Transaction) matching every given filter,
+        across the hot and archived history"""
+        with self._lock:
+            self._catch_up(accounts)
+            options = [(iter(range(len(self._postings))), len(self._postings))]
+            if num is not None:
+                ids = self._by_account.get(num, [])
+                options.append((iter(ids), len(ids)))
+            if counterparty is not None:
+                ids = self._by_counterparty.get(counterparty, [])
+                options.append((iter(ids), len(ids)))
+            if op is not None:
+                ids = self._by_op.get(op, [])
+                options.append((iter(ids), len(ids)))
+            if min_cents is not None or max_cents is not None:
+                options.append(self._range(self._by_amount, min_cents, max_cents))
+            if since is not None or until is not None:
+                options.append(self._range(self._by_time, since, until))
+            ids = sorted(min(options, key=lambda option: option[1])[0])
+            postings = self._postings
+        return self._matches(postings, ids, num, op, counterparty,
+                             min_cents, max_cents, since, until)
+    
+    @staticmethod
+    def _matches(postings, ids, num, op, counterparty, min_cents, max_cents, since, until):
+        for pid in ids:
+            posting = postings[pid]
+            if posting is None:
+                continue
+            acc, txn = posting
+            if ((num is None or acc == num)
+                    and (op is None or txn.op == op)
+                    and (counterparty is None or txn.counterparty == counterparty)
+                    and (min_cents is None or txn.amount >= min_cents)
+                    and (max_cents is None or txn.amount <= max_cents)
+                    and (since is None or txn.timestamp >= since)
+                    and (until is None or txn.timestamp <= until)):
+                yield posting
+
+class BankMetrics:
+    """Counters and latency histograms fed by BankManager hooks
+    
+    Register with BankManager(metrics=True) or bank.add_hook(BankMetrics()).
+    """
+    
+    LATENCY_BUCKETS_MS = (0.01, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, float('inf'))
+    SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26, 1 << 30, float('inf'))
+    COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, float('inf'))
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ops = {}
+        self.bytes_written = {}
+        self.history_lengths = [0] * len(self.COUNT_BUCKETS)
+    
+    @staticmethod
+    def _bucket(buckets, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                return i
+        return len(buckets) - 1
+    
+    def __call__(self, name, ms, info):
+        with self._lock:
+            op = self.ops.get(name)
+            if op is None:
+                op = self.ops[name] = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                       'buckets': [0] * len(self.LATENCY_BUCKETS_MS)}
+            op['count'] += 1
+            op['errors'] += not info.get('ok', True)
+            op['total_ms'] += ms
+            op['max_ms'] = max(op['max_ms'], ms)
+            op['buckets'][self._bucket(self.LATENCY_BUCKETS_MS, ms)] += 1
+            
+            if 'bytes' in info:
+                sizes = self.bytes_written.setdefault(
+                    name, {'total': 0, 'buckets': [0] * len(self.SIZE_BUCKETS)})
+                sizes['total'] += info['bytes']
+                sizes['buckets'][self._bucket(self.SIZE_BUCKETS, info['bytes'])] += 1
+            for length in info.get('history_lengths', ()):
+                self.history_lengths[self._bucket(self.COUNT_BUCKETS, length)] += 1
+    
+    def _percentile(self, op, pct):
+        """Upper bound of the bucket holding the pct-th percentile"""
+        target = op['count'] * pct / 100
+        seen = 0
+        for bound, count in zip(self.LATENCY_BUCKETS_MS, op['buckets']):
+            seen += count
+            if seen >= target:
+                return min(bound, op['max_ms'])
+        return op['max_ms']
+    
+    def snapshot(self):
+        """Plain-dict copy of everything collected so far"""
+        with self._lock:
+            ops = {}
+            for name, op in self.ops.items():
+                ops[name] = {
+                    'count': op['count'],
+                    'errors': op['errors'],
+                    'mean_ms': op['total_ms'] / op['count'],
+                    'p50_ms': self._percentile(op, 50),
+                    'p99_ms': self._percentile(op, 99),
+                    'max_ms': op['max_ms'],
+                    'latency_buckets_ms': dict(zip(map(str, self.LATENCY_BUCKETS_MS), op['buckets'])),
+                }
+            written = {name: {'total': w['total'],
+                              'buckets': dict(zip(map(str, self.SIZE_BUCKETS), w['buckets']))}
+                       for name, w in self.bytes_written.items()}
+            lengths = dict(zip(map(str, self.COUNT_BUCKETS), self.history_lengths))
+        return {'operations': ops, 'bytes_written': written, 'history_lengths': lengths}
+    
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+    
+    def to_text(self):
+        """Human-readable stats table"""
+        stats = self.snapshot()
+        lines = [f"{'operation':16}{'count':>8}{'errors':>8}{'mean ms':>10}"
+                 f"{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, op in sorted(stats['operations'].items()):
+            lines.append(f"{name:16}{op['count']:8}{op['errors']:8}{op['mean_ms']:10.3f}"
+                         f"{op['p50_ms']:10.3f}{op['p99_ms']:10.3f}{op['max_ms']:10.3f}")
+        for name, written in sorted(stats['bytes_written'].items()):
+            count = self.ops[name]['count']
+            lines.append(f"{name} wrote {written['total']} bytes ({written['total'] // count} per call)")
+        lengths = ", ".join(f"<={bound}: {n}" for bound, n in stats['history_lengths'].items() if n)
+        if lengths:
+            lines.append(f"history lengths at save: {lengths}")
+        return "\n".join(lines)
+
+BatchResult = namedtuple('BatchResult', 'row ok value error')
+
+def load_batch_file(path):
+    """Read batch instructions from a .csv (with header) or .jsonl file"""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            return [dict(row) for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+def _day_end_amounts(kinds, balances, phone, interest_ppm, fee_cents, expire):
+    """Interest, fees and expired phone credit for whole columns of accounts
+    
+    kinds holds 0 for Personal, 1 for Business and -1 for unused rows;
+    balances and phone are cents and are updated in place. Interest is
+    paid on positive Personal balances in parts per million, rounded down
+    to the cent, and a fee never takes a balance below zero. Every amount
+    is worked out before any column is written, so a run that would take
+    a balance past MAX_CENTS raises BadInputError and changes nothing.
+    Returns the three amount columns and the indexes of the rows that
+    changed.
+    """
+    if numpy is not None:
+        kind = numpy.frombuffer(kinds, dtype=numpy.int8)
+        bal = numpy.frombuffer(balances, dtype=numpy.int64)
+        ph = numpy.frombuffer(phone, dtype=numpy.int64)
+        paid = (kind == 0) & (bal > 0)
+        interest = numpy.zeros_like(bal)
+        if interest_ppm:
+            # bal * ppm only fits in int64 up to this balance; larger ones use Python ints
+            wide = paid & (bal > MAX_CENTS // interest_ppm)
+            narrow = paid & ~wide
+            interest[narrow] = bal[narrow] * interest_ppm // 1_000_000
+            for i in numpy.flatnonzero(wide).tolist():
+                cents = int(bal[i]) * interest_ppm // 1_000_000
+                if cents > MAX_CENTS - int(bal[i]):
+                    raise BadInputError("Amount is too large")
+                interest[i] = cents
+            if (interest[paid] > MAX_CENTS - bal[paid]).any():
+                raise BadInputError("Amount is too large")
+        bal += interest
+        fee = numpy.where(kind == 1, numpy.minimum(numpy.maximum(bal, 0), fee_cents), 0)
+        bal -= fee
+        expired = ph.copy() if expire else numpy.zeros_like(ph)
+        ph -= expired
+        changed = numpy.flatnonzero(interest | fee | expired)
+        return interest.tolist(), fee.tolist(), expired.tolist(), changed.tolist()
+    
+    count = len(balances)
+    interest, fee, expired = array('q', [0]) * count, array('q', [0]) * count, array('q', [0]) * count
+    if interest_ppm:
+        for i in range(count):
+            cents = balances[i]
+            if kinds[i] == 0 and cents > 0:
+                if cents * interest_ppm // 1_000_000 > MAX_CENTS - cents:
+                    raise BadInputError("Amount is too large")
+                interest[i] = cents * interest_ppm // 1_000_000
+    changed = []
+    for i in range(count):
+        cents = balances[i] + interest[i]
+        if kinds[i] == 1 and cents > 0 and fee_cents:
+            fee[i] = min(cents, fee_cents)
+            cents -= fee[i]
+        if expire and phone[i]:
+            expired[i] = phone[i]
+            phone[i] = 0
+        if interest[i] or fee[i] or expired[i]:
+            balances[i] = cents
+            changed.append(i)
+    return interest, fee, expired, changed
+
+class OperationRecorder:
+    """Appends every handle_choice call to a compact JSON-lines log
+    
+    Each line has the start time (seconds since recording began), the
+    option, its arguments with the password blanked, whether it worked and
+    how long it took; new accounts also keep their number, taken from the
+    command's journal record. close() adds
+    the final balance of every account the log touched, which replay_log
+    checks against.
+    """
+    
+    PASSWORD_CHOICES = ('2', '3', '4', '5', '6', '7', '8', '9')
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w')
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._touched = set()
+    
+    @staticmethod
+    def accounts_of(choice, args):
+        """Positions in args that hold account numbers"""
+        if choice == '1' or not args:
+            return ()
+        return (0, 2) if choice == '5' else (0,)
+    
+    def record(self, choice, args, ok, opened, start, end):
+        args = [str(arg) for arg in args]
+        if choice in self.PASSWORD_CHOICES and len(args) > 1:
+            args[1] = ""
+        entry = {'t': round(start - self._origin, 6), 'o': choice, 'a': args,
+                 'ok': ok, 'ms': round((end - start) * 1000, 3)}
+        touched = [args[i] for i in self.accounts_of(choice, args) if i < len(args)]
+        if choice == '1' and ok and opened is not None:
+            entry['n'] = opened
+            touched.append(opened)
+        line = json.dumps(entry, separators=(',', ':')) + "\n"
+        with self._lock:
+            self._touched.update(touched)
+            self._file.write(line)
+    
+    def close(self, accounts):
+        """Write the final balances (in cents, None once deleted) and close the log"""
+        with self._lock:
+            final = {num: accounts[num]._cents if num in accounts else None
+                     for num in sorted(self._touched)}
+            self._file.write(json.dumps({'final': final}, separators=(',', ':')) + "\n")
+            self._file.close()
+
+def replay_log(log_path, data_file, timing='fast', workers=1, password="replay"):
+    """Re-run a recorded log against a copy of data_file and report on it
+    
+    timing is 'fast' (back to back) or 'original' (keeping the recorded
+    gaps). With several worker threads, accounts linked by a transfer (or
+    by opening) share a lane, so every account's operations keep their
+    recorded order. The log holds no passwords, so every account in the
+    copy gets the same one.
+    """
+    if timing not in ('fast', 'original'):
+        raise BadInputError("Timing must be fast or original")
+    entries, final = [], {}
+    with open(log_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'final' in entry:
+                final = entry['final']
+            else:
+                entries.append(entry)
+    
+    groups = {}  # account -> an account it is linked to, leading to its group's root
+    
+    def root(num):
+        while groups.setdefault(num, num) != num:
+            groups[num] = groups[groups[num]]
+            num = groups[num]
+        return num
+    
+    keys = []
+    for entry in entries:
+        nums = [entry['a'][i] for i in OperationRecorder.accounts_of(entry['o'], entry['a'])
+                if i < len(entry['a'])]
+        if 'n' in entry:
+            nums.append(entry['n'])
+        nums = nums or [""]
+        for num in nums[1:]:
+            groups[root(num)] = root(nums[0])
+        keys.append(nums[0])
+    
+    lanes = [[] for _ in range(max(workers, 1))]
+    for entry, key in zip(entries, keys):
+        lanes[zlib.crc32(root(key).encode()) % len(lanes)].append(entry)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, os.path.basename(data_file))
+        shutil.copy(data_file, copy)
+        bank = BankManager(data_file=copy)
+        try:
+            stored = hash_password(password, bank.PASSWORD_ITERATIONS)
+            for num in list(bank.accounts):
+                bank.accounts[num].password = stored
+            numbers = {}  # recorded account number -> replayed one
+            latencies = []
+            mismatches = []
+            
+            def run(lane):
+                for entry in lane:
+                    if timing == 'original':
+                        delay = begin + entry['t'] - first - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    choice, args = entry['o'], list(entry['a'])
+                    for i in OperationRecorder.accounts_of(choice, args):
+                        if i < len(args):
+                            args[i] = numbers.get(args[i], args[i])
+                    if choice in OperationRecorder.PASSWORD_CHOICES and len(args) > 1:
+                        args[1] = password
+                    start = time.perf_counter()
+                    try:
+                        call = bank.commands.run(bank, choice, args)
+                        ok = True
+                    except (BankError, IndexError):  # IndexError: too few arguments
+                        ok = False
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    if ok != entry['ok']:
+                        mismatches.append(entry)
+                    if ok and call.opened is not None:
+                        bank.accounts[call.opened].password = stored
+                        if 'n' in entry:
+                            numbers[entry['n']] = call.opened
+            
+            first = entries[0]['t'] if entries else 0
+            begin = time.perf_counter()
+            threads = [threading.Thread(target=run, args=(lane,)) for lane in lanes]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - begin
+            
+            wrong = {}
+            for num, cents in final.items():
+                replayed = numbers.get(num, num)
+                got = bank.accounts[replayed]._cents if replayed in bank.accounts else None
+                if got != cents:
+                    wrong[num] = (cents, got)
+        finally:
+            bank.close()
+    
+    ordered = sorted(latencies)
+    
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+    
+    recorded = sorted(entry['ms'] for entry in entries)
+    return {
+        'operations': len(entries),
+        'seconds': elapsed,
+        'ops_per_sec': len(entries) / elapsed if elapsed else 0.0,
+        'p50_ms': pct(50), 'p95_ms': pct(95), 'p99_ms': pct(99), 'max_ms': pct(100),
+        'recorded_p50_ms': recorded[len(recorded) // 2] if recorded else 0.0,
+        'outcome_mismatches': len(mismatches),
+        'balance_mismatches': wrong,
+        'balances_match': not wrong,
+    }
+
+Field = namedtuple('Field', 'name label parse optional')
+Field.__new__.__defaults__ = (False,)
+
+def _parse_kind(text):
+    kind = str(text).strip().capitalize()
+    if kind not in CompactAccountStore.KINDS:
+        raise BadInputError("Must be Personal or Business")
+    return kind
+
+def _parse_count(text):
+    count = int(text)
+    if count < 0:
+        raise BadInputError("Please enter a number of 0 or more")
+    return count
+
+class Command:
+    """One menu option: where it is shown, its argument schema and its action
+    
+    Options on the account menu take the account number and password (or
+    session token) first, then one value per field. action(bank, *values)
+    for main-menu options, action(bank, acc, num, *values) for the others,
+    returns the message and the journal records to commit.
+    """
+    
+    __slots__ = ('choice', 'label', 'fields', 'action', 'menu', 'confirm')
+    
+    def __init__(self, choice, label, fields, action, menu='account', confirm=None):
+        self.choice = choice
+        self.label = label
+        self.fields = tuple(fields)
+        self.action = action
+        self.menu = menu
+        self.confirm = confirm
+    
+    @property
+    def login(self):
+        """Whether the option needs an account number and password"""
+        return self.choice != '1'
+    
+    def parse(self, args):
+        """Check and convert the values after number and password"""
+        values = []
+        for i, field in enumerate(self.fields):
+            if i >= len(args) or args[i] is None or args[i] == '':
+                if not field.optional:
+                    raise BadInputError(f"Missing {field.label.rstrip(':').lower()}")
+                values.append(None)
+            else:
+                values.append(field.parse(args[i]))
+        return values
+
+class CommandCall:
+    """One dispatch through a registry, as seen by middleware"""
+    
+    __slots__ = ('bank', 'choice', 'args', 'message', 'records', 'staged')
+    
+    def __init__(self, bank, choice, args, staged=None):
+        self.bank = bank
+        self.choice = choice
+        self.args = args
+        self.message = None
+        self.records = []
+        self.staged = staged  # list collecting staged records for an async caller
+    
+    @property
+    def opened(self):
+        """Number of the account this call opened, or None"""
+        for record in self.records:
+            if record[0] == 'new':
+                return record[1]
+        return None
+
+class CommandRegistry:
+    """Menu options by choice, plus middleware run around every call
+    
+    A middleware is called as middleware(call, proceed) with a CommandCall;
+    it must call proceed() to run the rest of the chain. The one added
+    last runs outermost.
+    """
+    
+    def __init__(self, commands=()):
+        self._commands = OrderedDict()
+        self.middleware = []
+        for command in commands:
+            self.register(command)
+    
+    def register(self, command):
+        self._commands[command.choice] = command
+        return command
+    
+    def get(self, choice):
+        return self._commands.get(choice)
+    
+    def __iter__(self):
+        return iter(self._commands.values())
+    
+    def copy(self):
+        """A registry with the same commands and its own middleware"""
+        registry = CommandRegistry(self)
+        registry.middleware = list(self.middleware)
+        return registry
+    
+    def use(self, middleware):
+        """Wrap every call in middleware"""
+        self.middleware.insert(0, middleware)
+    
+    def apply(self, bank, choice, args):
+        """Validate args and run a command in memory; return message and records"""
+        command = self._commands.get(choice)
+        if command is None:
+            return "Invalid option", []
+        try:
+            if not command.login:
+                return command.action(bank, *command.parse(args))
+            if len(args) < 2:
+                raise BadInputError("Missing account number or password")
+            num, pwd = args[0], args[1]
+            values = command.parse(args[2:])
+            return command.action(bank, bank.login(num, pwd), num, *values)
+        except ValueError:
+            raise BadInputError("Please enter numbers only")
+    
+    def dispatch(self, bank, choice, args, staged=None):
+        """Run a command through the middleware and return its message
+        
+        With a staged list, persisting only stages the records and adds
+        the (records, future) pairs to it; the caller makes them durable.
+        """
+        return self.run(bank, choice, args, staged).message
+    
+    def run(self, bank, choice, args, staged=None):
+        """Like dispatch, but return the whole CommandCall"""
+        call = CommandCall(bank, choice, args, staged)
+        chain = self.middleware
+        
+        def proceed(i=0):
+            if i < len(chain):
+                chain[i](call, lambda: proceed(i + 1))
+            else:
+                call.message, call.records = self.apply(bank, choice, args)
+        
+        proceed()
+        return call
+
+def persist_middleware(call, proceed):
+    """Commit the records a command produced, in the order it was applied"""
+    with call.bank.committing(call.staged) as commit:
+        proceed()
+        if call.records:
+            commit(*call.records)
+
+def timing_middleware(call, proceed):
+    """Report each option's duration to the bank's hooks"""
+    start = time.perf_counter()
+    ok = False
+    try:
+        proceed()
+        ok = True
+    finally:
+        call.bank._emit(f"option_{call.choice}", start, ok=ok)
+
+def recording_middleware(call, proceed):
+    """Append each call to the bank's operation log"""
+    start = time.perf_counter()
+    ok = False
+    try:
+        proceed()
+        ok = True
+    finally:
+        call.bank.recorder.record(call.choice, call.args, ok, call.opened,
+                                  start, time.perf_counter())
+
+def _new_account(bank, acc_type):
+    num, pwd, record = bank._open_account(acc_type)
+    return f"New {acc_type} account:\nNumber: {num}\nPassword: {pwd}", [record]
+
+def _welcome(bank, acc, num):
+    return f"Welcome {acc.type} account {num}", []
+
+def _deposit(bank, acc, num, amount):
+    acc.add_money(amount)
+    message = f"Added {_format_money(amount)}. New balance: {_format_cents(acc._cents)}"
+    return message, [('add', num, amount)]
+
+def _withdraw(bank, acc, num, amount):
+    acc.take_money(amount)
+    message = f"Withdrew {_format_money(amount)}. New balance: {_format_cents(acc._cents)}"
+    return message, [('take', num, amount)]
+
+def _transfer(bank, acc, num, to_num, amount):
+    with bank.locks.holding(num, to_num):
+        if to_num not in bank.accounts:
+            raise NoAccountError("Receiver account not found")
+        acc.send_money(amount, bank.accounts[to_num])
+    return f"Sent {_format_money(amount)} to {to_num}", [('send', num, to_num, amount)]
+
+def _balance(bank, acc, num):
+    return (f"Balance: {_format_cents(acc._cents)}\n"
+            f"Phone credit: {_format_cents(acc._phone_cents)}"), []
+
+def _delete(bank, acc, num):
+    return f"Account {num} deleted", [bank._delete_account(num)]
+
+def _phone_topup(bank, acc, num, amount):
+    acc.add_phone_credit(amount)
+    message = (f"Added {_format_money(amount)} phone credit. "
+               f"New balance: {_format_cents(acc._phone_cents)}")
+    return message, [('phone', num, amount)]
+
+def _history(bank, acc, num, offset, limit):
+    if offset or limit is not None:
+        text = "\n".join(bank.history_page(num, offset or 0, limit))
+    else:
+        text = bank.statement(num).text
+        archived = bank.archive.count(num, acc.history)
+        if archived:
+            text = f"({archived} older entries archived; ask for a page to see them)\n" + text
+    return (text or "No transactions"), []
+
+def _parse_number(text):
+    return str(text).strip()
+
+_AMOUNT = Field('amount', "Amount:", _parse_amount)
+
+COMMANDS = CommandRegistry([
+    Command('1', "New Account", [Field('acc_type', "Account type:", _parse_kind)], _new_account, menu='main'),
+    Command('2', "Login", [], _welcome, menu='main'),
+    Command('3', "Deposit", [_AMOUNT], _deposit),
+    Command('4', "Withdraw", [_AMOUNT], _withdraw),
+    Command('5', "Transfer", [Field('to_num', "To Account:", _parse_number), _AMOUNT], _transfer),
+    Command('6', "View Balance", [], _balance),
+    Command('7', "Delete Account", [], _delete, confirm="Delete account?"),
+    Command('8', "Phone Top-up", [_AMOUNT], _phone_topup),
+    Command('9', "History", [Field('offset', "From entry:", _parse_count, True),
+                             Field('limit', "Entries:", _parse_count, True)], _history),
+])
+
+class GroupCommitter:
+    """Collects commit requests from many threads and flushes them together"""
+    
+    def __init__(self, flush, max_batch=64, max_delay_ms=5):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._closed = False
+        self._started = time.monotonic()
+        self.counters = {
+            'submitted': 0,    # commit requests received
+            'durable': 0,      # requests acknowledged after a flush
+            'failed': 0,       # requests whose flush raised
+            'records': 0,      # operation records written
+            'flushes': 0,      # flush calls, i.e. fsyncs or snapshot writes
+            'largest_batch': 0,
+            'flush_seconds': 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, records):
+        """Queue records and return a Future that resolves once durable"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise BankError("Commit queue is closed")
+            self._pending.append((records, future))
+            self.counters['submitted'] += 1
+            self._cond.notify()
+        return future
+    
+    def _run(self):
+        """Flusher loop: wait for a full batch or the delay, then flush once"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.max_delay
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            
+            records = [rec for recs, _ in batch for rec in recs]
+            start = time.monotonic()
+            try:
+                self._flush(records)
+            except Exception as e:
+                self.counters['failed'] += len(batch)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.counters['flush_seconds'] += time.monotonic() - start
+            
+            self.counters['flushes'] += 1
+            self.counters['records'] += len(records)
+            self.counters['durable'] += len(batch)
+            self.counters['largest_batch'] = max(self.counters['largest_batch'], len(batch))
+            for _, future in batch:
+                future.set_result(len(batch))
+    
+    def stats(self):
+        """Durability and throughput counters"""
+        stats = dict(self.counters)
+        elapsed = time.monotonic() - self._started
+        with self._cond:
+            stats['pending'] = len(self._pending)
+        stats['avg_batch'] = stats['durable'] / stats['flushes'] if stats['flushes'] else 0.0
+        stats['ops_per_sec'] = stats['durable'] / elapsed if elapsed else 0.0
+        return stats
+    
+    def close(self):
+        """Flush whatever is queued and stop the flusher thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+class BankManager:
+    """Handles all bank operations and data storage"""
+    
+    DATA_FILE = "bank_data.txt"
+    BINARY_FILE = "bank_data.bin"  # used with binary=True
+    SQLITE_FILE = "bank_data.db"  # used by --sqlite
+    JOURNAL_SUFFIX = ".journal"
+    COMPACT_THRESHOLD = 1024 * 1024  # journal bytes before folding into a snapshot
+    JOURNAL_FSYNC = True
+    GROUP_MAX_BATCH = 64
+    GROUP_MAX_DELAY_MS = 5
+    ACCOUNT_NUMBER_RANGE = (10000, 99999)
+    PASSWORD_ITERATIONS = 100_000
+    SESSION_TTL = 15 * 60  # seconds a session token stays valid
+    AUTH_CACHE_TTL = 5 * 60  # seconds a verified password skips hashing
+    AUTH_CACHE_SIZE = 10000
+    LOGIN_MAX_FAILURES = 5
+    LOGIN_WINDOW = 60
+    LOGIN_LOCKOUT = 300
+    STATEMENT_CACHE_BYTES = 16 * 1024 * 1024
+    ARCHIVE_SUFFIX = ".archive"  # directory of compressed old history
+    ARCHIVE_CODEC = "zlib"
+    HISTORY_KEEP = 1000  # entries kept in the hot file by archive_history
+    
+    def __init__(self, journal=False, group_commit=False,
+                 max_batch=None, max_delay_ms=None, lazy=False, columnar=False,
+                 metrics=False, hooks=(), binary=False, backend=None, record=None,
+                 data_file=None):
+        if data_file is not None:
+            self.DATA_FILE = data_file  # this bank only; others keep the class default
+        if lazy and columnar:
+            raise BankError("Lazy loading and columnar storage can't be combined")
+        if binary and (lazy or columnar or journal):
+            raise BankError("Binary storage can't be combined with other storage modes")
+        if backend is not None and (lazy or journal or binary):
+            raise BankError("A storage backend can't be combined with lazy, journal or binary modes")
+        self.locks = LockTable()  # this bank's accounts; watchers see only its writes
+        self.accounts = CompactAccountStore(self.locks) if columnar else AccountDict(self.locks)
+        self.binary = binary
+        self.backend = backend
+        self._stored_history = {}  # account -> history entries the backend has
+        self._pending = {}  # transfer id -> (kind, account, cents, other account)
+        self.hooks = list(hooks)
+        self.metrics = BankMetrics() if metrics else None
+        if self.metrics is not None:
+            self.hooks.append(self.metrics)
+        self.recorder = OperationRecorder(record) if record else None
+        self._deferred = None  # records held by deferred()
+        self.commands = COMMANDS.copy()
+        self.commands.use(persist_middleware)
+        if self.recorder is not None:
+            self.commands.use(recording_middleware)
+        if self.hooks:
+            self.commands.use(timing_middleware)
+        self.journal = journal
+        self.lazy = lazy
+        self._source = None
+        self._lock = threading.RLock()
+        self._journal_lock = threading.Lock()  # journal file, _seq and byte counts
+        self._seq = 0
+        self._journal_file = None
+        self._journal_bytes = 0
+        self._unflushed = 0  # journal bytes written but not yet flushed
+        self._compactor = None
+        self._committer = None
+        self._numbers = None
+        self._auth_key = secrets.token_bytes(32)
+        self._sessions = TTLCache(self.SESSION_TTL)
+        self._verified = TTLCache(self.AUTH_CACHE_TTL, self.AUTH_CACHE_SIZE)
+        self._attempts = LoginRateLimiter(
+            self.LOGIN_MAX_FAILURES, self.LOGIN_WINDOW, self.LOGIN_LOCKOUT)
+        self._statements = StatementCache(self.STATEMENT_CACHE_BYTES)
+        self.archive = HistoryArchive(self.DATA_FILE + self.ARCHIVE_SUFFIX, self.ARCHIVE_CODEC)
+        self._ledger = LedgerIndex(self.locks, self.archive)
+        self.load_data()
+        if journal:
+            self._open_journal()
+        if group_commit:
+            self._committer = GroupCommitter(
+                self._write_journal if journal else self._persist,
+                max_batch or self.GROUP_MAX_BATCH,
+                self.GROUP_MAX_DELAY_MS if max_delay_ms is None else max_delay_ms)
+    
+    def add_hook(self, hook):
+        """Call hook(name, ms, info) after each timed operation"""
+        if not self.hooks:
+            self.commands.use(timing_middleware)
+        self.hooks.append(hook)
+    
+    def _emit(self, name, start, **info):
+        """Report an operation that began at perf_counter() value start"""
+        ms = (time.perf_counter() - start) * 1000
+        for hook in self.hooks:
+            hook(name, ms, info)
+    
+    def stats(self, fmt='text'):
+        """Metrics dump as text or JSON"""
+        if self.metrics is None:
+            return "Metrics are off" if fmt == 'text' else "{}"
+        return self.metrics.to_json() if fmt == 'json' else self.metrics.to_text()
+    
+    @property
+    def journal_path(self):
+        """Path of the append-only operation log"""
+        return self.DATA_FILE + self.JOURNAL_SUFFIX
+    
+    def load_data(self):
+        """Load accounts from file, then replay any journaled operations"""
+        start = time.perf_counter()
+        if self.backend is not None:
+            for acc in self.backend.load_accounts():
+                self.accounts[acc.number] = acc
+                self._stored_history[acc.number] = len(acc.history)
+        elif self.binary:
+            if not os.path.exists(self.BINARY_FILE) and os.path.exists(self.DATA_FILE):
+                convert_text_to_binary(self.DATA_FILE, self.BINARY_FILE)
+            self.accounts = MappedAccountStore(self.BINARY_FILE, locks=self.locks)
+        elif self.lazy:
+            self._load_index()
+        elif os.path.exists(self.DATA_FILE):
+            with open(self.DATA_FILE, 'r') as f:
+                for line in f:
+                    if line.startswith('#seq '):
+                        self._seq = int(line.split()[1])
+                    elif line.startswith('#pending '):
+                        self._load_pending(line)
+                    elif line.count('|') >= 4:
+                        acc = self._parse_line(line)
+                        self.accounts[acc.number] = acc
+        
+        replayed = 0
+        for path in (self.journal_path + ".old", self.journal_path):
+            if os.path.exists(path):
+                replayed += self._replay(path)
+        
+        if self.hooks:
+            self._emit('load_data', start, accounts=len(self.accounts), replayed=replayed)
+        
+        if replayed and not self.journal:
+            # Fold leftover journal into a plain data file
+            self.save_data()
+            self._remove_journals()
+    
+    def _load_index(self):
+        """Index account fields and history offsets without parsing history"""
+        if not os.path.exists(self.DATA_FILE):
+            return
+        source = _HistorySource(self.DATA_FILE)
+        offset = 0
+        with open(self.DATA_FILE, 'rb') as f:
+            for raw in f:
+                if raw.startswith(b'#seq '):
+                    self._seq = int(raw.split()[1])
+                elif raw.startswith(b'#pending '):
+                    self._load_pending(raw.decode())
+                elif raw.count(b'|') >= 4:
+                    line = raw.rstrip(b'\r\n')
+                    cut = line.rfind(b'|') if line.count(b'|') >= 5 else len(line)
+                    num, pwd, kind, money, phone = line[:cut].decode().split('|')[:5]
+                    acc = self._make_account(num, pwd, kind, money, phone)
+                    acc._history = None
+                    acc._lazy_history = (source, offset + cut + 1, max(len(line) - cut - 1, 0))
+                    self.accounts[num] = acc
+                offset += len(raw)
+        self._source = source
+    
+    def _load_pending(self, line):
+        """Restore a half-finished cross-shard transfer from a snapshot line"""
+        _, txid, kind, num, cents, other = line.split()
+        self._pending[txid] = (kind, num, int(cents), other)
+    
+    @staticmethod
+    def _make_account(num, pwd, kind, money, phone):
+        """Create the right account class for a stored record"""
+        if kind == "Personal":
+            acc = PersonalAccount(num, pwd, money)
+        else:
+            acc = BusinessAccount(num, pwd, money)
+        acc._phone_cents = _to_cents(phone)
+        return acc
+    
+    @classmethod
+    def _parse_line(cls, line):
+        """Build an account from one '|' separated data line"""
+        parts = line.strip().split('|')
+        acc = cls._make_account(*parts[:5])
+        if len(parts) > 5 and parts[5]:
+            acc.history = History.from_field(parts[5])
+        return acc
+    
+    def _record_line(self, acc):
+        """Format one account as a data file line"""
+        if acc.history_loaded:
+            history = acc.history.encode()
+        else:
+            source, offset, length = acc._lazy_history
+            history = source.read(offset, length)
+        return self._format_line(acc, history)
+    
+    @staticmethod
+    def _format_line(acc, history):
+        return (f"{acc.number}|{acc.password}|{acc.type}|{_format_cents(acc._cents)}|"
+                f"{_format_cents(acc._phone_cents)}|{history}\n")
+    
+    def _render_snapshot(self):
+        """Snapshot lines paired with the account each one stores"""
+        rows = []
+        with self.locks.reading_all():
+            # No transfer is half-applied while every account is locked
+            rows.extend((None, f"#pending {txid} {' '.join(map(str, entry))}\n")
+                        for txid, entry in self._pending.items())
+            rows.extend((acc, self._record_line(acc)) for acc in list(self.accounts.values()))
+        return rows
+    
+    def save_data(self):
+        """Save accounts to file"""
+        if self.journal:
+            self.compact(background=False)
+            return
+        if self.binary:
+            # Changes were made in place; only flushing is left
+            with self._lock:
+                self.accounts.flush()
+            return
+        if self.backend is not None:
+            with self._lock, self.backend.transaction():
+                for num in list(self.accounts):
+                    self._store_account(num)
+            return
+        with self._lock:
+            if not self.hooks:
+                self._write_snapshot(self._render_snapshot())
+                return
+            start = time.perf_counter()
+            rows = self._render_snapshot()
+            rendered = time.perf_counter()
+            written = self._write_snapshot(rows)
+            self._emit('save_data', start, bytes=written,
+                       render_ms=(rendered - start) * 1000,
+                       write_ms=(time.perf_counter() - rendered) * 1000,
+                       history_lengths=[len(acc.history) for acc, _ in rows
+                                        if acc is not None and acc.history_loaded])
+    
+    def commit(self, *records):
+        """Persist operations, either as journal records or a full save
+        
+        Operations on accounts that other threads may be changing should
+        commit inside committing() instead, to keep their journal order.
+        """
+        with self.committing() as commit:
+            commit(*records)
+    
+    @contextmanager
+    def committing(self, staged=None):
+        """Apply operations in the block and commit them in the order applied
+        
+        Yields a function taking journal records. Account locks taken in
+        the block are kept until it ends, so records for one account reach
+        the journal in the order the changes were made. They are durable
+        once the block has exited, or at the end of deferred(). Given a
+        staged list, the (records, future) pairs go there instead, for the
+        caller to pass to _finish().
+        """
+        pairs = [] if staged is None else staged
+        
+        def commit(*records):
+            pairs.append((records, self._stage(records)))
+        
+        try:
+            with self.locks.pinned():
+                yield commit
+        finally:
+            if staged is None:
+                self._finish_or_defer(pairs)
+    
+    def _finish_or_defer(self, staged):
+        with self._lock:
+            if self._deferred is not None:
+                self._deferred.extend(staged)
+                staged = []
+        self._finish(staged)
+    
+    def _stage(self, records):
+        """Give records their place in the journal, or queue them for a save
+        
+        Called with the records' accounts still locked. Journal records get
+        their sequence numbers and are written without waiting for the
+        disk. Returns a Future from the group committer, or None.
+        """
+        if not self.journal:
+            return self._committer.submit(records) if self._committer is not None else None
+        with self._journal_lock:
+            lines = []
+            for rec in records:
+                self._seq += 1
+                lines.append('|'.join([str(self._seq)] + [str(f) for f in rec]) + '\n')
+            data = ''.join(lines)
+            if self._committer is not None:
+                return self._committer.submit([data])
+            self._journal_file.write(data)
+            self._journal_bytes += len(data)
+            self._unflushed += len(data)
+        return None
+    
+    def _finish(self, staged):
+        """Wait until staged (records, future) pairs are durable
+        
+        Called once their account locks are released, since a save or
+        compaction may need every account.
+        """
+        if not staged:
+            return
+        futures = [future for _, future in staged if future is not None]
+        for future in futures:
+            future.result()
+        if not futures:
+            if self.journal:
+                self._write_journal([])
+            else:
+                self._persist([rec for records, _ in staged for rec in records])
+        self._after_durable(staged)
+    
+    def _after_durable(self, staged):
+        """Work that has to wait until staged records are durable"""
+        for records, _ in staged:
+            for rec in records:
+                if rec[0] == 'del' and rec[1] not in self.accounts:
+                    self._drop_deleted(rec[1])
+        if self._compaction_due():
+            self.compact()
+    
+    def _compaction_due(self):
+        return self.journal and self._journal_bytes >= self.COMPACT_THRESHOLD
+    
+    def commit_stats(self):
+        """Group commit counters, or None when group commit is off"""
+        return self._committer.stats() if self._committer is not None else None
+    
+    def _persist(self, records):
+        """Store the accounts records touched, or rewrite the data file"""
+        if self.backend is not None:
+            self._persist_backend(records)
+        else:
+            self.save_data()
+    
+    def _write_journal(self, chunks):
+        """Append staged journal text and flush everything written so far"""
+        with self._journal_lock:
+            start = time.perf_counter()
+            data = ''.join(chunks)
+            self._journal_file.write(data)
+            self._journal_bytes += len(data)
+            written, self._unflushed = self._unflushed + len(data), 0
+            if not written:
+                return  # another thread's flush already covered ours
+            self._journal_file.flush()
+            if self.JOURNAL_FSYNC:
+                os.fsync(self._journal_file.fileno())
+        if self.hooks:
+            self._emit('journal_append', start, bytes=written)
+    
+    def _persist_backend(self, records):
+        """Store just the accounts the records touched, in one transaction"""
+        with self._lock:
+            start = time.perf_counter()
+            with self.backend.transaction():
+                for rec in records:
+                    if rec[0] == 'del':
+                        self.backend.delete_account(rec[1])
+                        self._stored_history.pop(rec[1], None)
+                    else:
+                        self._store_account(rec[1])
+                        if rec[0] == 'send':
+                            self._store_account(rec[2])
+            if self.hooks:
+                self._emit('backend_commit', start, records=len(records))
+    
+    def _store_account(self, num):
+        """Upsert an account and append the history the backend lacks"""
+        acc = self.accounts.get(num)
+        if acc is None:
+            return
+        with self.locks.holding(num):
+            self.backend.upsert_account(acc)
+            stored = self._stored_history.get(num, 0)
+            new = acc.history.page(stored)
+            if new:
+                self.backend.append_transactions(num, new)
+            self._stored_history[num] = stored + len(new)
+    
+    def _replay(self, path):
+        """Apply journal records newer than the loaded snapshot"""
+        with open(path, 'r') as f:
+            data = f.read()
+        
+        # A torn write at the tail was never acknowledged, so drop it
+        good = data[:data.rfind('\n') + 1]
+        if len(good) != len(data):
+            with open(path, 'r+') as f:
+                f.truncate(len(good))
+        
+        count = 0
+        for line in good.splitlines():
+            parts = line.split('|')
+            seq = int(parts[0])
+            if seq <= self._seq:
+                continue
+            self._apply_record(parts[1], parts[2:])
+            self._seq = seq
+            count += 1
+        return count
     
-    def add_phone_credit(self, amount):
-        """Top up mobile balance"""
-        self.take_money(amount)
-        self.phone_credit += amount
-        self.history.append(f"Phone +{amount}")
-
-class PersonalAccount(Account):
-    """Account for individual customers"""
-    def __init__(self, num, pwd, money=0):
-        super().__init__(num, pwd, "Personal", money)
-
-class BusinessAccount(Account):
-    """Account for business customers"""
-    def __init__(self, num, pwd, money=0):
-        super().__init__(num, pwd, "Business", money)
-
-class BankManager:
-    """Handles all bank operations and data storage"""
+    def _apply_record(self, op, fields):
+        """Re-run one journaled operation against the in-memory accounts"""
+        if op == 'new':
+            num, pwd, kind = fields
+            if kind == "Personal":
+                self.accounts[num] = PersonalAccount(num, pwd)
+            else:
+                self.accounts[num] = BusinessAccount(num, pwd)
+        elif op == 'del':
+            self.accounts.pop(fields[0], None)
+            self._drop_deleted(fields[0])
+        elif op == 'add':
+            self.accounts[fields[0]].add_money(fields[1])
+        elif op == 'take':
+            self.accounts[fields[0]].take_money(fields[1])
+        elif op == 'send':
+            self.accounts[fields[0]].send_money(fields[2], self.accounts[fields[1]])
+        elif op == 'phone':
+            self.accounts[fields[0]].add_phone_credit(fields[1])
+        elif op in ('hold', 'expect'):
+            self._prepare(op, fields[0], fields[1], int(fields[2]), fields[3])
+        elif op == 'settle':
+            self._settle(fields[0])
+        elif op == 'cancel':
+            self._cancel(fields[0])
+        elif op == 'eod':
+            self._end_of_day(*map(int, fields))
+        else:
+            raise BankError(f"Unknown journal record: {op}")
     
-    DATA_FILE = "bank_data.txt"
+    def _open_journal(self):
+        """Open the journal for appending"""
+        self._journal_file = open(self.journal_path, 'a')
+        self._journal_bytes = self._journal_file.tell()
     
-    def __init__(self):
-        self.accounts = {}
-        self.load_data()
+    def _remove_journals(self):
+        """Delete journal files once a snapshot covers them"""
+        for path in (self.journal_path, self.journal_path + ".old"):
+            if os.path.exists(path):
+                os.remove(path)
     
-    def load_data(self):
-        """Load accounts from file"""
-        if os.path.exists(self.DATA_FILE):
-            with open(self.DATA_FILE, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        parts = line.strip().split('|')
-                        num = parts[0]
-                        pwd = parts[1]
-                        kind = parts[2]
-                        money = float(parts[3])
-                        phone = float(parts[4])
-                        
-                        if kind == "Personal":
-                            acc = PersonalAccount(num, pwd, money)
-                        else:
-                            acc = BusinessAccount(num, pwd, money)
-                        
-                        acc.phone_credit = phone
-                        if len(parts) > 5:
-                            acc.history = parts[5].split(';')
-                        
-                        self.accounts[num] = acc
+    def compact(self, background=True):
+        """Fold the journal into a fresh snapshot of the data file"""
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                if background:
+                    return
+                self._compactor.join()
+            
+            old = self.journal_path + ".old"
+            with self.locks.reading_all():
+                # Every applied operation has its seq once writers are out;
+                # the snapshot only waits for them, rendering happens later
+                snapshot = _RecordSnapshot(self)
+                head = [f"#seq {self._seq}\n"]
+                head.extend(f"#pending {txid} {' '.join(map(str, entry))}\n"
+                            for txid, entry in self._pending.items())
+                
+                # Rotate the live journal so records after the snapshot go to a new one
+                with self._journal_lock:
+                    if self._unflushed:
+                        self._journal_file.flush()
+                        os.fsync(self._journal_file.fileno())
+                        self._unflushed = 0
+                    self._journal_file.close()
+                    if os.path.exists(old):
+                        with open(self.journal_path, 'r') as src, open(old, 'a') as dst:
+                            dst.write(src.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, old)
+                    self._open_journal()
+            
+            self._compactor = threading.Thread(
+                target=self._write_compacted, args=(snapshot, head, old), daemon=True)
+            self._compactor.start()
+            if not background:
+                self._compactor.join()
     
-    def save_data(self):
-        """Save accounts to file"""
-        with open(self.DATA_FILE, 'w') as f:
-            for acc in self.accounts.values():
-                history = ';'.join(acc.history)
-                f.write(f"{acc.number}|{acc.password}|{acc.type}|{acc.balance}|{acc.phone_credit}|{history}\n")
+    def _write_compacted(self, snapshot, head, old_journal):
+        """Render a compaction snapshot and write it; runs on the compactor thread"""
+        rows = [(None, line) for line in head]
+        with snapshot:
+            for acc, lazy, line in snapshot:
+                if lazy is None:
+                    rows.append((None, line))
+                else:
+                    source, offset, length = lazy
+                    rows.append((acc, line[:-1] + source.read(offset, length) + "\n"))
+        return self._write_snapshot(rows, old_journal)
     
-    def make_account(self, acc_type):
-        """Create new account"""
-        num = str(random.randint(10000, 99999))
-        while num in self.accounts:
-            num = str(random.randint(10000, 99999))
+    def _write_snapshot(self, rows, old_journal=None):
+        """Write snapshot lines to a temp file, swap it in, return its size"""
+        start = time.perf_counter()
+        tmp = self.DATA_FILE + ".tmp"
+        relocate = []
+        with open(tmp, 'wb') as f:
+            offset = 0
+            for acc, line in rows:
+                data = line.encode()
+                f.write(data)
+                if acc is not None and not acc.history_loaded:
+                    cut = data.rfind(b'|') + 1
+                    relocate.append((acc, offset + cut, len(data) - cut - 1))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.DATA_FILE)
+        _fsync_dir(self.DATA_FILE)
+        if old_journal is not None:
+            os.remove(old_journal)
         
-        pwd = str(random.randint(1000, 9999))
+        if self.lazy:
+            # Point still-unread histories at the new file so the old one can go
+            source = _HistorySource(self.DATA_FILE)
+            for acc, offset, length in relocate:
+                if not acc.history_loaded:
+                    acc._lazy_history = (source, offset, length)
+            self._source = source
+        
+        if old_journal is not None and self.hooks:
+            self._emit('compact', start, bytes=offset)
+        return offset
+    
+    def close(self):
+        """Finish background work and release the journal"""
+        self._ledger.close()
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
+        if self.recorder is not None:
+            self.recorder.close(self.accounts)
+            self.recorder = None
+        with self._lock:
+            if self._compactor is not None:
+                self._compactor.join()
+            if self._source is not None:
+                self._source.close()
+                self._source = None
+            if self._journal_file is not None:
+                with self._journal_lock:
+                    self._journal_file.close()
+                    self._journal_file = None
+            if self.binary:
+                self.accounts.close()
+            if self.backend is not None:
+                self.backend.close()
+    
+    @property
+    def allocator(self):
+        """Account number allocator, seeded with the numbers already in use"""
+        if self._numbers is not None:
+            return self._numbers
+        with self._lock:
+            if self._numbers is None:
+                allocator = AccountNumberAllocator(*self.ACCOUNT_NUMBER_RANGE)
+                for num in self.accounts:
+                    if str(num).isdigit():
+                        allocator.reserve(num)
+                self._numbers = allocator
+        return self._numbers
+    
+    def new_account_number(self):
+        """Draw an account number nobody holds"""
+        num = str(self.allocator.allocate())
+        while num in self.accounts:  # added behind the allocator's back
+            num = str(self.allocator.allocate())
+        return num
+    
+    def make_account(self, acc_type, num=None):
+        """Create new account, under num if given"""
+        with self.committing() as commit:
+            num, pwd, record = self._open_account(acc_type, num)
+            commit(record)
+        return num, pwd
+    
+    def _open_account(self, acc_type, num=None):
+        """Create an account in memory and return its journal record"""
+        if num is None:
+            num = self.new_account_number()
+        elif num in self.accounts:
+            raise BadInputError(f"Account {num} already exists")
+        elif self._numbers is not None and str(num).isdigit():
+            self._numbers.reserve(num)
+        (pwd, stored), = self._new_credentials(1)
         
         if acc_type == "Personal":
-            acc = PersonalAccount(num, pwd)
+            acc = PersonalAccount(num, stored)
         else:
-            acc = BusinessAccount(num, pwd)
+            acc = BusinessAccount(num, stored)
         
-        self.accounts[num] = acc
-        self.save_data()
-        return num, pwd
+        self.archive.remove(num)  # one a crash kept from an earlier owner
+        with self.locks.holding(num):
+            self.accounts[num] = acc
+        return num, pwd, ('new', num, stored, acc.type)
+    
+    def _new_credentials(self, count):
+        """Random passwords paired with their hashes"""
+        pwds = [str(random.randint(1000, 9999)) for _ in range(count)]
+        if count < 2:
+            hashes = [hash_password(pwd, self.PASSWORD_ITERATIONS) for pwd in pwds]
+        else:
+            # hashlib releases the GIL, so bulk opens hash in parallel
+            with ThreadPoolExecutor(max_workers=min(count, os.cpu_count() or 1)) as pool:
+                hashes = list(pool.map(hash_password, pwds, [self.PASSWORD_ITERATIONS] * count))
+        return list(zip(pwds, hashes))
     
     def login(self, num, pwd):
-        """Authenticate user"""
+        """Authenticate user with a password or a session token
+        
+        A full hash check runs once; after that the same password is
+        accepted from a short-lived cache, and session tokens from
+        open_session are a dictionary lookup.
+        """
+        self._attempts.check(num)
         if num not in self.accounts:
             raise NoAccountError("Account not found")
-        if self.accounts[num].password != pwd:
-            raise WrongPasswordError("Wrong password")
-        return self.accounts[num]
+        acc = self.accounts[num]
+        
+        if isinstance(pwd, str) and pwd.startswith(SESSION_PREFIX):
+            if self._sessions.get(pwd) != num:
+                self._attempts.failed(num)
+                raise WrongPasswordError("Session expired, please log in again")
+            return acc
+        
+        stored = acc.password
+        key = (num, hmac.new(self._auth_key, str(pwd).encode(), 'sha256').digest())
+        if self._verified.get(key) != stored:
+            if not verify_password(pwd, stored):
+                self._attempts.failed(num)
+                raise WrongPasswordError("Wrong password")
+            if not is_password_hash(stored):
+                # Legacy plaintext password; the hash is saved with the next snapshot
+                stored = acc.password = hash_password(pwd, self.PASSWORD_ITERATIONS)
+            self._verified.put(key, stored)
+        self._attempts.succeeded(num)
+        return acc
+    
+    def open_session(self, num, pwd):
+        """Log in once and return a token usable in place of the password"""
+        self.login(num, pwd)
+        token = SESSION_PREFIX + secrets.token_urlsafe(24)
+        self._sessions.put(token, num)
+        return token
+    
+    def close_session(self, token):
+        """End a session early"""
+        self._sessions.pop(token)
+    
+    BATCH_OPS = ('open', 'deposit', 'withdraw', 'transfer', 'phone')
+    
+    def run_batch(self, instructions, atomic=True, verify=True):
+        """Validate and apply many instructions, then persist once
+        
+        Each instruction is a dict with an 'op' of open, deposit, withdraw,
+        transfer or phone. Opens take a 'type' and an optional 'ref'; the
+        others take 'account', 'amount', 'password' (when verify is on) and
+        'to' for transfers. An account of '@ref' means the account opened
+        earlier in the same batch under that ref.
+        
+        With atomic=True one failing row rolls the whole batch back;
+        otherwise good rows are kept. Returns one BatchResult per row.
+        """
+        rows = [dict(row) for row in instructions]
+        results = [None] * len(rows)
+        plans = [None] * len(rows)
+        refs = set()
+        
+        for i, row in enumerate(rows):
+            try:
+                plans[i] = self._check_batch_row(row, refs, verify)
+            except BankError as e:
+                results[i] = BatchResult(i, False, None, str(e))
+        
+        if atomic and any(results):
+            return self._reject_batch(results, "Batch rejected")
+        
+        opens = sum(1 for plan in plans if plan and plan[0] == 'open')
+        try:
+            numbers = self.allocator.allocate_many(opens)
+        except AccountsExhaustedError as e:
+            if atomic:
+                return self._reject_batch(results, str(e))
+            numbers = []
+        
+        credentials = self._new_credentials(min(opens, len(numbers)))
+        undo = []
+        records = []
+        created = {}
+        touched = {num for plan in plans if plan and plan[0] != 'open'
+                   for num in plan[2:] if not num.startswith('@')}
+        with self.committing() as commit, self.locks.holding(*touched, *map(str, numbers)):
+            for i, plan in enumerate(plans):
+                if plan is None:
+                    continue
+                try:
+                    value = self._apply_batch_row(plan, numbers, credentials, created, undo, records)
+                    results[i] = BatchResult(i, True, value, None)
+                except BankError as e:
+                    results[i] = BatchResult(i, False, None, str(e))
+                    if atomic:
+                        self._undo_batch(undo)
+                        for num in numbers:
+                            self.allocator.release(num)
+                        return self._reject_batch(results, "Batch rolled back")
+            
+            for num in numbers:
+                self.allocator.release(num)
+            if records:
+                commit(*records)
+        return results
+    
+    def _check_batch_row(self, row, refs, verify):
+        """Validate one batch row and return the parsed plan"""
+        op = row.get('op')
+        if op not in self.BATCH_OPS:
+            raise BadInputError(f"Unknown batch op: {op}")
+        
+        if op == 'open':
+            kind = str(row.get('type', '')).capitalize()
+            if kind not in ("Personal", "Business"):
+                raise BadInputError("Must be Personal or Business")
+            if row.get('ref'):
+                refs.add(row['ref'])
+            return ('open', kind, row.get('ref'))
+        
+        try:
+            amount = _from_cents(_to_cents(row.get('amount')))
+        except (TypeError, ValueError):
+            raise BadInputError("Please enter numbers only")
+        if amount <= 0:
+            raise BadInputError("Amount must be positive")
+        
+        accounts = [str(row.get('account', ''))]
+        if op == 'transfer':
+            accounts.append(str(row.get('to', '')))
+        for num in accounts:
+            if num.startswith('@'):
+                if num[1:] not in refs:
+                    raise NoAccountError(f"Unknown batch ref {num}")
+            elif num not in self.accounts:
+                raise NoAccountError("Account not found")
+        
+        if verify and not accounts[0].startswith('@'):
+            self.login(accounts[0], row.get('password'))
+        return (op, amount, *accounts)
+    
+    def _apply_batch_row(self, plan, numbers, credentials, created, undo, records):
+        """Apply one validated row, noting how to undo it"""
+        op = plan[0]
+        if op == 'open':
+            if not numbers:
+                raise AccountsExhaustedError("No account numbers left")
+            kind, ref = plan[1], plan[2]
+            num = str(numbers.pop())
+            pwd, stored = credentials.pop()
+            acc = PersonalAccount(num, stored) if kind == "Personal" else BusinessAccount(num, stored)
+            self.archive.remove(num)  # one a crash kept from an earlier owner
+            self.accounts[num] = acc
+            if ref:
+                created[ref] = num
+            undo.append(('open', num))
+            records.append(('new', num, stored, kind))
+            return (num, pwd)
+        
+        amount = plan[1]
+        nums = []
+        for num in plan[2:]:
+            if num.startswith('@'):
+                if num[1:] not in created:
+                    raise NoAccountError(f"Batch ref {num} was not opened")
+                num = created[num[1:]]
+            if num not in self.accounts:
+                raise NoAccountError("Account not found")
+            nums.append(num)
+        accs = [self.accounts[num] for num in nums]
+        for num, acc in zip(nums, accs):
+            undo.append(('account', num, acc._cents, acc._phone_cents, len(acc.history)))
+        
+        acc = accs[0]
+        if op == 'deposit':
+            acc.add_money(amount)
+            records.append(('add', nums[0], amount))
+        elif op == 'withdraw':
+            acc.take_money(amount)
+            records.append(('take', nums[0], amount))
+        elif op == 'transfer':
+            acc.send_money(amount, accs[1])
+            records.append(('send', nums[0], nums[1], amount))
+        else:
+            acc.add_phone_credit(amount)
+            records.append(('phone', nums[0], amount))
+        return acc.balance
+    
+    def _undo_batch(self, undo):
+        """Restore every account touched by a failed atomic batch"""
+        for entry in reversed(undo):
+            if entry[0] == 'open':
+                del self.accounts[entry[1]]
+                self.allocator.release(entry[1])
+            else:
+                _, num, cents, phone, length = entry
+                acc = self.accounts[num]
+                acc._cents = cents
+                acc._phone_cents = phone
+                acc.history.truncate(length)
+                self._statements.discard(num)
+    
+    @staticmethod
+    def _reject_batch(results, reason):
+        """Fill in results for rows that were not applied"""
+        return [res if res is not None and not res.ok else BatchResult(i, False, None, reason)
+                for i, res in enumerate(results)]
+    
+    # Two-phase transfers between shards. The sending shard holds the money
+    # and the receiving shard notes the credit it expects; then both settle,
+    # or both cancel. Every step is journaled and repeating one is harmless.
+    
+    def prepare_debit(self, txid, num, pwd, amount, to_num):
+        """Take money out of num and hold it for transfer txid"""
+        self.login(num, pwd)
+        with self.committing() as commit:
+            record = self._prepare('hold', txid, num, _to_cents(amount), to_num)
+            if record:
+                commit(record)
+    
+    def prepare_credit(self, txid, num, cents, from_num):
+        """Check num can receive transfer txid and remember it"""
+        with self.committing() as commit:
+            record = self._prepare('expect', txid, num, cents, from_num)
+            if record:
+                commit(record)
+    
+    def settle(self, txid):
+        """Finish a prepared transfer on this shard"""
+        with self.committing() as commit:
+            record = self._settle(txid)
+            if record:
+                commit(record)
+    
+    def cancel(self, txid):
+        """Undo a prepared transfer on this shard"""
+        with self.committing() as commit:
+            record = self._cancel(txid)
+            if record:
+                commit(record)
+    
+    def pending(self):
+        """Prepared transfers that are neither settled nor cancelled"""
+        return dict(self._pending)
+    
+    def _prepare(self, op, txid, num, cents, other):
+        with self.locks.holding(num):
+            if txid in self._pending:
+                return None
+            if num not in self.accounts:
+                raise NoAccountError("Receiver account not found" if op == 'expect' else "Account not found")
+            if op == 'hold':
+                self.accounts[num]._take_cents(cents)
+            elif cents <= 0:
+                raise BadInputError("Amount must be positive")
+            self._pending[txid] = ('debit' if op == 'hold' else 'credit', num, cents, other)
+        return (op, txid, num, cents, other)
+    
+    def _settle(self, txid):
+        entry = self._pending.get(txid)
+        if entry is None:
+            return None
+        kind, num, cents, other = entry
+        with self.locks.holding(num):
+            if self._pending.get(txid) is not entry:
+                return None  # settled by another caller meanwhile
+            acc = self.accounts[num]
+            if kind == 'debit':
+                acc.history.record_cents(OP_SENT, cents, other)
+            else:
+                acc._add_cents(cents)
+                acc.history.record_cents(OP_GOT, cents, other)
+            del self._pending[txid]
+        return ('settle', txid)
+    
+    def _cancel(self, txid):
+        entry = self._pending.get(txid)
+        if entry is None:
+            return None
+        kind, num, cents, _ = entry
+        with self.locks.holding(num):
+            if self._pending.get(txid) is not entry:
+                return None
+            if kind == 'debit':
+                self.accounts[num]._add_cents(cents)  # give the held money back
+            del self._pending[txid]
+        return ('cancel', txid)
     
     def remove_account(self, num):
         """Delete account"""
-        if num in self.accounts:
+        with self.committing() as commit:
+            commit(self._delete_account(num))
+    
+    def _delete_account(self, num):
+        """Delete an account in memory and return its journal record"""
+        with self.locks.holding(num):
+            if num not in self.accounts:
+                raise NoAccountError("Account not found")
+            if any(entry[1] == num for entry in self._pending.values()):
+                raise BankError("Account has a transfer in progress")
             del self.accounts[num]
-            self.save_data()
-        else:
-            raise NoAccountError("Account not found")
+        self._sessions.discard_values(num)
+        self._attempts.forget(num)
+        self._statements.discard(num)
+        self._ledger.forget(num)
+        return ('del', num)  # the archive and number go once this is durable
     
-    def handle_choice(self, choice, *args):
-        """Process user menu selections"""
-        try:
-            if choice == '1':  # New account
-                acc_type = args[0]
-                num, pwd = self.make_account(acc_type)
-                return f"New {acc_type} account:\nNumber: {num}\nPassword: {pwd}"
-            
-            elif choice == '2':  # Login
-                num = args[0]
-                pwd = args[1]
-                acc = self.login(num, pwd)
-                return f"Welcome {acc.type} account {num}"
-            
-            elif choice == '3':  # Deposit
-                num = args[0]
-                pwd = args[1]
-                amount = float(args[2])
-                acc = self.login(num, pwd)
-                acc.add_money(amount)
-                self.save_data()
-                return f"Added {amount}. New balance: {acc.balance}"
-            
-            elif choice == '4':  # Withdraw
-                num = args[0]
-                pwd = args[1]
-                amount = float(args[2])
-                acc = self.login(num, pwd)
-                acc.take_money(amount)
-                self.save_data()
-                return f"Withdrew {amount}. New balance: {acc.balance}"
-            
-            elif choice == '5':  # Transfer
-                from_num = args[0]
-                pwd = args[1]
-                to_num = args[2]
-                amount = float(args[3])
-                
-                from_acc = self.login(from_num, pwd)
-                if to_num not in self.accounts:
-                    raise NoAccountError("Receiver account not found")
-                
-                to_acc = self.accounts[to_num]
-                from_acc.send_money(amount, to_acc)
-                self.save_data()
-                return f"Sent {amount} to {to_num}"
-            
-            elif choice == '6':  # Check balance
-                num = args[0]
-                pwd = args[1]
-                acc = self.login(num, pwd)
-                return f"Balance: {acc.balance}\nPhone credit: {acc.phone_credit}"
-            
-            elif choice == '7':  # Delete account
-                num = args[0]
-                pwd = args[1]
-                self.login(num, pwd)
-                self.remove_account(num)
-                return f"Account {num} deleted"
-            
-            elif choice == '8':  # Phone top-up
-                num = args[0]
-                pwd = args[1]
-                amount = float(args[2])
-                acc = self.login(num, pwd)
-                acc.add_phone_credit(amount)
+    def _drop_deleted(self, num):
+        """Remove a deleted account's archive and free its number"""
+        self.archive.remove(num)
+        if self._numbers is not None and str(num).isdigit():
+            self._numbers.release(num)
+    
+    def snapshot(self):
+        """Consistent point-in-time view of all accounts, taken in O(1)"""
+        return Snapshot(self)
+    
+    def report(self, top=10, workers=4):
+        """Balance totals, phone-credit liabilities and top balances from one
+        snapshot, scanned in parallel while writers carry on"""
+        
+        def summarize(part):
+            count = cents = phone = 0
+            best = []
+            for acc in part:
+                count += 1
+                cents += acc.cents
+                phone += acc.phone_cents
+                if len(best) < top:
+                    heapq.heappush(best, (acc.cents, acc.number))
+                elif acc.cents > best[0][0]:
+                    heapq.heapreplace(best, (acc.cents, acc.number))
+            return count, cents, phone, best
+        
+        with self.snapshot() as snap, ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(summarize, snap.parts(workers)))
+        best = heapq.nlargest(top, (entry for result in results for entry in result[3]))
+        return {
+            'accounts': sum(result[0] for result in results),
+            'total_balance': _from_cents(sum(result[1] for result in results)),
+            'phone_liabilities': _from_cents(sum(result[2] for result in results)),
+            'top_balances': [(num, _from_cents(cents)) for cents, num in best],
+        }
+    
+    def total_balance(self):
+        """Sum of every balance, added up in whole cents"""
+        if isinstance(self.accounts, CompactAccountStore):
+            return _from_cents(sum(self.accounts._balances))
+        return _from_cents(sum(acc._cents for acc in self.accounts.values()))
+    
+    def end_of_day(self, interest_rate=0, fee=0, expire_phone=False):
+        """Pay interest to Personal accounts, charge Business accounts a fee
+        and expire phone credit, then persist once
+        
+        interest_rate is a fraction of the balance (e.g. "0.0001"); fee is
+        in currency units. Returns the number of accounts that changed.
+        """
+        ppm = _parse_amount(interest_rate).scaleb(6)
+        if ppm < 0 or ppm != ppm.to_integral_value():
+            raise BadInputError("Interest rate must be 0 or more, to at most 6 decimals")
+        fee_cents = _to_cents(_parse_amount(fee))
+        if fee_cents < 0:
+            raise BadInputError("Fee can't be negative")
+        start = time.perf_counter()
+        with self._lock:
+            with self.committing() as commit:
+                changed = self._end_of_day(int(ppm), fee_cents, int(bool(expire_phone)))
+                if self.journal:
+                    # One record replays the whole run, placed before any later change
+                    commit(('eod', int(ppm), fee_cents, int(bool(expire_phone))))
+            if self.backend is not None:
+                with self.backend.transaction():
+                    for num in changed:
+                        self._store_account(num)
+            elif not self.journal:
                 self.save_data()
-                return f"Added {int(amount)} phone credit. New balance: {int(acc.phone_credit)}"
+        self._ledger.touch(*changed)
+        if self.hooks:
+            self._emit('end_of_day', start, accounts=len(changed))
+        return len(changed)
+    
+    def _end_of_day(self, interest_ppm, fee_cents, expire):
+        """Apply the end-of-day rules in memory; return the changed account numbers"""
+        accounts = self.accounts
+        kinds = CompactAccountStore.KINDS
+        with self.locks.holding_all():
+            if isinstance(accounts, CompactAccountStore):
+                # The store's own columns are updated in place
+                rows = None
+                columns = (accounts._kinds, accounts._balances, accounts._phone)
+            elif isinstance(accounts, MappedAccountStore):
+                rows = [row for row in range(accounts._used)
+                        if accounts._map[accounts._offset(row) + accounts.LIVE]]
+                columns = (array('b', (accounts._map[accounts._offset(row) + accounts.KIND] for row in rows)),
+                           array('q', (accounts._get(row, accounts.BALANCE) for row in rows)),
+                           array('q', (accounts._get(row, accounts.PHONE) for row in rows)))
+            else:
+                rows = list(accounts.values())
+                columns = (array('b', (kinds.index(acc.type) if acc.type in kinds else 0 for acc in rows)),
+                           array('q', (acc._cents for acc in rows)),
+                           array('q', (acc._phone_cents for acc in rows)))
+            interest, fee, expired, changed = _day_end_amounts(
+                *columns, interest_ppm, fee_cents, expire)
             
-            elif choice == '9':  # History
-                num = args[0]
-                pwd = args[1]
-                acc = self.login(num, pwd)
-                return "\n".join(acc.history) if acc.history else "No transactions"
+            now = int(time.time())
+            pack = _HistoryBase.RECORD.pack
+            entries = []
+            numbers = []
+            for i in changed:
+                if rows is None:
+                    row, num = i, str(accounts._numbers[i])
+                    seq = _ArenaHistory(accounts, row).next_seq()
+                elif isinstance(accounts, MappedAccountStore):
+                    row = rows[i]
+                    accounts._put(row, accounts.BALANCE, columns[1][i])
+                    accounts._put(row, accounts.PHONE, columns[2][i])
+                    num = str(accounts._get(row, accounts.NUMBER))
+                    seq = _ArenaHistory(accounts, row).next_seq()
+                else:
+                    row = rows[i]
+                    row._cents, row._phone_cents = columns[1][i], columns[2][i]
+                    num, seq = row.number, row.history.next_seq()
+                numbers.append(num)
+                for op, cents in ((OP_INTEREST, interest[i]), (OP_FEE, fee[i]), (OP_EXPIRED, expired[i])):
+                    if cents:
+                        entries.append((row, pack(op, cents, 0, now, seq)))
+                        seq += 1
             
+            if rows is None or isinstance(accounts, MappedAccountStore):
+                accounts._append_many(entries)
             else:
-                return "Invalid option"
+                for acc, raw in entries:
+                    acc.history._append_raw(raw)
+        return numbers
+    
+    def archive_history(self, keep=None, days=None):
+        """Move history beyond the newest keep entries, or older than days,
+        into the archive, then save the hot data once
         
-        except ValueError:
-            raise BadInputError("Please enter numbers only")
+        Only accounts over the limit are touched, and the newest entry
+        always stays hot so sequence numbers carry on from it. Returns the
+        number of entries moved.
+        """
+        if self.backend is not None:
+            raise BankError("History can't be archived with a storage backend")
+        keep = self.HISTORY_KEEP if keep is None and days is None else keep
+        cutoff = None if days is None else time.time() - days * 86400
+        moved = 0
+        with self._lock:
+            for num in list(self.accounts):
+                with self.locks.holding(num):
+                    acc = self.accounts[num]
+                    history = acc.history
+                    cut = max(len(history) - keep, 0) if keep is not None else 0
+                    if cutoff is not None:
+                        for txn in history.page(cut):
+                            if txn.timestamp >= cutoff:
+                                break
+                            cut += 1
+                    cut = min(cut, len(history) - 1)
+                    if cut <= 0:
+                        continue
+                    raws = list(history.raw_records())
+                    self.archive.append(num, raws[:cut], history)
+                    acc.history = History.from_raw(raws[cut:])
+                    self._statements.discard(num)
+                    self._ledger.forget(num)
+                    moved += cut
+            if moved:
+                self.save_data()
+        return moved
+    
+    def query(self, account=None, op=None, counterparty=None, min_amount=None,
+              max_amount=None, since=None, until=None):
+        """Find transactions through the ledger indexes
+        
+        op is an op code or name ("Added", "Took", "Sent", "Got", "Phone",
+        ...); amounts are in currency units and since/until are Unix
+        times, both inclusive. Yields (account, Transaction) pairs from the
+        archived and hot history, in the order they were indexed.
+        """
+        if isinstance(op, str):
+            if op not in _OP_NAMES:
+                raise BadInputError(f"Unknown transaction type: {op}")
+            op = _OP_NAMES[op]
+        return self._ledger.query(
+            self.accounts, None if account is None else str(account), op,
+            None if counterparty is None else _account_key(counterparty),
+            None if min_amount is None else _to_cents(min_amount),
+            None if max_amount is None else _to_cents(max_amount), since, until)
+    
+    def history_page(self, num, offset=0, limit=None):
+        """History lines from offset, reading archived entries first"""
+        history = self.accounts[num].history
+        archived = self.archive.count(num, history)
+        lines = [str(txn) for txn in self.archive.records(num, history, offset, limit)]
+        if limit is None or len(lines) < limit:
+            rest = None if limit is None else limit - len(lines)
+            lines.extend(self.statement(num).page(max(offset - archived, 0), rest))
+        return lines
+    
+    def statement(self, num):
+        """Cached rendered history and totals for an account"""
+        if num not in self.accounts:
+            raise NoAccountError("Account not found")
+        return self._statements.get(num, self.accounts[num].history)
+    
+    def handle_choice(self, choice, *args):
+        """Process user menu selections"""
+        return self.commands.dispatch(self, choice, args)
+    
+    def apply_choice(self, choice, *args):
+        """Run a menu option in memory; return its message and journal records"""
+        return self.commands.apply(self, choice, args)
+    
+    @contextmanager
+    def deferred(self):
+        """Wait for every command's records and make them durable together on exit
+        
+        Journal records still take their place as each command runs; other
+        modes save once at the end.
+        """
+        with self._lock:
+            outer = self._deferred is not None
+            if not outer:
+                self._deferred = []
+        try:
+            yield
+        finally:
+            if not outer:
+                with self._lock:
+                    staged, self._deferred = self._deferred, None
+                self._finish(staged)
+
+class AsyncBankManager:
+    """asyncio front end for a BankManager
+    
+    Calls go through the bank's command registry, middleware included, on
+    a small thread pool. Writes stage their journal records there, then
+    one background writer flushes everything queued so far in a single
+    save. Balance and history reads are answered from memory and never
+    wait for a flush.
+    """
+    
+    def __init__(self, bank, workers=4):
+        self.bank = bank
+        self._ops = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bank-op")
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bank-io")
+        self._pending = []
+        self._writer = None
+        self.flushes = 0
+    
+    async def handle_choice(self, choice, *args):
+        """Awaitable version of BankManager.handle_choice"""
+        loop = asyncio.get_running_loop()
+        # On the pool, since a password check hashes for tens of ms
+        staged = []
+        message = await loop.run_in_executor(
+            self._ops, self.bank.commands.dispatch, self.bank, choice, args, staged)
+        if staged:
+            await self._commit(staged)
+        return message
+    
+    async def _commit(self, staged):
+        """Wait until staged records are durable, sharing flushes with other callers"""
+        loop = asyncio.get_running_loop()
+        futures = [future for _, future in staged if future is not None]
+        if futures:
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+            if self.bank._compaction_due() or any(
+                    rec[0] == 'del' for records, _ in staged for rec in records):
+                await loop.run_in_executor(self._io, self.bank._after_durable, staged)
+            return
+        
+        future = loop.create_future()
+        self._pending.extend((pair, future) for pair in staged)
+        if self._writer is None or self._writer.done():
+            self._writer = loop.create_task(self._drain())
+        await future
+    
+    async def _drain(self):
+        """Flush queued records until the queue stays empty"""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await loop.run_in_executor(self._io, self.bank._finish, [staged for staged, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.flushes += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+    
+    async def open_account(self, acc_type):
+        return await self.handle_choice('1', acc_type)
+    
+    async def deposit(self, num, pwd, amount):
+        return await self.handle_choice('3', num, pwd, amount)
+    
+    async def withdraw(self, num, pwd, amount):
+        return await self.handle_choice('4', num, pwd, amount)
+    
+    async def transfer(self, num, pwd, to_num, amount):
+        return await self.handle_choice('5', num, pwd, to_num, amount)
+    
+    async def balance(self, num, pwd):
+        return await self.handle_choice('6', num, pwd)
+    
+    async def delete_account(self, num, pwd):
+        return await self.handle_choice('7', num, pwd)
+    
+    async def phone_topup(self, num, pwd, amount):
+        return await self.handle_choice('8', num, pwd, amount)
+    
+    async def history(self, num, pwd, offset=0, limit=None):
+        return await self.handle_choice('9', num, pwd, offset, limit)
+    
+    async def close(self):
+        """Wait for the last flush and stop the worker threads"""
+        if self._writer is not None:
+            await self._writer
+        self._ops.shutdown()
+        self._io.shutdown()
+
+class _BankRequestHandler(socketserver.StreamRequestHandler):
+    """One client connection: read pipelined lines, reply in order"""
+    
+    def handle(self):
+        server = self.server.bank_server
+        replies = queue.Queue()
+        writer = threading.Thread(target=self._write_replies, args=(replies,), daemon=True)
+        writer.start()
+        try:
+            for line in self.rfile:
+                if line.strip():
+                    replies.put(server.pool.submit(server.dispatch, line))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            replies.put(None)
+            writer.join()
+    
+    def _write_replies(self, replies):
+        """Send each reply once its request is done, batching ready ones"""
+        while True:
+            future = replies.get()
+            if future is None:
+                return
+            chunks = [future.result()]
+            while not replies.empty():
+                future = replies.queue[0]
+                if future is None or not future.done():
+                    break
+                chunks.append(replies.get().result())
+            try:
+                self.wfile.write(b''.join(chunks))
+            except (ConnectionError, OSError):
+                return
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class BankServer:
+    """JSON-lines TCP service in front of a BankManager
+    
+    Each request line is {"id": ..., "op": "3", "args": [...]}; the reply is
+    {"id": ..., "ok": true, "result": "...", "ms": ...} or has "error"
+    instead of "result". The "session" op takes [number, password] and
+    returns a token to pass as the password. Connections stay open and may pipeline requests;
+    replies come back in request order. Requests run on a worker pool.
+    """
+    
+    def __init__(self, bank, host="127.0.0.1", port=0, workers=8):
+        self.bank = bank
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bank-worker")
+        self._server = _ThreadingServer((host, port), _BankRequestHandler)
+        self._server.bank_server = self
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+    
+    @property
+    def address(self):
+        return self._server.server_address
+    
+    def dispatch(self, line):
+        """Run one request line and return the encoded reply"""
+        start = time.perf_counter()
+        reply = {}
+        try:
+            request = json.loads(line)
+            reply['id'] = request.get('id')
+            args = [str(arg) for arg in request.get('args', [])]
+            if request['op'] == 'session':
+                reply['result'] = self.bank.open_session(*args)
+            else:
+                reply['result'] = self.bank.handle_choice(str(request['op']), *args)
+            reply['ok'] = True
+        except BankError as e:
+            reply['ok'] = False
+            reply['error'] = str(e)
+        except (ValueError, KeyError, TypeError, AttributeError, IndexError):
+            reply['ok'] = False
+            reply['error'] = "Bad request"
+        except Exception as e:
+            reply['ok'] = False
+            reply['error'] = f"Server error: {e}"
+        ms = (time.perf_counter() - start) * 1000
+        reply['ms'] = round(ms, 3)
+        with self._stats_lock:
+            self.requests += 1
+            self.errors += not reply['ok']
+            self.total_ms += ms
+        return (json.dumps(reply) + "\n").encode()
+    
+    def stats(self):
+        """Request count, error count and mean service time"""
+        with self._stats_lock:
+            mean = self.total_ms / self.requests if self.requests else 0.0
+            return {'requests': self.requests, 'errors': self.errors, 'mean_ms': mean}
+    
+    def start(self):
+        """Serve on a background thread and return the bound address"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.address
+    
+    def serve_forever(self):
+        self._server.serve_forever()
+    
+    def stop(self):
+        """Stop accepting connections and finish queued requests"""
+        self._server.shutdown()
+        self._server.server_close()
+        self.pool.shutdown()
+
+def _shard_worker(conn, data_file, settings):
+    """Run one shard: answer BankManager calls arriving on conn"""
+    for name, value in settings.items():
+        setattr(BankManager, name, value)
+    bank = BankManager(journal=True, data_file=data_file)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        method, args = request
+        try:
+            if method == 'numbers':
+                result = list(bank.accounts)
+            elif method in ShardedBank.SHARD_METHODS:
+                result = getattr(bank, method)(*args)
+            else:
+                raise BankError(f"Unknown shard call: {method}")
+            conn.send(('ok', result))
+        except BankError as e:
+            conn.send(('error', type(e).__name__, str(e)))
+        except (ValueError, IndexError, KeyError) as e:
+            conn.send(('error', 'BadInputError', str(e)))
+    bank.close()
+
+class ShardedBank:
+    """Accounts split across worker processes, each with its own data file
+    
+    Accounts go to a shard by number: hashed (number % shards) or by equal
+    slices of ACCOUNT_NUMBER_RANGE. handle_choice takes the same arguments
+    as BankManager's and runs on the shard that owns the account.
+    
+    A transfer between shards is a two-phase commit. The sending shard
+    checks the password and holds the money, then the receiving shard
+    records the credit it expects, both in their journals. Only then is the decision written to this
+    router's log, and both shards settle. On startup or after a worker
+    restarts, prepared transfers with a logged decision are settled and all
+    others are cancelled, so a crash at any step neither creates nor loses
+    money.
+    """
+    
+    metrics = None
+    SHARD_METHODS = ('handle_choice', 'make_account', 'open_session', 'close_session',
+                     'prepare_debit', 'prepare_credit', 'settle', 'cancel', 'pending',
+                     'total_balance')
+    SETTINGS = ('ACCOUNT_NUMBER_RANGE', 'PASSWORD_ITERATIONS', 'JOURNAL_FSYNC',
+                'COMPACT_THRESHOLD', 'SESSION_TTL')
+    
+    def __init__(self, shards=4, partition='hash', data_file=None):
+        if partition not in ('hash', 'range'):
+            raise BadInputError("Partition must be hash or range")
+        self.shards = shards
+        self.partition = partition
+        base = os.path.splitext(data_file or BankManager.DATA_FILE)[0]
+        self.paths = [f"{base}.shard{i}.txt" for i in range(shards)]
+        self.log_path = base + ".shards.log"
+        self._check_layout(base + ".shards")
+        self._settings = {name: getattr(BankManager, name) for name in self.SETTINGS}
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * shards
+        self._conns = [None] * shards
+        self._locks = [threading.Lock() for _ in range(shards)]
+        for i in range(shards):
+            self._start(i)
+        self._numbers = None
+        self._numbers_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._active = set()  # transfers being run by a caller right now
+        self._committed = set()  # decided transfers not yet settled everywhere
+        self._recover()
+    
+    def _check_layout(self, path):
+        """Refuse to reopen shard files with a different split"""
+        layout = f"{self.shards} {self.partition}\n"
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() != layout:
+                    raise BankError(f"{path} was written for a different shard layout")
+        else:
+            with open(path, 'w') as f:
+                f.write(layout)
+    
+    def shard_of(self, num):
+        """Index of the shard that owns account num"""
+        if not str(num).isdigit():
+            return 0
+        if self.partition == 'hash':
+            return int(num) % self.shards
+        low, high = BankManager.ACCOUNT_NUMBER_RANGE
+        width = -(-(high - low + 1) // self.shards)
+        return min(max((int(num) - low) // width, 0), self.shards - 1)
+    
+    # Worker processes
+    
+    def _start(self, i):
+        conn, child = self._context.Pipe()
+        worker = self._context.Process(target=_shard_worker, daemon=True,
+                                       args=(child, self.paths[i], self._settings))
+        worker.start()
+        child.close()
+        self._workers[i], self._conns[i] = worker, conn
+    
+    def _call(self, i, method, *args):
+        """Run a BankManager method on shard i"""
+        with self._locks[i]:
+            try:
+                self._conns[i].send((method, args))
+                reply = self._conns[i].recv()
+            except (EOFError, OSError):
+                self._workers[i].kill()
+                self._workers[i].join()
+                self._start(i)
+                reply = None
+        if reply is None:
+            self._resolve(i)
+            raise ShardUnavailableError(f"Shard {i} restarted, please try again")
+        if reply[0] == 'ok':
+            return reply[1]
+        error = globals().get(reply[1])
+        if not (isinstance(error, type) and issubclass(error, BankError)):
+            error = BankError
+        raise error(reply[2])
+    
+    # Two-phase transfers
+    
+    def _recover(self):
+        """Finish or cancel transfers left over from a crash"""
+        committed, done = set(), set()
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        (committed if parts[1] == 'commit' else done).add(parts[0])
+        self._committed = committed - done
+        for i in range(self.shards):
+            self._resolve(i)
+        # Every decided transfer is settled now, so the log can start over
+        self._committed.clear()
+        self._log = open(self.log_path, 'w')
+    
+    def _resolve(self, i):
+        """Settle or cancel shard i's prepared transfers that no caller is running"""
+        for txid in self._call(i, 'pending'):
+            if txid in self._committed:
+                self._call(i, 'settle', txid)
+            elif txid not in self._active:
+                self._call(i, 'cancel', txid)
+    
+    def _log_line(self, line, sync):
+        with self._log_lock:
+            self._log.write(line)
+            self._log.flush()
+            if sync:
+                os.fsync(self._log.fileno())
+    
+    def transfer(self, from_num, pwd, to_num, amount):
+        """Move money between accounts on different shards"""
+        cents = _to_cents(_parse_amount(amount))
+        src, dst = self.shard_of(from_num), self.shard_of(to_num)
+        txid = secrets.token_hex(8)
+        self._active.add(txid)
+        try:
+            try:
+                # The debit checks the password, so nothing is journaled for a stranger
+                self._call(src, 'prepare_debit', txid, from_num, pwd, amount, to_num)
+                self._call(dst, 'prepare_credit', txid, to_num, cents, from_num)
+            except BankError:
+                self._active.discard(txid)
+                for shard in (src, dst):
+                    self._retry(shard, 'cancel', txid)
+                raise
+            self._committed.add(txid)
+            self._log_line(f"{txid} commit\n", sync=True)
+            settled = all([self._retry(shard, 'settle', txid) for shard in (dst, src)])
+            if settled:
+                self._committed.discard(txid)
+                self._log_line(f"{txid} done\n", sync=False)
+        finally:
+            self._active.discard(txid)
+    
+    def _retry(self, i, method, *args, attempts=3):
+        """Call shard i, retrying across restarts; False if it never answered"""
+        for _ in range(attempts):
+            try:
+                self._call(i, method, *args)
+                return True
+            except ShardUnavailableError:
+                continue
+        return False
+    
+    # BankManager-style interface
+    
+    @property
+    def allocator(self):
+        """Account numbers free across every shard"""
+        with self._numbers_lock:
+            if self._numbers is None:
+                allocator = AccountNumberAllocator(*BankManager.ACCOUNT_NUMBER_RANGE)
+                for i in range(self.shards):
+                    for num in self._call(i, 'numbers'):
+                        if str(num).isdigit():
+                            allocator.reserve(num)
+                self._numbers = allocator
+        return self._numbers
+    
+    def handle_choice(self, choice, *args):
+        """Route a menu option to the shard that owns the account"""
+        if choice == '1':
+            acc_type, = COMMANDS.get('1').parse(args)
+            num = str(self.allocator.allocate())
+            try:
+                num, pwd = self._call(self.shard_of(num), 'make_account', acc_type, num)
+            except ShardUnavailableError:
+                raise  # the shard may have opened it before restarting
+            except BankError:
+                self.allocator.release(num)
+                raise
+            return f"New {acc_type} account:\nNumber: {num}\nPassword: {pwd}"
+        if choice == '5' and len(args) >= 4 and self.shard_of(args[0]) != self.shard_of(args[2]):
+            self.transfer(*args[:4])
+            return f"Sent {_format_money(_parse_amount(args[3]))} to {args[2]}"
+        shard = self.shard_of(args[0]) if args else 0
+        message = self._call(shard, 'handle_choice', choice, *args)
+        if choice == '7' and self._numbers is not None:
+            self._numbers.release(args[0])
+        return message
+    
+    def open_session(self, num, pwd):
+        return self._call(self.shard_of(num), 'open_session', num, pwd)
+    
+    def close_session(self, token):
+        for i in range(self.shards):
+            self._call(i, 'close_session', token)
+    
+    def total_balance(self):
+        """All money across shards, counting money held by unfinished transfers"""
+        total = Decimal(0)
+        for i in range(self.shards):
+            total += self._call(i, 'total_balance')
+            total += sum(_from_cents(cents) for kind, _, cents, _ in
+                         self._call(i, 'pending').values() if kind == 'debit')
+        return total
+    
+    def close(self):
+        """Stop the workers after they finish queued calls"""
+        for i in range(self.shards):
+            with self._locks[i]:
+                try:
+                    self._conns[i].send(None)
+                except OSError:
+                    pass
+                self._workers[i].join()
+                self._conns[i].close()
+        self._log.close()
 
 class BankAppGUI:
-    """Graphical interface for the banking app"""
+    """Graphical interface for the banking app
+    
+    Bank calls run one at a time on a background thread, so a slow save
+    never freezes the window; results are picked up with window.after.
+    """
+    
+    POLL_MS = 30  # how often to check on a running operation
+    HISTORY_CHUNK = 200  # history lines inserted per event-loop turn
     
     def __init__(self, manager):
         self.manager = manager
         self.current_acc = None
+        self.session = None
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bank-gui")
+        self.busy = False
+        self.buttons = []
+        self._render = 0  # bumped to stop an unfinished chunked render
         
         self.window = tk.Tk()
         self.window.title("Simple Bank")
@@ -260,8 +4433,9 @@ class BankAppGUI:
         self.pwd_entry = tk.Entry(self.login_frame, show="*")
         self.pwd_entry.grid(row=1, column=1)
         
-        tk.Button(self.login_frame, text="Login", command=self.do_login).grid(
-            row=2, column=0, columnspan=2, pady=5)
+        login_button = tk.Button(self.login_frame, text="Login", command=self.do_login)
+        login_button.grid(row=2, column=0, columnspan=2, pady=5)
+        self.buttons.append(login_button)
         
         # Account actions
         self.actions_frame = tk.Frame(main_frame)
@@ -272,16 +4446,9 @@ class BankAppGUI:
         tk.Label(self.actions_frame, text="Choose action:").pack()
         
         self.action_var = tk.StringVar()
-        actions = [
-            ("3. Deposit", "3"),
-            ("4. Withdraw", "4"),
-            ("5. Transfer", "5"),
-            ("6. View Balance", "6"),
-            ("7. Delete Account", "7"),
-            ("8. Phone Top-up", "8"),
-            ("9. History", "9"),
-            ("0. Logout", "0")
-        ]
+        actions = [(f"{command.choice}. {command.label}", command.choice)
+                   for command in self.manager.commands if command.menu == 'account']
+        actions.append(("0. Logout", "0"))
         
         for text, val in actions:
             tk.Radiobutton(self.actions_frame, text=text, 
@@ -294,7 +4461,7 @@ class BankAppGUI:
         self.input_labels = []
         self.input_boxes = []
         
-        for i in range(3):
+        for i in range(max(len(command.fields) for command in self.manager.commands)):
             label = tk.Label(self.input_frame, text="")
             label.grid(row=i, column=0, sticky='e')
             entry = tk.Entry(self.input_frame, width=20)
@@ -310,17 +4477,22 @@ class BankAppGUI:
         self.output.grid(row=3, column=0, columnspan=2)
         
         # Action button
-        tk.Button(main_frame, text="Do Action", command=self.do_action).grid(
-            row=4, column=0, columnspan=2, pady=10)
+        action_button = tk.Button(main_frame, text="Do Action", command=self.do_action)
+        action_button.grid(row=4, column=0, columnspan=2, pady=10)
         
         # New account button
-        tk.Button(main_frame, text="New Account", 
-                 command=self.make_new_account).grid(
-            row=5, column=0, columnspan=2, pady=5)
+        new_button = tk.Button(main_frame, text="New Account", 
+                               command=self.make_new_account)
+        new_button.grid(row=5, column=0, columnspan=2, pady=5)
+        self.buttons.extend([action_button, new_button])
+        
+        # Pending indicator
+        self.status = tk.Label(main_frame, text="", fg='gray')
+        self.status.grid(row=6, column=0, columnspan=2)
     
     def update_inputs(self, *args):
         """Show relevant input fields for each action"""
-        choice = self.action_var.get()
+        command = self.manager.commands.get(self.action_var.get())
         
         # Hide all first
         for label, box in zip(self.input_labels, self.input_boxes):
@@ -328,50 +4500,90 @@ class BankAppGUI:
             box.grid_remove()
             box.delete(0, tk.END)
         
-        if choice == '3':  # Deposit
-            self.input_labels[0].config(text="Amount:")
-            self.input_labels[0].grid()
-            self.input_boxes[0].grid()
-        
-        elif choice == '4':  # Withdraw
-            self.input_labels[0].config(text="Amount:")
-            self.input_labels[0].grid()
-            self.input_boxes[0].grid()
-        
-        elif choice == '5':  # Transfer
-            self.input_labels[0].config(text="To Account:")
-            self.input_labels[1].config(text="Amount:")
-            self.input_labels[0].grid()
-            self.input_boxes[0].grid()
-            self.input_labels[1].grid()
-            self.input_boxes[1].grid()
-        
-        elif choice == '8':  # Phone top-up
-            self.input_labels[0].config(text="Amount:")
-            self.input_labels[0].grid()
-            self.input_boxes[0].grid()
+        for label, box, field in zip(self.input_labels, self.input_boxes,
+                                     command.fields if command else ()):
+            label.config(text=field.label)
+            label.grid()
+            box.grid()
     
     def show_message(self, text):
         """Display output"""
+        self._render += 1
         self.output.config(state='normal')
         self.output.delete(1.0, tk.END)
         self.output.insert(tk.END, text)
         self.output.config(state='disabled')
     
+    def show_progressively(self, text):
+        """Display long output a chunk of lines per event-loop turn"""
+        self.show_message("")
+        lines = text.split("\n")
+        render = self._render
+        
+        def insert(start):
+            if render != self._render:
+                return  # something newer is being shown
+            chunk = lines[start:start + self.HISTORY_CHUNK]
+            self.output.config(state='normal')
+            self.output.insert(tk.END, ("\n" if start else "") + "\n".join(chunk))
+            self.output.config(state='disabled')
+            if start + self.HISTORY_CHUNK < len(lines):
+                self.window.after(1, insert, start + self.HISTORY_CHUNK)
+        
+        insert(0)
+    
+    def run_in_background(self, work, on_done):
+        """Run work() off the UI thread, then on_done(result) back on it"""
+        if self.busy:
+            return
+        self.busy = True
+        for button in self.buttons:
+            button.config(state='disabled')
+        self.status.config(text="Working...")
+        future = self.worker.submit(work)
+        
+        def check():
+            if not future.done():
+                self.window.after(self.POLL_MS, check)
+                return
+            self.busy = False
+            for button in self.buttons:
+                button.config(state='normal')
+            self.status.config(text="")
+            try:
+                result = future.result()
+            except BankError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            on_done(result)
+        
+        self.window.after(self.POLL_MS, check)
+    
+    def show_login(self):
+        """Return to the login form"""
+        self.current_acc = None
+        self.actions_frame.grid_remove()
+        self.login_frame.grid()
+        self.num_entry.delete(0, tk.END)
+        self.pwd_entry.delete(0, tk.END)
+    
     def do_login(self):
         """Handle login attempt"""
         num = self.num_entry.get()
         pwd = self.pwd_entry.get()
         
-        try:
-            self.current_acc = self.manager.login(num, pwd)
+        def work():
+            return self.manager.open_session(num, pwd), self.manager.accounts[num]
+        
+        def done(result):
+            self.session, self.current_acc = result
             self.acc_info.config(
                 text=f"{self.current_acc.type} Account {num}")
             self.login_frame.grid_remove()
             self.actions_frame.grid(row=1, column=0, columnspan=2)
             self.show_message(f"Welcome! Balance: {self.current_acc.balance}")
-        except BankError as e:
-            messagebox.showerror("Error", str(e))
+        
+        self.run_in_background(work, done)
     
     def do_action(self):
         """Perform selected banking action"""
@@ -379,85 +4591,103 @@ class BankAppGUI:
             return
         
         choice = self.action_var.get()
+        num = self.current_acc.number
+        pwd = self.session
         
         if choice == '0':  # Logout
-            self.current_acc = None
-            self.actions_frame.grid_remove()
-            self.login_frame.grid()
-            self.num_entry.delete(0, tk.END)
-            self.pwd_entry.delete(0, tk.END)
-            self.show_message("Logged out")
+            def logged_out(result):
+                self.show_login()
+                self.show_message("Logged out")
+            
+            self.run_in_background(lambda: self.manager.close_session(pwd), logged_out)
             return
         
-        try:
-            num = self.current_acc.number
-            pwd = self.current_acc.password
-            
-            if choice == '3':  # Deposit
-                amount = self.input_boxes[0].get()
-                result = self.manager.handle_choice(choice, num, pwd, amount)
-            
-            elif choice == '4':  # Withdraw
-                amount = self.input_boxes[0].get()
-                result = self.manager.handle_choice(choice, num, pwd, amount)
-            
-            elif choice == '5':  # Transfer
-                to_num = self.input_boxes[0].get()
-                amount = self.input_boxes[1].get()
-                result = self.manager.handle_choice(choice, num, pwd, to_num, amount)
-            
-            elif choice == '6':  # Balance
-                result = self.manager.handle_choice(choice, num, pwd)
-            
-            elif choice == '7':  # Delete
-                result = self.manager.handle_choice(choice, num, pwd)
-                if "deleted" in result:
-                    self.current_acc = None
-                    self.actions_frame.grid_remove()
-                    self.login_frame.grid()
-                    self.num_entry.delete(0, tk.END)
-                    self.pwd_entry.delete(0, tk.END)
-            
-            elif choice == '8':  # Phone
-                amount = self.input_boxes[0].get()
-                result = self.manager.handle_choice(choice, num, pwd, amount)
-            
-            elif choice == '9':  # History
-                result = self.manager.handle_choice(choice, num, pwd)
-            
-            self.show_message(result)
+        command = self.manager.commands.get(choice)
+        if command is None:
+            return
+        if command.confirm and not messagebox.askyesno("Confirm", command.confirm):
+            return
+        args = tuple(box.get() for box in self.input_boxes[:len(command.fields)])
         
-        except BankError as e:
-            messagebox.showerror("Error", str(e))
+        def done(result):
+            if choice == '7' and "deleted" in result:
+                self.show_login()
+            if choice == '9':
+                self.show_progressively(result)
+            else:
+                self.show_message(result)
+        
+        self.run_in_background(lambda: self.manager.handle_choice(choice, num, pwd, *args), done)
     
     def make_new_account(self):
         """Create new account dialog"""
         acc_type = simpledialog.askstring("New Account", 
                                         "Account type (Personal/Business):")
-        if acc_type and acc_type.lower() in ['personal', 'business']:
-            try:
-                result = self.manager.handle_choice('1', acc_type.capitalize())
-                messagebox.showinfo("Success", result)
-            except BankError as e:
-                messagebox.showerror("Error", str(e))
-        elif acc_type:
-            messagebox.showerror("Error", "Must be Personal or Business")
+        if acc_type:
+            self.run_in_background(
+                lambda: self.manager.handle_choice('1', acc_type),
+                lambda result: messagebox.showinfo("Success", result))
     
     def run(self):
         """Start the application"""
         self.window.mainloop()
+        self.worker.shutdown(wait=True)  # let a running save finish
 
 def main():
     """Run the banking application"""
-    bank = BankManager()
+    if '--to-binary' in sys.argv:
+        count = convert_text_to_binary(BankManager.DATA_FILE, BankManager.BINARY_FILE)
+        print(f"Wrote {count} accounts to {BankManager.BINARY_FILE}")
+        return
+    if '--to-text' in sys.argv:
+        count = convert_binary_to_text(BankManager.BINARY_FILE, BankManager.DATA_FILE)
+        print(f"Wrote {count} accounts to {BankManager.DATA_FILE}")
+        return
+    
+    if '--migrate-to' in sys.argv:
+        # Copy accounts between the text file and the SQLite database
+        target = sys.argv[sys.argv.index('--migrate-to') + 1]
+        text, db = TextFileBackend(BankManager.DATA_FILE), SqliteBackend(BankManager.SQLITE_FILE)
+        source, dest = (text, db) if target == 'sqlite' else (db, text)
+        count = migrate(source, dest)
+        db.close()
+        print(f"Copied {count} accounts to {dest.path}")
+        return
     
-    if len(sys.argv) > 1 and sys.argv[1] == '--cli':
-        # Command line interface
+    if '--shards' in sys.argv:
+        # Sharded service: one worker process per shard behind a router
+        count = int(sys.argv[sys.argv.index('--shards') + 1])
+        partition = 'range' if '--partition' in sys.argv and \
+            sys.argv[sys.argv.index('--partition') + 1] == 'range' else 'hash'
+        bank = ShardedBank(shards=count, partition=partition)
+        i = sys.argv.index('--serve') if '--serve' in sys.argv else -1
+        port = int(sys.argv[i + 1]) if i >= 0 and i + 1 < len(sys.argv) and sys.argv[i + 1].isdigit() else 8765
+        server = BankServer(bank, port=port)
+        print(f"Serving {count} shards on {server.address[0]}:{server.address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            bank.close()
+            print(server.stats())
+        return
+    
+    backend = SqliteBackend(BankManager.SQLITE_FILE) if '--sqlite' in sys.argv else None
+    record = sys.argv[sys.argv.index('--record') + 1] if '--record' in sys.argv else None
+    bank = BankManager(journal='--journal' in sys.argv, lazy='--lazy' in sys.argv,
+                       metrics='--metrics' in sys.argv, binary='--binary' in sys.argv,
+                       backend=backend, record=record)
+    
+    if '--cli' in sys.argv:
+        # Command line interface, built from the same commands as the GUI
         print("Bank App - Command Line")
         while True:
             print("\nMain Menu:")
-            print("1. New Account")
-            print("2. Login")
+            for command in bank.commands:
+                if command.menu == 'main':
+                    print(f"{command.choice}. {command.label}")
             print("0. Exit")
             
             choice = input("Choose: ")
@@ -468,80 +4698,41 @@ def main():
             try:
                 if choice == '1':
                     acc_type = input("Account type (Personal/Business): ")
-                    num, pwd = bank.make_account(acc_type)
-                    print(f"Created {acc_type} account:\n#: {num}\nPassword: {pwd}")
+                    print(bank.handle_choice('1', acc_type))
                 
                 elif choice == '2':
                     num = input("Account #: ")
-                    pwd = input("Password: ")
-                    acc = bank.login(num, pwd)
-                    print(f"Welcome {acc.type} account {num}")
+                    token = bank.open_session(num, input("Password: "))
+                    print(bank.handle_choice('2', num, token))
                     
                     while True:
                         print("\nAccount Menu:")
-                        print("3. Deposit")
-                        print("4. Withdraw")
-                        print("5. Transfer")
-                        print("6. Balance")
-                        print("7. Delete")
-                        print("8. Phone")
-                        print("9. History")
+                        for command in bank.commands:
+                            if command.menu == 'account':
+                                print(f"{command.choice}. {command.label}")
                         print("0. Logout")
                         
                         action = input("Choose: ")
                         
                         if action == '0':
+                            bank.close_session(token)
                             break
                         
-                        try:
-                            if action == '3':
-                                amount = float(input("Amount: "))
-                                acc.add_money(amount)
-                                bank.save_data()
-                                print(f"Added {amount}. New balance: {acc.balance}")
-                            
-                            elif action == '4':
-                                amount = float(input("Amount: "))
-                                acc.take_money(amount)
-                                bank.save_data()
-                                print(f"Withdrew {amount}. New balance: {acc.balance}")
-                            
-                            elif action == '5':
-                                to_num = input("To account #: ")
-                                amount = float(input("Amount: "))
-                                if to_num not in bank.accounts:
-                                    print("Account not found")
-                                    continue
-                                acc.send_money(amount, bank.accounts[to_num])
-                                bank.save_data()
-                                print(f"Sent {amount} to {to_num}")
-                            
-                            elif action == '6':
-                                print(f"Balance: {acc.balance}\nPhone: {acc.phone_credit}")
-                            
-                            elif action == '7':
-                                confirm = input("Delete account? (y/n): ")
-                                if confirm.lower() == 'y':
-                                    bank.remove_account(num)
-                                    print(f"Account {num} deleted")
-                                    break
-                            
-                            elif action == '8':
-                                amount = float(input("Amount: "))
-                                acc.add_phone_credit(amount)
-                                bank.save_data()
-                                print(f"Added {amount} phone credit")
-                            
-                            elif action == '9':
-                                print("\n".join(acc.history) if acc.history else "No history")
-                            
-                            else:
-                                print("Invalid choice")
+                        command = bank.commands.get(action)
+                        if command is None or command.menu != 'account':
+                            print("Invalid choice")
+                            continue
+                        if command.confirm and input(f"{command.confirm} (y/n): ").lower() != 'y':
+                            continue
+                        values = [input(f"{field.label} ") for field in command.fields]
                         
+                        try:
+                            print(bank.handle_choice(action, num, token, *values))
                         except BankError as e:
                             print(f"Error: {str(e)}")
-                        except ValueError:
-                            print("Please enter numbers only")
+                            continue
+                        if action == '7':
+                            break
                 
                 else:
                     print("Invalid choice")
@@ -549,11 +4740,51 @@ def main():
             except BankError as e:
                 print(f"Error: {str(e)}")
     
+    elif '--serve' in sys.argv:
+        # JSON-lines service on localhost
+        i = sys.argv.index('--serve')
+        port = int(sys.argv[i + 1]) if i + 1 < len(sys.argv) and sys.argv[i + 1].isdigit() else 8765
+        server = BankServer(bank, port=port)
+        print(f"Serving on {server.address[0]}:{server.address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            print(server.stats())
+    
+    elif '--batch' in sys.argv:
+        # Apply a CSV/JSONL batch file and persist once
+        path = sys.argv[sys.argv.index('--batch') + 1]
+        results = bank.run_batch(load_batch_file(path),
+                                 atomic='--best-effort' not in sys.argv)
+        for res in results:
+            print(f"{res.row}: {'ok' if res.ok else 'failed'} {res.value if res.ok else res.error}")
+        print(f"{sum(res.ok for res in results)}/{len(results)} rows applied")
+    
+    elif '--archive' in sys.argv:
+        # Move old history out of the data file into compressed segments
+        i = sys.argv.index('--archive')
+        keep = int(sys.argv[i + 1]) if i + 1 < len(sys.argv) and sys.argv[i + 1].isdigit() else None
+        print(f"Archived {bank.archive_history(keep)} history entries")
+    
+    elif '--end-of-day' in sys.argv:
+        # Interest, fees and phone-credit expiry over every account
+        i = sys.argv.index('--end-of-day')
+        rate, fee = sys.argv[i + 1:i + 3]
+        start = time.perf_counter()
+        count = bank.end_of_day(rate, fee, expire_phone='--expire-phone' in sys.argv)
+        print(f"Updated {count} accounts in {time.perf_counter() - start:.2f}s")
+    
     else:
         # Graphical interface
         app = BankAppGUI(bank)
         app.run()
+    
+    bank.close()
+    if bank.metrics is not None:
+        print(bank.stats())
 
 if __name__ == "__main__":
-    import sys
     main()
\ No newline at end of file
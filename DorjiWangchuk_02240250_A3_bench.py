@@ -0,0 +1,466 @@
+"""Benchmarks for the banking app
+
+Run with:
+    python DorjiWangchuk_02240250_A3_bench.py --memory 100000
+    python DorjiWangchuk_02240250_A3_bench.py --load [HOST:PORT] [--connections 8]
+        [--requests 2000] [--pipeline 16]
+    python DorjiWangchuk_02240250_A3_bench.py --suite [--sizes 1000,100000,1000000]
+        [--history 20] [--budget 2] [--mode journal|lazy|columnar|binary]
+        [--save-baseline FILE] [--baseline FILE] [--tolerance 20]
+    python DorjiWangchuk_02240250_A3_bench.py --backends [--accounts 10000] [--ops 500]
+    python DorjiWangchuk_02240250_A3_bench.py --replay LOG [--data bank_data.txt]
+        [--timed] [--workers 1]
+
+--replay re-runs a log written with `--record LOG` against a copy of the
+data file as it was when recording began. Without HOST:PORT the load test starts its own server on a scratch data file.
+The suite runs each size in its own process so peak RSS is per size. With
+--baseline it exits with status 1 if any operation got slower than the
+tolerance (percent of ops/sec).
+"""
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from DorjiWangchuk_02240250_A3 import PersonalAccount, BusinessAccount, CompactAccountStore
+from DorjiWangchuk_02240250_A3 import BankManager, BankServer, History, OP_ADD, OP_TAKE, OP_SENT
+from DorjiWangchuk_02240250_A3 import convert_text_to_binary, migrate, SqliteBackend, TextFileBackend
+from DorjiWangchuk_02240250_A3 import replay_log
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+class LegacyAccount:
+    """The original account layout: a full object with its own __dict__"""
+    
+    def __init__(self, num, pwd, kind, money=0):
+        self.number = num
+        self.password = pwd
+        self.type = kind
+        self.balance = money
+        self.phone_credit = 0
+        self.history = []
+
+def legacy_account(num, pwd, kind, money):
+    return LegacyAccount(num, pwd, kind, money)
+
+def slotted_account(num, pwd, kind, money):
+    if kind == "Personal":
+        return PersonalAccount(num, pwd, money)
+    return BusinessAccount(num, pwd, money)
+
+def fill(accounts, make, count, history_len):
+    """Add count synthetic accounts with history_len entries each"""
+    for i in range(count):
+        num = str(10000 + i)
+        kind = "Personal" if i % 2 else "Business"
+        acc = make(num, str(1000 + i % 9000), kind, float(i % 5000))
+        acc.history = [f"Added {j + 1}.0" for j in range(history_len)]
+        accounts[num] = acc
+
+def measure_memory(count=100000, history_len=5):
+    """Bytes held by each account layout after loading count accounts"""
+    layouts = [
+        ("dict of objects (old)", dict, legacy_account),
+        ("dict of __slots__ objects", dict, slotted_account),
+        ("columnar store", CompactAccountStore, slotted_account),
+    ]
+    results = {}
+    for name, container, make in layouts:
+        tracemalloc.start()
+        accounts = container()
+        fill(accounts, make, count, history_len)
+        results[name] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del accounts
+    return results
+
+def print_memory(count, history_len=5):
+    """Print the memory benchmark as a table"""
+    results = measure_memory(count, history_len)
+    baseline = results["dict of objects (old)"]
+    print(f"Memory for {count} accounts, {history_len} history entries each")
+    for name, size in results.items():
+        print(f"  {name:28} {size / 2**20:9.1f} MiB  {size / count:7.0f} B/account"
+              f"  {size / baseline:5.2f}x")
+
+def percentile(values, pct):
+    """pct-th percentile of values (nearest rank)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class LoadClient:
+    """One persistent connection that pipelines JSON-lines requests"""
+    
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.reader = self.sock.makefile('rb')
+        self.next_id = 0
+    
+    def call_many(self, requests):
+        """Send requests back to back, then read all replies in order"""
+        lines = []
+        for op, args in requests:
+            self.next_id += 1
+            lines.append(json.dumps({'id': self.next_id, 'op': op, 'args': args}) + "\n")
+        self.sock.sendall("".join(lines).encode())
+        return [json.loads(self.reader.readline()) for _ in requests]
+    
+    def call(self, op, *args):
+        return self.call_many([(op, list(args))])[0]
+    
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+def run_load(address, connections=8, requests=2000, pipeline=16):
+    """Drive a mix of deposits and balance checks; return throughput numbers"""
+    setup = LoadClient(address)
+    reply = setup.call('1', 'Personal')
+    lines = reply['result'].splitlines()
+    num = lines[1].split(': ')[1]
+    pwd = lines[2].split(': ')[1]
+    setup.close()
+    
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_conn = requests // connections
+    
+    def worker():
+        client = LoadClient(address)
+        mine = []
+        failed = 0
+        sent = 0
+        while sent < per_conn:
+            window = min(pipeline, per_conn - sent)
+            batch = [('3', [num, pwd, '1']) if (sent + i) % 2 else ('6', [num, pwd])
+                     for i in range(window)]
+            start = time.perf_counter()
+            replies = client.call_many(batch)
+            elapsed = (time.perf_counter() - start) * 1000
+            mine.extend([elapsed / window] * window)
+            failed += sum(not r['ok'] for r in replies)
+            sent += window
+        client.close()
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+    
+    threads = [threading.Thread(target=worker) for _ in range(connections)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'seconds': elapsed,
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def load_local(connections, requests, pipeline):
+    """Run the load test against an in-process server on a scratch file"""
+    original = BankManager.DATA_FILE
+    with tempfile.TemporaryDirectory() as tmp:
+        BankManager.DATA_FILE = os.path.join(tmp, "bank_data.txt")
+        try:
+            bank = BankManager(journal=True, group_commit=True)
+            server = BankServer(bank)
+            address = server.start()
+            results = run_load(address, connections, requests, pipeline)
+            server.stop()
+            bank.close()
+        finally:
+            BankManager.DATA_FILE = original
+    return results
+
+FIRST_NUMBER = 1000000
+
+def synthetic_histories(history_len, variants=64, seed=1):
+    """A few encoded history fields to share between generated accounts"""
+    rng = random.Random(seed)
+    fields = []
+    for _ in range(variants):
+        history = History()
+        for _ in range(history_len):
+            op = rng.choice((OP_ADD, OP_TAKE, OP_SENT))
+            history.record(op, rng.randint(1, 500), FIRST_NUMBER + rng.randrange(1000))
+        fields.append(history.encode())
+    return fields
+
+def generate_data_file(path, count, history_len=20, seed=1):
+    """Write a bank_data.txt with count accounts of history_len entries"""
+    rng = random.Random(seed)
+    fields = synthetic_histories(history_len, seed=seed)
+    with open(path, 'w') as f:
+        chunk = []
+        for i in range(count):
+            kind = "Personal" if i % 3 else "Business"
+            chunk.append(f"{FIRST_NUMBER + i}|{1000 + i % 9000}|{kind}|"
+                         f"{rng.randint(0, 100000)}.0|0.0|{rng.choice(fields)}\n")
+            if len(chunk) == 10000:
+                f.writelines(chunk)
+                chunk = []
+        f.writelines(chunk)
+
+def timed(func, budget, limit=100000):
+    """Call func() until budget seconds or limit calls; return latencies in ms"""
+    latencies = []
+    deadline = time.perf_counter() + budget
+    while len(latencies) < limit and (not latencies or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def summarize(latencies):
+    total = sum(latencies) / 1000
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': len(latencies) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB"""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def bench_size(count, history_len=20, budget=2.0, mode=None):
+    """Benchmark every hot path against a generated file of count accounts"""
+    kwargs = {mode: True} if mode else {}
+    original = BankManager.DATA_FILE, BankManager.BINARY_FILE, BankManager.ACCOUNT_NUMBER_RANGE
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        BankManager.DATA_FILE = os.path.join(tmp, "bank_data.txt")
+        BankManager.BINARY_FILE = os.path.join(tmp, "bank_data.bin")
+        BankManager.ACCOUNT_NUMBER_RANGE = (FIRST_NUMBER, 10 * FIRST_NUMBER - 1)
+        try:
+            generate_data_file(BankManager.DATA_FILE, count, history_len)
+            file_size = os.path.getsize(BankManager.DATA_FILE)
+            if mode == 'binary':
+                convert_text_to_binary(BankManager.DATA_FILE, BankManager.BINARY_FILE)
+            
+            holder = []
+            def load():
+                if holder:
+                    holder.pop().close()
+                holder.append(BankManager(**kwargs))
+            results['load_data'] = timed(load, budget, limit=5)
+            bank = holder[0]
+            rng = random.Random(2)
+            
+            def some_account():
+                i = rng.randrange(count)
+                return str(FIRST_NUMBER + i), str(1000 + i % 9000)
+            
+            results['save_data'] = timed(bank.save_data, budget, limit=20)
+            results['make_account'] = timed(lambda: bank.make_account("Personal"), budget)
+            results['login'] = timed(lambda: bank.login(*some_account()), budget)
+            num, pwd = some_account()
+            token = bank.open_session(num, pwd)
+            results['login_session'] = timed(lambda: bank.login(num, token), budget)
+            
+            def option(choice, *extra):
+                def run():
+                    bank.handle_choice(choice, *some_account(), *extra)
+                return run
+            
+            def transfer():
+                num, pwd = some_account()
+                bank.handle_choice('5', num, pwd, str(FIRST_NUMBER + rng.randrange(count)), "0.01")
+            
+            def delete():
+                num, pwd = bank.make_account("Personal")
+                start = time.perf_counter()
+                bank.handle_choice('7', num, pwd)
+                return (time.perf_counter() - start) * 1000
+            
+            results['option_1'] = timed(lambda: bank.handle_choice('1', "Business"), budget)
+            results['option_2'] = timed(option('2'), budget)
+            results['option_3'] = timed(option('3', "5"), budget)
+            results['option_4'] = timed(option('4', "0.01"), budget)
+            results['option_5'] = timed(transfer, budget)
+            results['option_6'] = timed(option('6'), budget)
+            results['option_7'] = []
+            deadline = time.perf_counter() + budget
+            while not results['option_7'] or time.perf_counter() < deadline:
+                results['option_7'].append(delete())
+            results['option_8'] = timed(option('8', "0.01"), budget)
+            results['option_9'] = timed(option('9'), budget)
+            bank.close()
+        finally:
+            BankManager.DATA_FILE, BankManager.BINARY_FILE, BankManager.ACCOUNT_NUMBER_RANGE = original
+    
+    return {
+        'accounts': count,
+        'history_len': history_len,
+        'mode': mode or 'default',
+        'file_mb': file_size / 2**20,
+        'peak_rss_mb': peak_rss_mb(),
+        'ops': {name: summarize(lat) for name, lat in results.items()},
+    }
+
+def run_suite(sizes, history_len=20, budget=2.0, mode=None):
+    """Benchmark each size in a fresh process and collect the results"""
+    reports = []
+    for count in sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), '--suite-one', str(count),
+               '--history', str(history_len), '--budget', str(budget)]
+        if mode:
+            cmd += ['--mode', mode]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        reports.append(json.loads(out.strip().splitlines()[-1]))
+    return reports
+
+def print_suite(reports):
+    for report in reports:
+        print(f"\n{report['accounts']} accounts x {report['history_len']} entries "
+              f"[{report['mode']}]: file {report['file_mb']:.1f} MiB, "
+              f"peak RSS {report['peak_rss_mb']:.0f} MiB")
+        for name, op in report['ops'].items():
+            print(f"  {name:14} {op['ops_per_sec']:11.1f} ops/s  p50 {op['p50_ms']:9.3f} ms"
+                  f"  p99 {op['p99_ms']:9.3f} ms  ({op['calls']} calls)")
+
+def compare_to_baseline(reports, baseline, tolerance=20.0):
+    """List operations whose ops/sec fell more than tolerance percent"""
+    old = {(r['accounts'], r['mode']): r for r in baseline}
+    regressions = []
+    for report in reports:
+        before = old.get((report['accounts'], report['mode']))
+        if before is None:
+            continue
+        for name, op in report['ops'].items():
+            was = before['ops'].get(name, {}).get('ops_per_sec')
+            if was and op['ops_per_sec'] < was * (1 - tolerance / 100):
+                regressions.append((report['accounts'], name, was, op['ops_per_sec']))
+    return regressions
+
+def compare_backends(count=10000, ops=500):
+    """Deposits per second for each way of persisting the same accounts"""
+    original = BankManager.DATA_FILE
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.txt")
+        db = os.path.join(tmp, "bank_data.db")
+        generate_data_file(source, count, history_len=5)
+        start = time.perf_counter()
+        migrate(TextFileBackend(source), SqliteBackend(db))
+        results['migration_s'] = time.perf_counter() - start
+        setups = [
+            ("text file, full rewrite", lambda: BankManager()),
+            ("text file + journal", lambda: BankManager(journal=True)),
+            ("text backend", lambda: BankManager(backend=TextFileBackend(BankManager.DATA_FILE))),
+            ("sqlite backend (WAL)", lambda: BankManager(backend=SqliteBackend(db))),
+        ]
+        BankManager.DATA_FILE = os.path.join(tmp, "bank_data.txt")
+        try:
+            for name, make in setups:
+                shutil.copy(source, BankManager.DATA_FILE)
+                bank = make()
+                # Log in once per account up front so only storage is timed
+                tokens = [(str(FIRST_NUMBER + i), bank.open_session(str(FIRST_NUMBER + i),
+                                                                      str(1000 + i % 9000)))
+                          for i in range(min(count, 20))]
+                calls = iter(range(ops))
+                results[name] = summarize(timed(
+                    lambda: bank.handle_choice('3', *tokens[next(calls) % len(tokens)], "1"),
+                    budget=float('inf'), limit=ops))
+                bank.close()
+        finally:
+            BankManager.DATA_FILE = original
+    return results
+
+def option(args, name, default, kind=int):
+    """Value following name in args"""
+    if name in args and args.index(name) + 1 < len(args):
+        return kind(args[args.index(name) + 1])
+    return default
+
+def main():
+    """Run the benchmarks named on the command line"""
+    args = sys.argv[1:]
+    if '--memory' in args:
+        i = args.index('--memory')
+        count = int(args[i + 1]) if i + 1 < len(args) else 100000
+        print_memory(count)
+    elif '--suite-one' in args:
+        report = bench_size(option(args, '--suite-one', 1000), option(args, '--history', 20),
+                            option(args, '--budget', 2.0, float), option(args, '--mode', None, str))
+        print(json.dumps(report))
+    elif '--suite' in args:
+        sizes = [int(n) for n in option(args, '--sizes', "1000,100000,1000000", str).split(',')]
+        reports = run_suite(sizes, option(args, '--history', 20),
+                            option(args, '--budget', 2.0, float), option(args, '--mode', None, str))
+        print_suite(reports)
+        if '--save-baseline' in args:
+            with open(option(args, '--save-baseline', None, str), 'w') as f:
+                json.dump(reports, f, indent=1)
+        if '--baseline' in args:
+            with open(option(args, '--baseline', None, str)) as f:
+                regressions = compare_to_baseline(reports, json.load(f),
+                                                  option(args, '--tolerance', 20.0, float))
+            for count, name, was, now in regressions:
+                print(f"REGRESSION {count} accounts {name}: {was:.1f} -> {now:.1f} ops/s")
+            if regressions:
+                sys.exit(1)
+            print("No regressions against baseline")
+    elif '--backends' in args:
+        count = option(args, '--accounts', 10000)
+        results = compare_backends(count, option(args, '--ops', 500))
+        print(f"Storage backends, {count} accounts "
+              f"(text to sqlite migration took {results.pop('migration_s'):.2f} s)")
+        for name, r in results.items():
+            print(f"  {name:26} {r['ops_per_sec']:9.0f} deposits/sec   "
+                  f"p50 {r['p50_ms']:7.3f} ms   p99 {r['p99_ms']:7.3f} ms")
+    elif '--replay' in args:
+        report = replay_log(option(args, '--replay', None, str),
+                            option(args, '--data', BankManager.DATA_FILE, str),
+                            'original' if '--timed' in args else 'fast', option(args, '--workers', 1))
+        print(f"Replayed {report['operations']} operations in {report['seconds']:.2f} s: "
+              f"{report['ops_per_sec']:.0f} ops/sec, p50 {report['p50_ms']:.2f} ms "
+              f"(recorded {report['recorded_p50_ms']:.2f} ms), p95 {report['p95_ms']:.2f} ms, "
+              f"p99 {report['p99_ms']:.2f} ms, max {report['max_ms']:.2f} ms")
+        print(f"{report['outcome_mismatches']} operations ended differently")
+        for num, (expected, got) in report['balance_mismatches'].items():
+            print(f"BALANCE MISMATCH {num}: expected {expected} cents, got {got}")
+        print("Final balances match" if report['balances_match'] else "Final balances differ")
+        if not report['balances_match']:
+            sys.exit(1)
+    elif '--load' in args:
+        i = args.index('--load')
+        connections = option(args, '--connections', 8)
+        requests = option(args, '--requests', 2000)
+        pipeline = option(args, '--pipeline', 16)
+        if i + 1 < len(args) and ':' in args[i + 1]:
+            host, port = args[i + 1].rsplit(':', 1)
+            results = run_load((host, int(port)), connections, requests, pipeline)
+        else:
+            results = load_local(connections, requests, pipeline)
+        print(f"{results['requests']} requests over {connections} connections "
+              f"(pipeline {pipeline}): {results['ops_per_sec']:.0f} ops/sec, "
+              f"p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms, "
+              f"{results['errors']} errors")
+    else:
+        print(__doc__)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,28 @@
+import asyncio
+import gc
+import json
 import unittest
 import os
+import socket
+import threading
+import time
+import types
+from decimal import Decimal
+import DorjiWangchuk_02240250_A3 as bank_module
 from DorjiWangchuk_02240250_A3 import BankManager, Account, PersonalAccount, BusinessAccount
+from DorjiWangchuk_02240250_A3 import AsyncBankManager, BankServer, BankAppGUI
 from DorjiWangchuk_02240250_A3 import BankError, NotEnoughMoneyError, BadInputError
+from DorjiWangchuk_02240250_A3 import OP_ADD, OP_TAKE, OP_SENT, OP_PHONE
+from DorjiWangchuk_02240250_A3 import AccountNumberAllocator, AccountsExhaustedError, load_batch_file
+from DorjiWangchuk_02240250_A3 import TTLCache, TooManyAttemptsError, is_password_hash
+from DorjiWangchuk_02240250_A3 import StatementCache, Statement, History
+from DorjiWangchuk_02240250_A3 import MappedAccountStore, convert_text_to_binary, convert_binary_to_text
+from DorjiWangchuk_02240250_A3 import SqliteBackend, TextFileBackend, migrate
+from DorjiWangchuk_02240250_A3 import ShardedBank, ShardUnavailableError
+from DorjiWangchuk_02240250_A3 import OP_INTEREST, OP_FEE, OP_EXPIRED, HistoryArchive
+from DorjiWangchuk_02240250_A3 import replay_log, COMMANDS, Command, ACCOUNT_LOCKS
+
+BankManager.PASSWORD_ITERATIONS = 1000  # keep account setup fast in tests
 
 class TestAccountBasics(unittest.TestCase):
     """Tests for core account functionality"""
@@ -160,5 +181,1863 @@ class TestPhoneTopUp(unittest.TestCase):
         with self.assertRaises(NotEnoughMoneyError):
             self.bank.handle_choice('8', self.test_num, self.test_pwd, "2000")
 
+class TestJournal(unittest.TestCase):
+    """Tests for journaled storage mode"""
+    
+    TEST_FILE = "test_journal_data.txt"
+    
+    def setUp(self):
+        """Set up journaled test bank"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        self.bank = BankManager(journal=True)
+    
+    def tearDown(self):
+        """Clean up journal and data files"""
+        self.bank.close()
+        BankManager.DATA_FILE = self.original_file
+        for path in (self.TEST_FILE, self.TEST_FILE + ".journal",
+                     self.TEST_FILE + ".journal.old", self.TEST_FILE + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_operations_append_to_journal(self):
+        """Deposits are logged without rewriting the data file"""
+        before = os.path.getmtime(self.TEST_FILE), os.path.getsize(self.TEST_FILE)
+        self.bank.handle_choice('3', "11111", "pass1", "250")
+        after = os.path.getmtime(self.TEST_FILE), os.path.getsize(self.TEST_FILE)
+        self.assertEqual(after, before)
+        self.assertTrue(os.path.getsize(self.TEST_FILE + ".journal") > 0)
+    
+    def test_reload_replays_journal(self):
+        """A fresh manager sees journaled operations"""
+        self.bank.handle_choice('5', "11111", "pass1", "22222", "300")
+        num, pwd = self.bank.make_account("Personal")
+        self.bank.handle_choice('7', "22222", "pass2")
+        self.bank.close()
+        
+        reloaded = BankManager(journal=True)
+        self.assertEqual(reloaded.accounts["11111"].balance, 700)
+        self.assertIn(num, reloaded.accounts)
+        self.assertNotIn("22222", reloaded.accounts)
+        self.assertIn("Sent 300 to 22222", reloaded.accounts["11111"].history)
+        reloaded.close()
+    
+    def test_compaction_folds_journal(self):
+        """Passing the size threshold writes a new snapshot"""
+        self.bank.COMPACT_THRESHOLD = 1
+        self.bank.handle_choice('3', "11111", "pass1", "100")
+        self.bank.close()
+        self.assertFalse(os.path.exists(self.TEST_FILE + ".journal.old"))
+        with open(self.TEST_FILE) as f:
+            self.assertIn("|1100|", f.read())
+        
+        reloaded = BankManager(journal=True)
+        self.assertEqual(reloaded.accounts["11111"].balance, 1100)
+        reloaded.close()
+    
+    def test_compaction_renders_in_background(self):
+        """compact() returns before rendering, and writes meanwhile land in the new journal"""
+        self.bank.handle_choice('3', "11111", "pass1", "100")
+        caller = threading.current_thread()
+        rendering = threading.Event()
+        release = threading.Event()
+        real_encode = History.encode
+        def slow_encode(history):
+            if threading.current_thread() is not caller:
+                rendering.set()
+                release.wait(5)
+            return real_encode(history)
+        History.encode = slow_encode
+        try:
+            self.bank.compact()
+            self.assertTrue(rendering.wait(5))
+            self.bank.handle_choice('3', "11111", "pass1", "50")
+            self.bank.handle_choice('4', "22222", "pass2", "500")
+            release.set()
+            self.bank.close()
+        finally:
+            History.encode = real_encode
+        with open(self.TEST_FILE) as f:
+            self.assertIn("|1100|", f.read())
+        reloaded = BankManager(journal=True)
+        self.assertEqual(reloaded.accounts["11111"].balance, 1150)
+        self.assertEqual(reloaded.accounts["22222"].balance, 4500)
+        reloaded.close()
+    
+    def test_concurrent_calls_replay_in_order(self):
+        """Records for one account reach the journal in the order they were applied"""
+        for group_commit in (False, True):
+            bank = BankManager(journal=True, group_commit=group_commit)
+            applied = threading.Event()
+            deposit = bank.commands.get('3')
+            
+            def slow_deposit(bank, acc, num, amount):
+                result = deposit.action(bank, acc, num, amount)
+                applied.set()
+                time.sleep(0.05)  # a withdrawal now could be journaled first
+                return result
+            
+            bank.commands.register(Command('3', deposit.label, deposit.fields, slow_deposit))
+            worker = threading.Thread(target=bank.handle_choice, args=('3', "11111", "pass1", "500"))
+            worker.start()
+            applied.wait()
+            bank.handle_choice('4', "11111", "pass1", "1500")
+            worker.join()
+            bank.close()
+            reloaded = BankManager(journal=True)
+            self.assertEqual(reloaded.accounts["11111"].balance, 0)
+            reloaded.close()
+            os.remove(self.TEST_FILE + ".journal")
+            with open(self.TEST_FILE, 'w') as f:
+                f.write("11111|pass1|Personal|1000|0|\n")
+    
+    def test_torn_tail_ignored(self):
+        """A half-written last record is dropped on load"""
+        self.bank.handle_choice('3', "11111", "pass1", "100")
+        self.bank.close()
+        with open(self.TEST_FILE + ".journal", 'a') as f:
+            f.write("99|add|11111|5")
+        
+        reloaded = BankManager(journal=True)
+        self.assertEqual(reloaded.accounts["11111"].balance, 1100)
+        reloaded.handle_choice('3', "11111", "pass1", "1")
+        reloaded.close()
+        
+        again = BankManager(journal=True)
+        self.assertEqual(again.accounts["11111"].balance, 1101)
+        again.close()
+
+class TestDurableSaves(unittest.TestCase):
+    """Tests for atomic snapshots and group commit"""
+    
+    TEST_FILE = "test_durable_data.txt"
+    
+    def setUp(self):
+        """Set up test bank"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE = self.original_file
+        for path in (self.TEST_FILE, self.TEST_FILE + ".tmp", self.TEST_FILE + ".journal"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_failed_save_keeps_old_file(self):
+        """A crash before the rename leaves the previous data intact"""
+        bank = BankManager()
+        bank.accounts["11111"].add_money(500)
+        real_replace = os.replace
+        def crash(*args):
+            raise OSError("simulated crash")
+        os.replace = crash
+        try:
+            with self.assertRaises(OSError):
+                bank.save_data()
+        finally:
+            os.replace = real_replace
+        self.assertEqual(BankManager().accounts["11111"].balance, 1000)
+    
+    def test_group_commit_shares_flushes(self):
+        """Concurrent operations are persisted in fewer flushes"""
+        bank = BankManager(group_commit=True, max_batch=32, max_delay_ms=50)
+        nums = [str(20000 + i) for i in range(32)]
+        for num in nums:
+            bank.accounts[num] = PersonalAccount(num, "pw", 100)
+        
+        threads = [threading.Thread(target=bank.handle_choice, args=('3', num, "pw", "10"))
+                   for num in nums]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = bank.commit_stats()
+        bank.close()
+        
+        self.assertEqual(stats['durable'], 32)
+        self.assertLess(stats['flushes'], 32)
+        reloaded = BankManager()
+        self.assertEqual(sum(reloaded.accounts[n].balance for n in nums), 32 * 110)
+    
+    def test_group_commit_with_journal(self):
+        """Batched journal records replay in order"""
+        bank = BankManager(journal=True, group_commit=True)
+        bank.handle_choice('3', "11111", "pass1", "5")
+        bank.handle_choice('4', "11111", "pass1", "3")
+        bank.close()
+        reloaded = BankManager(journal=True)
+        self.assertEqual(reloaded.accounts["11111"].balance, 1002)
+        reloaded.close()
+
+class TestLazyLoading(unittest.TestCase):
+    """Tests for on-demand history loading"""
+    
+    TEST_FILE = "test_lazy_data.txt"
+    
+    def setUp(self):
+        """Set up test file with histories"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500;Took 100\n")
+            f.write("22222|pass2|Business|5000|25|Phone +25\n")
+            f.write("33333|pass3|Personal|0|0|\n")
+        self.bank = BankManager(lazy=True)
+    
+    def tearDown(self):
+        """Clean up test files"""
+        self.bank.close()
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_history_not_parsed_at_startup(self):
+        """Only the fixed fields are loaded up front"""
+        acc = self.bank.accounts["22222"]
+        self.assertEqual(acc.balance, 5000)
+        self.assertEqual(acc.phone_credit, 25)
+        self.assertFalse(acc.history_loaded)
+    
+    def test_history_read_on_access(self):
+        """Option 9 materializes history from disk"""
+        result = self.bank.handle_choice('9', "11111", "pass1")
+        self.assertEqual(result, "Added 500\nTook 100")
+        self.assertTrue(self.bank.accounts["11111"].history_loaded)
+        self.assertEqual(self.bank.accounts["33333"].history, [])
+    
+    def test_save_keeps_unread_history(self):
+        """Saving copies unread histories and keeps them readable"""
+        self.bank.handle_choice('3', "33333", "pass3", "10")
+        self.assertFalse(self.bank.accounts["22222"].history_loaded)
+        self.assertEqual(self.bank.accounts["22222"].history, ["Phone +25"])
+        self.assertEqual(BankManager().accounts["11111"].history, ["Added 500", "Took 100"])
+
+class TestColumnarStore(unittest.TestCase):
+    """Tests for the compact array-backed account store"""
+    
+    TEST_FILE = "test_columnar_data.txt"
+    
+    def setUp(self):
+        """Set up columnar test bank"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        self.bank = BankManager(columnar=True)
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_views_behave_like_accounts(self):
+        """Account methods work through store views"""
+        acc = self.bank.login("11111", "pass1")
+        acc.send_money(300, self.bank.accounts["22222"])
+        self.assertEqual(self.bank.accounts["11111"].balance, 700)
+        self.assertEqual(self.bank.accounts["22222"].balance, 5300)
+        self.assertEqual(list(self.bank.accounts["11111"].history),
+                         ["Added 500", "Took 300", "Sent 300 to 22222"])
+        self.assertEqual(self.bank.accounts["22222"].type, "Business")
+    
+    def test_operations_round_trip(self):
+        """Columnar data saves and reloads in the normal format"""
+        num, pwd = self.bank.make_account("Business")
+        self.bank.handle_choice('3', num, pwd, "40")
+        self.bank.handle_choice('7', "22222", "pass2")
+        reloaded = BankManager()
+        self.assertEqual(reloaded.accounts[num].balance, 40)
+        self.assertEqual(reloaded.accounts[num].history, ["Added 40"])
+        self.assertNotIn("22222", reloaded.accounts)
+    
+    def test_vacuum_keeps_data(self):
+        """Vacuum shrinks the arena without losing live entries"""
+        store = self.bank.accounts
+        store["22222"].history = ["Added 1"] * 10
+        del store["22222"]
+        before = len(store._hist_arena)
+        store.vacuum()
+        self.assertLess(len(store._hist_arena), before)
+        self.assertEqual(list(store["11111"].history), ["Added 500"])
+
+class TestStructuredHistory(unittest.TestCase):
+    """Tests for typed, binary-encoded transaction history"""
+    
+    TEST_FILE = "test_history_data.txt"
+    
+    def setUp(self):
+        """Set up test file with legacy text history"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500.0;Sent 50 to 22222;Phone +25.5\n")
+            f.write("22222|pass2|Business|5000|0|Got 50 from 11111\n")
+        self.bank = BankManager()
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_legacy_text_migrates(self):
+        """Old text entries load as typed records"""
+        records = list(self.bank.accounts["11111"].history.records())
+        self.assertEqual([r.op for r in records], [OP_ADD, OP_SENT, OP_PHONE])
+        self.assertEqual(records[1].amount, 5000)
+        self.assertEqual(records[1].counterparty, 22222)
+        self.assertEqual(records[2].seq, 3)
+        self.assertEqual(list(self.bank.accounts["11111"].history),
+                         ["Added 500", "Sent 50 to 22222", "Phone +25.50"])
+    
+    def test_saved_as_binary(self):
+        """History is written in the packed format and reads back the same"""
+        self.bank.handle_choice('3', "22222", "pass2", "12.25")
+        with open(self.TEST_FILE) as f:
+            self.assertNotIn("Added", f.read())
+        history = BankManager().accounts["22222"].history
+        self.assertEqual(list(history), ["Got 50 from 11111", "Added 12.25"])
+        self.assertGreater(history.page(1)[0].timestamp, 0)
+    
+    def test_history_paging(self):
+        """Option 9 can return one page of history"""
+        result = self.bank.handle_choice('9', "11111", "pass1", "1", "1")
+        self.assertEqual(result, "Sent 50 to 22222")
+        result = self.bank.handle_choice('9', "11111", "pass1", "5", "10")
+        self.assertEqual(result, "No transactions")
+
+class TestAccountNumbers(unittest.TestCase):
+    """Tests for the account number allocator"""
+    
+    def test_allocates_whole_range_once(self):
+        """Every number in the range comes out exactly once"""
+        allocator = AccountNumberAllocator(100, 199)
+        allocator.reserve(150)
+        numbers = allocator.allocate_many(99)
+        self.assertEqual(sorted(numbers), [n for n in range(100, 200) if n != 150])
+        with self.assertRaises(AccountsExhaustedError):
+            allocator.allocate()
+    
+    def test_bulk_checks_space_first(self):
+        """A bulk request that can't be met takes nothing"""
+        allocator = AccountNumberAllocator(1, 10)
+        with self.assertRaises(AccountsExhaustedError):
+            allocator.allocate_many(11)
+        self.assertEqual(allocator.available(), 10)
+    
+    def test_released_numbers_reused(self):
+        """Deleted accounts free their numbers"""
+        allocator = AccountNumberAllocator(1, 3)
+        first = allocator.allocate_many(3)
+        allocator.release(first[0])
+        self.assertEqual(allocator.allocate(), first[0])
+    
+    def test_reserving_drawn_numbers(self):
+        """Reserving a number already handed out keeps the count right"""
+        allocator = AccountNumberAllocator(1, 10)
+        drawn = allocator.allocate_many(4)
+        for num in drawn:
+            allocator.reserve(num)
+        self.assertEqual(allocator.available(), 6)
+        allocator.release(drawn[0])
+        allocator.reserve(drawn[0])
+        self.assertEqual(allocator.available(), 6)
+        rest = allocator.allocate_many(6)
+        self.assertEqual(sorted(drawn + rest), list(range(1, 11)))
+    
+    def test_manager_uses_configured_range(self):
+        """make_account draws from ACCOUNT_NUMBER_RANGE"""
+        original = BankManager.DATA_FILE
+        BankManager.DATA_FILE = "test_numbers_data.txt"
+        try:
+            bank = BankManager()
+            bank.ACCOUNT_NUMBER_RANGE = (1000000, 1000001)
+            nums = {bank.make_account("Personal")[0] for _ in range(2)}
+            self.assertEqual(nums, {"1000000", "1000001"})
+            with self.assertRaises(AccountsExhaustedError):
+                bank.make_account("Personal")
+        finally:
+            BankManager.DATA_FILE = original
+            if os.path.exists("test_numbers_data.txt"):
+                os.remove("test_numbers_data.txt")
+
+class TestBatchOperations(unittest.TestCase):
+    """Tests for bulk opening and posting"""
+    
+    TEST_FILE = "test_batch_data.txt"
+    
+    def setUp(self):
+        """Set up test bank"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        self.bank = BankManager()
+        self.saves = 0
+        real_save = self.bank.save_data
+        def counting_save():
+            self.saves += 1
+            real_save()
+        self.bank.save_data = counting_save
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE = self.original_file
+        for path in (self.TEST_FILE, "test_batch.csv"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_open_and_fund_persists_once(self):
+        """Opening and funding many accounts writes the file once"""
+        rows = [{'op': 'open', 'type': 'Business', 'ref': f"c{i}"} for i in range(50)]
+        rows += [{'op': 'deposit', 'account': f"@c{i}", 'amount': '100'} for i in range(50)]
+        results = self.bank.run_batch(rows)
+        self.assertTrue(all(res.ok for res in results))
+        self.assertEqual(self.saves, 1)
+        self.assertEqual(len(BankManager().accounts), 52)
+    
+    def test_atomic_batch_rolls_back(self):
+        """One bad row undoes the whole batch"""
+        rows = [
+            {'op': 'open', 'type': 'Personal'},
+            {'op': 'deposit', 'account': '11111', 'password': 'pass1', 'amount': '50'},
+            {'op': 'withdraw', 'account': '22222', 'password': 'pass2', 'amount': '9999'},
+        ]
+        results = self.bank.run_batch(rows)
+        self.assertFalse(any(res.ok for res in results))
+        self.assertIn("Not enough", results[2].error)
+        self.assertEqual(self.bank.accounts["11111"].balance, 1000)
+        self.assertEqual(len(self.bank.accounts["11111"].history), 0)
+        self.assertEqual(len(self.bank.accounts), 2)
+        self.assertEqual(self.saves, 0)
+    
+    def test_best_effort_keeps_good_rows(self):
+        """Best-effort mode applies the rows that pass"""
+        rows = [
+            {'op': 'transfer', 'account': '11111', 'password': 'pass1', 'to': '22222', 'amount': '10'},
+            {'op': 'deposit', 'account': '11111', 'password': 'wrong', 'amount': '50'},
+            {'op': 'deposit', 'account': '22222', 'password': 'pass2', 'amount': 'abc'},
+        ]
+        results = self.bank.run_batch(rows, atomic=False)
+        self.assertEqual([res.ok for res in results], [True, False, False])
+        self.assertEqual(results[0].value, 990)
+        self.assertEqual(self.bank.accounts["22222"].balance, 5010)
+    
+    def test_best_effort_failed_open(self):
+        """Rows naming the ref of an open that failed fail on their own"""
+        def exhausted(count):
+            raise AccountsExhaustedError("No account numbers left")
+        self.bank.allocator.allocate_many = exhausted
+        rows = [
+            {'op': 'open', 'type': 'Personal', 'ref': 'a'},
+            {'op': 'deposit', 'account': '@a', 'amount': '50'},
+            {'op': 'transfer', 'account': '11111', 'password': 'pass1', 'to': '@a', 'amount': '5'},
+            {'op': 'deposit', 'account': '22222', 'password': 'pass2', 'amount': '10'},
+        ]
+        results = self.bank.run_batch(rows, atomic=False)
+        self.assertEqual([res.ok for res in results], [False, False, False, True])
+        self.assertIn("@a", results[1].error)
+        self.assertEqual(self.bank.accounts["11111"].balance, 1000)
+        self.assertEqual(self.bank.accounts["22222"].balance, 5010)
+    
+    def test_csv_loader(self):
+        """Batch rows can come from a CSV file"""
+        with open("test_batch.csv", 'w') as f:
+            f.write("op,account,password,amount\n")
+            f.write("deposit,11111,pass1,25\n")
+        results = self.bank.run_batch(load_batch_file("test_batch.csv"))
+        self.assertTrue(results[0].ok)
+        self.assertEqual(self.bank.accounts["11111"].balance, 1025)
+
+class TestConcurrency(unittest.TestCase):
+    """Stress tests for per-account locking"""
+    
+    TEST_FILE = "test_threads_data.txt"
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE = getattr(self, 'original_file', BankManager.DATA_FILE)
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def run_threads(self, target, count):
+        """Start count threads on target(i) and wait for all of them"""
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    
+    def test_no_overdraw(self):
+        """Racing withdrawals never take more than the balance"""
+        acc = Account("12345", "pw", "Test", 1000)
+        done = []
+        def withdraw(i):
+            try:
+                acc.take_money(10)
+                done.append(i)
+            except NotEnoughMoneyError:
+                pass
+        self.run_threads(withdraw, 300)
+        self.assertEqual(len(done), 100)
+        self.assertEqual(acc.balance, 0)
+    
+    def test_transfers_conserve_money(self):
+        """Thousands of concurrent transfers keep the total balance"""
+        accounts = [Account(str(10000 + i), "pw", "Test", 1000) for i in range(10)]
+        def transfer(i):
+            src = accounts[i % 10]
+            dst = accounts[(i * 7 + 3) % 10]
+            for _ in range(5):
+                try:
+                    src.send_money(50, dst)
+                except NotEnoughMoneyError:
+                    pass
+                src, dst = dst, src
+        self.run_threads(transfer, 2000)
+        self.assertEqual(sum(acc.balance for acc in accounts), 10000)
+        self.assertTrue(all(acc.balance >= 0 for acc in accounts))
+        sent = sum(1 for acc in accounts for r in acc.history.records() if r.op == OP_SENT)
+        added = sum(1 for acc in accounts for r in acc.history.records() if r.op == OP_ADD)
+        self.assertEqual(sent, added)
+    
+    def test_manager_threads_columnar(self):
+        """Concurrent handle_choice transfers on the columnar store"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            for i in range(20):
+                f.write(f"{20000 + i}|pw|Personal|500|0|\n")
+        bank = BankManager(columnar=True, group_commit=True)
+        def transfer(i):
+            try:
+                bank.handle_choice('5', str(20000 + i % 20), "pw", str(20000 + (i + 1) % 20), "30")
+            except NotEnoughMoneyError:
+                pass
+        self.run_threads(transfer, 1000)
+        bank.close()
+        reloaded = BankManager()
+        self.assertEqual(sum(acc.balance for acc in reloaded.accounts.values()), 10000)
+
+class TestAsyncFrontEnd(unittest.TestCase):
+    """Tests for the asyncio front end"""
+    
+    TEST_FILE = "test_async_data.txt"
+    
+    def setUp(self):
+        """Set up test bank with a slow disk"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            for i in range(20):
+                f.write(f"{30000 + i}|pw|Personal|100|0|\n")
+        self.bank = BankManager()
+        real_persist = self.bank._persist
+        def slow_persist(records):
+            time.sleep(0.05)
+            real_persist(records)
+        self.bank._persist = slow_persist
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_concurrent_writes_coalesce(self):
+        """Many awaiting deposits share a few flushes"""
+        async def scenario():
+            front = AsyncBankManager(self.bank)
+            await asyncio.gather(*(front.deposit(str(30000 + i), "pw", "10") for i in range(20)))
+            await front.close()
+            return front.flushes
+        flushes = asyncio.run(scenario())
+        self.assertLess(flushes, 20)
+        reloaded = BankManager()
+        self.assertEqual(sum(acc.balance for acc in reloaded.accounts.values()), 2200)
+    
+    def test_reads_skip_write_queue(self):
+        """Balance reads answer while a flush is still running"""
+        async def scenario():
+            front = AsyncBankManager(self.bank)
+            write = asyncio.ensure_future(front.transfer("30000", "pw", "30001", "40"))
+            await asyncio.sleep(0.01)
+            start = time.monotonic()
+            balance = await front.balance("30001", "pw")
+            waited = time.monotonic() - start
+            done = write.done()
+            await write
+            history = await front.history("30000", "pw")
+            await front.close()
+            return balance, waited, done, history
+        balance, waited, done, history = asyncio.run(scenario())
+        self.assertFalse(done)
+        self.assertLess(waited, 0.04)
+        self.assertIn("Balance: 140", balance)
+        self.assertIn("Sent 40 to 30001", history)
+    
+    def test_reads_leave_the_loop_free(self):
+        """Password checks for reads run on the worker threads"""
+        threads = []
+        real_login = self.bank.login
+        def login(num, pwd):
+            threads.append(threading.current_thread())
+            return real_login(num, pwd)
+        self.bank.login = login
+        async def scenario():
+            front = AsyncBankManager(self.bank)
+            try:
+                return await front.balance("30000", "pw")
+            finally:
+                await front.close()
+        self.assertIn("Balance: 100", asyncio.run(scenario()))
+        self.assertNotIn(threading.main_thread(), threads)
+    
+    def test_calls_go_through_middleware(self):
+        """Async writes and reads are timed and recorded like handle_choice"""
+        log = self.TEST_FILE + ".log"
+        bank = BankManager(metrics=True, record=log)
+        async def scenario():
+            front = AsyncBankManager(bank)
+            try:
+                await front.deposit("30000", "pw", "5")
+                return await front.balance("30000", "pw")
+            finally:
+                await front.close()
+        self.assertIn("Balance: 105", asyncio.run(scenario()))
+        bank.close()
+        stats = json.loads(bank.stats('json'))
+        self.assertEqual(stats['operations']['option_3']['count'], 1)
+        self.assertEqual(stats['operations']['option_6']['count'], 1)
+        with open(log) as f:
+            calls = [json.loads(line) for line in f]
+        os.remove(log)
+        self.assertEqual([call.get('o') for call in calls[:2]], ['3', '6'])
+    
+    def test_errors_propagate(self):
+        """Bank errors surface from awaited calls"""
+        async def scenario():
+            front = AsyncBankManager(self.bank)
+            try:
+                await front.withdraw("30000", "pw", "1000")
+            finally:
+                await front.close()
+        with self.assertRaises(NotEnoughMoneyError):
+            asyncio.run(scenario())
+
+class TestServer(unittest.TestCase):
+    """Tests for the JSON-lines service mode"""
+    
+    TEST_FILE = "test_server_data.txt"
+    
+    def setUp(self):
+        """Start a server on a free port"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+        self.server = BankServer(BankManager(), workers=4)
+        self.sock = socket.create_connection(self.server.start())
+        self.reader = self.sock.makefile('rb')
+    
+    def tearDown(self):
+        """Stop server and clean up"""
+        self.reader.close()
+        self.sock.close()
+        self.server.stop()
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def send(self, *requests):
+        """Pipeline raw request lines and read one reply per line"""
+        self.sock.sendall("".join(line + "\n" for line in requests).encode())
+        return [json.loads(self.reader.readline()) for _ in requests]
+    
+    def test_pipelined_replies_in_order(self):
+        """Replies come back in request order with latency"""
+        requests = [json.dumps({'id': i, 'op': '3', 'args': ["11111", "pass1", 1]})
+                    for i in range(20)]
+        requests.append(json.dumps({'id': 'bal', 'op': '6', 'args': ["11111", "pass1"]}))
+        replies = self.send(*requests)
+        self.assertEqual([r['id'] for r in replies], list(range(20)) + ['bal'])
+        self.assertTrue(all(r['ok'] for r in replies))
+        self.assertIn("Balance: 1020", replies[-1]['result'])
+        self.assertIn('ms', replies[0])
+    
+    def test_errors_keep_connection(self):
+        """Bad requests get an error reply and the connection stays usable"""
+        replies = self.send("not json",
+                            json.dumps({'id': 1, 'op': '4', 'args': ["11111", "pass1", 5000]}),
+                            json.dumps({'id': 2, 'op': '2', 'args': ["11111", "pass1"]}))
+        self.assertEqual(replies[0]['error'], "Bad request")
+        self.assertEqual(replies[1]['error'], "Not enough funds")
+        self.assertTrue(replies[2]['ok'])
+        self.assertEqual(self.server.stats()['errors'], 2)
+
+class TestMetrics(unittest.TestCase):
+    """Tests for operation instrumentation"""
+    
+    TEST_FILE = "test_metrics_data.txt"
+    
+    def setUp(self):
+        """Set up test bank with metrics on"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500\n")
+        self.events = []
+        self.bank = BankManager(metrics=True, hooks=[
+            lambda name, ms, info: self.events.append((name, info))])
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_hooks_see_operations(self):
+        """Hooks get load, option and save events"""
+        self.bank.handle_choice('3', "11111", "pass1", "5")
+        names = [name for name, _ in self.events]
+        self.assertEqual(names, ['load_data', 'save_data', 'option_3'])
+        save_info = self.events[1][1]
+        self.assertEqual(save_info['bytes'], os.path.getsize(self.TEST_FILE))
+        self.assertEqual(save_info['history_lengths'], [2])
+    
+    def test_stats_dump(self):
+        """Stats count calls and errors in text and JSON"""
+        self.bank.handle_choice('6', "11111", "pass1")
+        with self.assertRaises(BankError):
+            self.bank.handle_choice('4', "11111", "pass1", "99999")
+        stats = json.loads(self.bank.stats('json'))
+        self.assertEqual(stats['operations']['option_4']['errors'], 1)
+        self.assertEqual(stats['operations']['option_6']['count'], 1)
+        self.assertIn("option_6", self.bank.stats())
+    
+    def test_metrics_alone_time_options(self):
+        """metrics=True with no other hooks still times every option"""
+        bank = BankManager(metrics=True)
+        bank.handle_choice('3', "11111", "pass1", "5")
+        stats = json.loads(bank.stats('json'))
+        self.assertEqual(stats['operations']['option_3']['count'], 1)
+    
+    def test_off_by_default(self):
+        """No hooks means no metrics"""
+        bank = BankManager()
+        self.assertEqual(bank.hooks, [])
+        self.assertEqual(bank.stats(), "Metrics are off")
+
+class TestCredentials(unittest.TestCase):
+    """Tests for hashed passwords, sessions and login limits"""
+    
+    TEST_FILE = "test_credentials_data.txt"
+    
+    def setUp(self):
+        """Set up test bank with a legacy plaintext password"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+        self.bank = BankManager()
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_new_accounts_store_hashes(self):
+        """Only the hash of a new password reaches the data file"""
+        num, pwd = self.bank.make_account("Personal")
+        self.assertTrue(is_password_hash(self.bank.accounts[num].password))
+        with open(self.TEST_FILE) as f:
+            self.assertNotIn(f"{num}|{pwd}|", f.read())
+        self.assertEqual(BankManager().login(num, pwd).number, num)
+    
+    def test_legacy_password_upgraded(self):
+        """A plaintext password is rehashed on its first good login"""
+        self.bank.login("11111", "pass1")
+        self.assertTrue(is_password_hash(self.bank.accounts["11111"].password))
+        self.bank.handle_choice('3', "11111", "pass1", "5")
+        self.assertEqual(BankManager().login("11111", "pass1").balance, 1005)
+    
+    def test_session_token(self):
+        """A session token works in place of the password until closed"""
+        token = self.bank.open_session("11111", "pass1")
+        self.assertIn("Balance: 1000", self.bank.handle_choice('6', "11111", token))
+        with self.assertRaises(BankError):
+            self.bank.login("22222", token)
+        self.bank.close_session(token)
+        with self.assertRaises(BankError):
+            self.bank.login("11111", token)
+    
+    def test_cache_expiry(self):
+        """Entries expire ttl seconds after being stored"""
+        now = [0.0]
+        cache = TTLCache(10, clock=lambda: now[0])
+        cache.put("a", 1)
+        now[0] = 5
+        cache.put("b", 2)
+        now[0] = 12
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(len(cache), 1)
+    
+    def test_rate_limit(self):
+        """Repeated failures lock the account, even for the right password"""
+        for _ in range(BankManager.LOGIN_MAX_FAILURES):
+            with self.assertRaises(BankError):
+                self.bank.login("11111", "wrong")
+        with self.assertRaises(TooManyAttemptsError):
+            self.bank.login("11111", "pass1")
+    
+    def test_delete_ends_sessions(self):
+        """Deleting an account revokes its session tokens"""
+        token = self.bank.open_session("11111", "pass1")
+        self.bank.handle_choice('7', "11111", token)
+        self.assertEqual(len(self.bank._sessions), 0)
+
+class TestStatementCache(unittest.TestCase):
+    """Tests for cached history views"""
+    
+    TEST_FILE = "test_statement_data.txt"
+    
+    def setUp(self):
+        """Set up test bank with some history"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500;Took 20\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        self.bank = BankManager()
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_updates_incrementally(self):
+        """New transactions are added to the cached statement"""
+        self.assertEqual(self.bank.handle_choice('9', "11111", "pass1"), "Added 500\nTook 20")
+        self.bank.handle_choice('3', "11111", "pass1", "30")
+        self.assertEqual(self.bank.handle_choice('9', "11111", "pass1", "2"), "Added 30")
+        self.assertEqual(self.bank.handle_choice('9', "11111", "pass1"), "Added 500\nTook 20\nAdded 30")
+        statement = self.bank.statement("11111")
+        self.assertEqual(statement.totals[OP_ADD], 53000)
+        self.assertEqual(statement.totals[OP_TAKE], 2000)
+        self.assertEqual(self.bank._statements.misses, 1)
+    
+    def test_text_extended_in_place(self):
+        """Reading after a write only joins the new lines"""
+        statement = Statement()
+        self.assertEqual(statement.text, "")
+        statement.add(History(["Added 5", "Took 1"]).page())
+        self.assertEqual(statement.text, "Added 5\nTook 1")
+        statement.lines[0] = "changed"  # not re-joined from here on
+        statement.add(History(["Added 2"]).page())
+        self.assertEqual(statement.text, "Added 5\nTook 1\nAdded 2")
+    
+    def test_rolled_back_history(self):
+        """A statement is rebuilt when its history is cut back"""
+        self.bank.statement("11111")
+        self.bank.run_batch([
+            {'op': 'deposit', 'account': '11111', 'password': 'pass1', 'amount': '5'},
+            {'op': 'withdraw', 'account': '22222', 'password': 'pass2', 'amount': '99999'},
+        ])
+        self.bank.accounts["11111"].add_money(7)
+        self.assertEqual(self.bank.statement("11111").lines[-1], "Added 7")
+        self.assertEqual(len(self.bank.statement("11111").lines), 3)
+    
+    def test_lru_memory_cap(self):
+        """The least recently read statements go first"""
+        cache = StatementCache(max_bytes=300)
+        histories = [History(["Added 5"] * 2) for _ in range(3)]
+        for i, history in enumerate(histories):
+            cache.get(i, history)
+        self.assertLessEqual(cache.size, 300)
+        self.assertEqual(len(cache), 2)
+        cache.get(1, histories[1])
+        cache.get(0, histories[0])
+        self.assertEqual(list(cache._entries), [1, 0])
+    
+    def test_columnar_history(self):
+        """Statements read only new records from the arena"""
+        bank = BankManager(columnar=True)
+        bank.statement("11111")
+        bank.accounts["11111"].take_money(1)
+        self.assertEqual(bank.statement("11111").lines, ["Added 500", "Took 20", "Took 1"])
+
+class TestMoney(unittest.TestCase):
+    """Tests for exact money amounts"""
+    
+    TEST_FILE = "test_money_data.txt"
+    
+    def setUp(self):
+        """Set up test bank from a float-formatted file"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|651.0|0.0|\n")
+            f.write("22222|pass2|Business|300.00000000000006|12.5|\n")
+        self.bank = BankManager()
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_float_files_load(self):
+        """Old float balances load as exact amounts"""
+        self.assertEqual(self.bank.accounts["11111"].balance, Decimal("651"))
+        self.assertEqual(self.bank.accounts["22222"].balance, Decimal("300"))
+        self.assertEqual(self.bank.accounts["22222"].phone_credit, Decimal("12.5"))
+        self.bank.save_data()
+        with open(self.TEST_FILE) as f:
+            self.assertIn("22222|pass2|Business|300|12.50|", f.read())
+    
+    def test_no_drift(self):
+        """Many small transfers add up exactly"""
+        acc = self.bank.accounts["11111"]
+        for _ in range(1000):
+            acc.send_money("0.1", self.bank.accounts["22222"])
+        self.bank.handle_choice('5', "11111", "pass1", "22222", "0.1")
+        self.assertEqual(acc.balance, Decimal("550.9"))
+        self.assertEqual(self.bank.total_balance(), Decimal("951"))
+        self.assertEqual(BankManager().accounts["22222"].balance, Decimal("400.1"))
+    
+    def test_bad_amounts(self):
+        """Text, NaN and amounts below a cent are rejected"""
+        for amount in ("abc", "nan", "0.001"):
+            with self.assertRaises(BadInputError):
+                self.bank.handle_choice('3', "11111", "pass1", amount)
+        self.assertIn("New balance: 651.01", self.bank.handle_choice('3', "11111", "pass1", "0.01"))
+    
+    def test_amount_limits(self):
+        """Amounts and balances past 64-bit cents are refused before anything changes"""
+        acc = self.bank.accounts["11111"]
+        for amount in ("1e17", "-1e17", 10 ** 17):
+            with self.assertRaises(BadInputError):
+                self.bank.handle_choice('3', "11111", "pass1", amount)
+        self.bank.handle_choice('3', "11111", "pass1", "90000000000000000")
+        with self.assertRaises(BadInputError):
+            self.bank.handle_choice('3', "11111", "pass1", "90000000000000000")
+        with self.assertRaises(BadInputError):
+            self.bank.accounts["22222"].send_money("90000000000000000", acc)
+        self.assertEqual(acc.balance, Decimal("90000000000000651"))
+        self.assertEqual(len(acc.history), 1)
+        self.assertEqual(self.bank.accounts["22222"].balance, Decimal("300"))
+
+class TestBinaryStorage(unittest.TestCase):
+    """Tests for the memory-mapped binary data file"""
+    
+    TEST_FILE = "test_binary_data.txt"
+    BINARY_FILE = "test_binary_data.bin"
+    
+    def setUp(self):
+        """Set up a text file to convert"""
+        self.original_files = BankManager.DATA_FILE, BankManager.BINARY_FILE
+        BankManager.DATA_FILE, BankManager.BINARY_FILE = self.TEST_FILE, self.BINARY_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500\n")
+            f.write("22222|pass2|Business|5000|2.5|\n")
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE, BankManager.BINARY_FILE = self.original_files
+        for path in (self.TEST_FILE, self.BINARY_FILE, self.BINARY_FILE + ".idx",
+                     self.BINARY_FILE + ".hist", self.TEST_FILE + ".back"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_changes_survive_reopen(self):
+        """Updates made in place are there after reopening"""
+        bank = BankManager(binary=True)
+        bank.handle_choice('5', "11111", "pass1", "22222", "300")
+        num, pwd = bank.make_account("Business")
+        bank.handle_choice('7', "22222", "pass2")
+        bank.close()
+        reopened = BankManager(binary=True)
+        self.assertEqual(sorted(reopened.accounts), sorted(["11111", num]))
+        self.assertEqual(reopened.accounts["11111"].balance, 700)
+        self.assertEqual(list(reopened.accounts["11111"].history)[-1], "Sent 300 to 22222")
+        self.assertEqual(reopened.login(num, pwd).type, "Business")
+        reopened.close()
+    
+    def test_round_trip(self):
+        """Text to binary and back gives the same accounts"""
+        self.assertEqual(convert_text_to_binary(self.TEST_FILE, self.BINARY_FILE), 2)
+        convert_binary_to_text(self.BINARY_FILE, self.TEST_FILE + ".back")
+        with open(self.TEST_FILE + ".back") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[1], "22222|pass2|Business|5000|2.50|")
+        self.assertEqual(History.from_field(lines[0].split('|')[5]), ["Added 500"])
+    
+    def test_growth_and_index_rebuild(self):
+        """The file and index grow, and a lost index is rebuilt"""
+        store = MappedAccountStore(self.BINARY_FILE, capacity=4)
+        for num in range(10000, 13000):
+            store[str(num)] = PersonalAccount(str(num), "pw", num)
+        del store["10005"]
+        store.close()
+        os.remove(self.BINARY_FILE + ".idx")
+        store = MappedAccountStore(self.BINARY_FILE)
+        self.assertEqual(len(store), 2999)
+        self.assertNotIn("10005", store)
+        self.assertEqual(store["12999"].balance, 12999)
+        store.close()
+    
+    def test_lookups_during_index_rebuild(self):
+        """Lookups keep working while the index grows, and rebuild_index waits for the accounts"""
+        store = MappedAccountStore(self.BINARY_FILE, capacity=4)
+        store["10000"] = PersonalAccount("10000", "pw", 5)
+        misses = []
+        done = threading.Event()
+        
+        def look():
+            while not done.is_set():
+                try:
+                    if store["10000"].balance != 5:
+                        misses.append("balance")
+                except (KeyError, ValueError) as e:  # ValueError: a closed map
+                    misses.append(e)
+        
+        reader = threading.Thread(target=look)
+        reader.start()
+        try:
+            for num in range(10001, 14000):
+                store[str(num)] = PersonalAccount(str(num), "pw", 1)
+        finally:
+            done.set()
+            reader.join()
+        self.assertEqual(misses, [])
+        
+        with store.locks.holding("12345"):
+            rebuild = threading.Thread(target=store.rebuild_index)
+            rebuild.start()
+            rebuild.join(0.2)
+            self.assertTrue(rebuild.is_alive())
+        rebuild.join()
+        self.assertEqual(store["13999"].balance, 1)
+        store.close()
+
+class TestStorageBackends(unittest.TestCase):
+    """Tests for pluggable storage backends"""
+    
+    TEST_FILE = "test_backend_data.txt"
+    DB_FILE = "test_backend_data.db"
+    
+    def setUp(self):
+        """Set up a text file and migrate it to SQLite"""
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|Added 500\n")
+            f.write("22222|pass2|Business|5000|2.5|\n")
+        self.assertEqual(migrate(TextFileBackend(self.TEST_FILE), SqliteBackend(self.DB_FILE)), 2)
+    
+    def tearDown(self):
+        """Clean up test files"""
+        for path in (self.TEST_FILE, self.TEST_FILE + ".back", self.DB_FILE,
+                     self.DB_FILE + "-wal", self.DB_FILE + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_sqlite_operations_persist(self):
+        """Each operation is stored as its own small transaction"""
+        bank = BankManager(backend=SqliteBackend(self.DB_FILE))
+        bank.handle_choice('5', "11111", "pass1", "22222", "300")
+        num, pwd = bank.make_account("Personal")
+        bank.handle_choice('7', "22222", "pass2")
+        bank.close()
+        backend = SqliteBackend(self.DB_FILE)
+        mode = backend._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        self.assertIsNone(backend.load_account("22222"))
+        acc = backend.load_account("11111")
+        self.assertEqual(acc.balance, 700)
+        self.assertEqual(list(acc.history), ["Added 500", "Took 300", "Sent 300 to 22222"])
+        self.assertEqual(sorted(a.number for a in backend.load_accounts()), sorted(["11111", num]))
+        backend.close()
+    
+    def test_migrate_back_to_text(self):
+        """SQLite data copies back into an equivalent text file"""
+        migrate(SqliteBackend(self.DB_FILE), TextFileBackend(self.TEST_FILE + ".back"))
+        path = self.TEST_FILE + ".back"
+        bank = BankManager(backend=TextFileBackend(path))
+        self.assertEqual(bank.accounts["22222"].phone_credit, 2.5)
+        bank.handle_choice('3', "11111", "pass1", "1")
+        self.assertEqual(list(TextFileBackend(path).load_account("11111").history),
+                         ["Added 500", "Added 1"])
+
+class TestShards(unittest.TestCase):
+    """Tests for sharded mode and two-phase transfers"""
+    
+    BASE = "test_shard_data"
+    
+    def setUp(self):
+        """Put 11111 on shard 1 and 22222 on shard 0"""
+        self.tearDown()
+        with open(self.BASE + ".shard0.txt", 'w') as f:
+            f.write("22222|pass2|Business|5000|0|\n")
+        with open(self.BASE + ".shard1.txt", 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+    
+    def tearDown(self):
+        """Clean up test files"""
+        for name in os.listdir("."):
+            if name.startswith(self.BASE):
+                os.remove(name)
+    
+    def open(self):
+        return ShardedBank(shards=2, data_file=self.BASE + ".txt")
+    
+    def test_cross_shard_transfer(self):
+        """Money moves between shards and the total stays the same"""
+        bank = self.open()
+        self.assertEqual(bank.handle_choice('5', "11111", "pass1", "22222", "300"),
+                         "Sent 300 to 22222")
+        with self.assertRaises(NotEnoughMoneyError):
+            bank.transfer("11111", "pass1", "22222", "5000")
+        num = bank.handle_choice('1', "Personal").split()[4]
+        self.assertEqual(bank.total_balance(), 6000)
+        self.assertEqual(bank._call(bank.shard_of(num), 'numbers').count(num), 1)
+        bank.close()
+        bank = self.open()
+        self.assertIn("5300", bank.handle_choice('6', "22222", "pass2"))
+        self.assertIn("700", bank.handle_choice('6', "11111", "pass1"))
+        self.assertEqual(bank._call(1, 'pending'), {})
+        bank.close()
+    
+    def test_bad_requests_leave_no_trace(self):
+        """Bad types and passwords are refused before anything is journaled or allocated"""
+        bank = self.open()
+        try:
+            message = bank.handle_choice('1', "personal")
+            self.assertTrue(message.startswith("New Personal account"))
+            num = message.split()[4]
+            self.assertIn("Personal", bank._call(bank.shard_of(num), 'handle_choice', '2', num, message.split()[6]))
+            free = bank.allocator.available()
+            with self.assertRaises(BadInputError):
+                bank.handle_choice('1', "Savings")
+            real_call = bank._call
+            def failing_call(i, method, *args):
+                if method == 'make_account':
+                    raise BankError("Disk full")
+                return real_call(i, method, *args)
+            bank._call = failing_call
+            with self.assertRaises(BankError):
+                bank.handle_choice('1', "Business")
+            bank._call = real_call
+            self.assertEqual(bank.allocator.available(), free)
+            
+            with self.assertRaises(BankError):
+                bank.transfer("11111", "wrong", "22222", "100")
+        finally:
+            bank.close()
+        for name in os.listdir("."):
+            if name.startswith(self.BASE + ".shard0"):
+                with open(name) as f:
+                    self.assertNotIn("expect", f.read())
+    
+    def test_recovery_after_crash(self):
+        """Undecided transfers are cancelled and decided ones settled on restart"""
+        bank = self.open()
+        bank._call(0, 'prepare_credit', "t1", "22222", 10000, "11111")
+        bank._call(1, 'prepare_debit', "t1", "11111", "pass1", "100", "22222")
+        bank._call(0, 'prepare_credit', "t2", "22222", 20000, "11111")
+        bank._call(1, 'prepare_debit', "t2", "11111", "pass1", "200", "22222")
+        self.assertEqual(bank.total_balance(), 6000)
+        bank._log_line("t2 commit\n", sync=True)
+        for worker in bank._workers:
+            worker.kill()
+        bank = self.open()
+        self.assertEqual(bank._call(0, 'pending'), {})
+        self.assertEqual(bank._call(1, 'pending'), {})
+        self.assertIn("800", bank.handle_choice('6', "11111", "pass1"))
+        self.assertIn("5200", bank.handle_choice('6', "22222", "pass2"))
+        bank.close()
+    
+    def test_worker_restart(self):
+        """A dead shard reports unavailable once and then works again"""
+        bank = self.open()
+        bank._workers[1].kill()
+        bank._workers[1].join()
+        with self.assertRaises(ShardUnavailableError):
+            bank.handle_choice('6', "11111", "pass1")
+        self.assertIn("1000", bank.handle_choice('6', "11111", "pass1"))
+        bank.close()
+
+class TestEndOfDay(unittest.TestCase):
+    """Tests for the end-of-day interest, fee and expiry run"""
+    
+    TEST_FILE = "test_eod_data.txt"
+    
+    def setUp(self):
+        """Set up accounts with balances and phone credit"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|3|\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+            f.write("33333|pass3|Business|10|0|\n")
+            f.write("44444|pass4|Personal|0|0|\n")
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE = self.original_file
+        for path in (self.TEST_FILE, self.TEST_FILE + ".journal", self.TEST_FILE + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def check(self, bank):
+        self.assertEqual(bank.accounts["11111"].balance, Decimal("1001.23"))
+        self.assertEqual(bank.accounts["11111"].phone_credit, 0)
+        self.assertEqual(bank.accounts["22222"].balance, 4975)
+        self.assertEqual(bank.accounts["33333"].balance, 0)
+        self.assertEqual(list(bank.accounts["11111"].history),
+                         ["Interest 1.23", "Phone -3 expired"])
+        self.assertEqual([t.op for t in bank.accounts["11111"].history.records()],
+                         [OP_INTEREST, OP_EXPIRED])
+        self.assertEqual([t.op for t in bank.accounts["22222"].history.records()], [OP_FEE])
+        if "44444" in bank.accounts:
+            self.assertFalse(bank.accounts["44444"].history)
+    
+    def test_rules_and_single_save(self):
+        """Every rule applies and the result is saved"""
+        bank = BankManager()
+        self.assertEqual(bank.end_of_day("0.00123", "25", expire_phone=True), 3)
+        self.check(bank)
+        self.check(BankManager())
+        with self.assertRaises(BadInputError):
+            bank.end_of_day("0.0000001")
+    
+    def test_columnar_store(self):
+        """Columnar stores update their columns in place and skip deleted rows"""
+        bank = BankManager(columnar=True)
+        bank.remove_account("44444")
+        bank.end_of_day("0.00123", "25", expire_phone=True)
+        self.check(bank)
+        self.assertNotIn("44444", bank.accounts)
+    
+    def test_overflow_changes_nothing(self):
+        """Interest past the largest amount fails before any balance moves"""
+        with open(self.TEST_FILE, 'a') as f:
+            f.write("55555|pass5|Personal|92233720368547758|0|\n")
+        for columnar in (False, True):
+            bank = BankManager(columnar=columnar)
+            with self.assertRaises(BadInputError):
+                bank.end_of_day("0.01", "25", expire_phone=True)
+            self.assertEqual(bank.accounts["11111"].balance, 1000)
+            self.assertEqual(bank.accounts["11111"].phone_credit, 3)
+            self.assertEqual(bank.accounts["22222"].balance, 5000)
+            self.assertEqual(bank.accounts["55555"].balance, Decimal("92233720368547758"))
+            self.assertFalse(bank.accounts["11111"].history)
+    
+    def test_journal_replay(self):
+        """One journal record replays the whole run"""
+        bank = BankManager(journal=True)
+        bank.end_of_day("0.00123", "25", expire_phone=True)
+        bank.close()
+        reopened = BankManager(journal=True)
+        self.check(reopened)
+        self.assertEqual(next(reopened.accounts["11111"].history.records()).op, OP_INTEREST)
+        reopened.close()
+
+class TestHistoryArchive(unittest.TestCase):
+    """Tests for moving old history into compressed archive segments"""
+    
+    TEST_FILE = "test_archive_data.txt"
+    
+    def setUp(self):
+        """Set up an account with ten deposits"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+        self.bank = BankManager()
+        for i in range(1, 11):
+            self.bank.accounts["11111"].add_money(i)
+    
+    def tearDown(self):
+        """Clean up data and archive files"""
+        BankManager.DATA_FILE = self.original_file
+        archive = self.TEST_FILE + BankManager.ARCHIVE_SUFFIX
+        if os.path.exists(archive):
+            for name in os.listdir(archive):
+                os.remove(os.path.join(archive, name))
+            os.rmdir(archive)
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_pages_span_archive_and_hot_history(self):
+        """Paging reads archived entries first, then the hot file"""
+        self.assertEqual(self.bank.archive_history(keep=6), 4)
+        self.assertEqual(self.bank.archive_history(keep=3), 3)
+        self.assertEqual(self.bank.archive_history(keep=3), 0)
+        bank = BankManager()
+        self.assertEqual(len(bank.accounts["11111"].history), 3)
+        page = bank.handle_choice('9', "11111", "pass1", "2", "4")
+        self.assertEqual(page.split("\n"), ["Added 3", "Added 4", "Added 5", "Added 6"])
+        page = bank.handle_choice('9', "11111", "pass1", "6", "10")
+        self.assertEqual(page.split("\n"), ["Added 7", "Added 8", "Added 9", "Added 10"])
+        text = bank.handle_choice('9', "11111", "pass1")
+        self.assertTrue(text.startswith("(7 older entries archived"))
+        bank.handle_choice('7', "11111", "pass1")
+        self.assertEqual(bank.archive.count("11111", None), 0)
+    
+    def test_sequence_numbers_carry_on(self):
+        """Entries added after archiving continue the sequence"""
+        self.assertEqual(self.bank.archive_history(keep=0), 9)
+        acc = self.bank.accounts["11111"]
+        acc.add_money(11)
+        self.bank.end_of_day("0.001")
+        seqs = [t.seq for t in self.bank.archive.records("11111", acc.history)]
+        seqs += [t.seq for t in acc.history.records()]
+        self.assertEqual(seqs, list(range(1, 13)))
+    
+    def test_unfinished_run_is_ignored(self):
+        """A segment whose records never left the hot file is dropped"""
+        archive = HistoryArchive(self.TEST_FILE + BankManager.ARCHIVE_SUFFIX, 'lzma')
+        history = self.bank.accounts["11111"].history
+        archive.append("11111", list(history.raw_records())[:5], history)
+        self.assertEqual(archive.count("11111", history), 0)
+        self.assertEqual(self.bank.archive_history(keep=8), 2)
+        self.assertEqual([str(t) for t in self.bank.archive.records("11111", None)],
+                         ["Added 1", "Added 2"])
+    
+    def test_segment_headers_cached(self):
+        """History pages read the segment headers once until the archive changes"""
+        self.bank.archive_history(keep=5)
+        reads = []
+        real_read = self.bank.archive._read
+        def read(num):
+            reads.append(num)
+            return real_read(num)
+        self.bank.archive._read = read
+        for _ in range(3):
+            self.bank.handle_choice('9', "11111", "pass1")
+            self.bank.handle_choice('9', "11111", "pass1", "0", "2")
+        self.assertEqual(reads, ["11111"])
+        self.bank.archive_history(keep=2)
+        text = self.bank.handle_choice('9', "11111", "pass1")
+        self.assertTrue(text.startswith("(8 older entries archived"))
+    
+    def test_failed_delete_keeps_archive(self):
+        """The archive and number stay until the delete is saved"""
+        self.bank.archive_history(keep=5)
+        free = self.bank.allocator.available()
+        def failing_persist(records):
+            raise OSError("Disk full")
+        self.bank._persist = failing_persist
+        with self.assertRaises(OSError):
+            self.bank.handle_choice('7', "11111", "pass1")
+        self.assertEqual(self.bank.allocator.available(), free)
+        bank = BankManager()
+        self.assertEqual(len(bank.history_page("11111")), 10)
+        bank.handle_choice('7', "11111", "pass1")
+        self.assertEqual(bank.archive.count("11111", None), 0)
+
+class TestLedgerQueries(unittest.TestCase):
+    """Tests for indexed transaction queries"""
+    
+    TEST_FILE = "test_ledger_data.txt"
+    
+    def setUp(self):
+        """Set up three accounts with some transfers"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("12345|pass1|Personal|5000|0|\n")
+            f.write("67890|pass2|Business|5000|0|\n")
+            f.write("11111|pass3|Personal|5000|0|\n")
+        self.bank = BankManager()
+        self.bank.handle_choice('5', "12345", "pass1", "67890", "100")
+        self.bank.handle_choice('5', "11111", "pass3", "67890", "200")
+        self.bank.handle_choice('4', "67890", "pass2", "1500")
+    
+    def tearDown(self):
+        """Clean up test file"""
+        self.bank.close()
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_filters(self):
+        """Each index answers its own kind of question"""
+        found = list(self.bank.query(account="12345", counterparty="67890", op="Sent"))
+        self.assertEqual([(num, str(txn)) for num, txn in found], [("12345", "Sent 100 to 67890")])
+        self.assertEqual(len(list(self.bank.query(counterparty="67890"))), 2)
+        big = list(self.bank.query(op=OP_TAKE, min_amount=1000, since=time.time() - 7 * 86400))
+        self.assertEqual([(num, txn.amount) for num, txn in big], [("67890", 150000)])
+        self.assertEqual(len(list(self.bank.query(min_amount=150, max_amount=200))), 4)
+        self.assertEqual(list(self.bank.query(until=0)), [])
+        with self.assertRaises(BadInputError):
+            self.bank.query(op="Borrowed")
+    
+    def test_indexes_follow_changes(self):
+        """New, cut and deleted history is reflected in later queries"""
+        self.assertEqual(len(list(self.bank.query(account="67890"))), 5)
+        self.bank.handle_choice('3', "67890", "pass2", "5")
+        self.assertEqual(len(list(self.bank.query(account="67890"))), 6)
+        self.bank.archive_history(keep=1)
+        found = [str(t) for _, t in self.bank.query(account="67890")]
+        self.assertEqual(len(found), 6)
+        self.assertEqual(found[-1], "Added 5")
+        self.assertEqual(len(list(self.bank.query(op=OP_TAKE, min_amount=1000))), 1)
+        self.bank.handle_choice('7', "11111", "pass3")
+        self.assertEqual(list(self.bank.query(account="11111")), [])
+        for name in os.listdir(self.TEST_FILE + ".archive"):
+            os.remove(os.path.join(self.TEST_FILE + ".archive", name))
+        os.rmdir(self.TEST_FILE + ".archive")
+    
+    def test_indexes_see_every_writer(self):
+        """Changes made outside handle_choice are indexed too"""
+        self.assertEqual(len(list(self.bank.query(account="12345"))), 2)
+        async def scenario():
+            front = AsyncBankManager(self.bank)
+            await front.deposit("12345", "pass1", "9")
+            await front.close()
+        asyncio.run(scenario())
+        self.assertEqual(str(list(self.bank.query(account="12345"))[-1][1]), "Added 9")
+        self.bank.accounts["12345"].add_money(7)
+        self.assertEqual(str(list(self.bank.query(account="12345"))[-1][1]), "Added 7")
+
+    def test_index_watches_only_its_bank(self):
+        """Writes in another bank neither call nor dirty this bank's index"""
+        list(self.bank.query())
+        self.assertIn(self.bank._ledger._changing, self.bank.locks.watchers)
+        self.assertNotIn(self.bank._ledger._changing, ACCOUNT_LOCKS.watchers)
+        other = BankManager()
+        other.accounts["12345"].add_money(1)
+        other.handle_choice('3', "67890", "pass2", "1")
+        self.assertEqual(self.bank._ledger._dirty, set())
+        self.assertEqual(other.locks.watchers, [])
+        other.close()
+
+class TestRecordReplay(unittest.TestCase):
+    """Tests for recording handle_choice calls and replaying them"""
+    
+    TEST_FILE = "test_replay_data.txt"
+    LOG_FILE = "test_replay.log"
+    
+    def setUp(self):
+        """Record some traffic against a copy of the start state"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        with open(self.TEST_FILE) as f:
+            self.start = f.read()
+        bank = BankManager(record=self.LOG_FILE)
+        num = bank.handle_choice('1', "Personal").split()[4]
+        bank.accounts[num].password = "newpass"
+        for i in range(20):
+            bank.handle_choice('3', "11111", "pass1", "10")
+            bank.handle_choice('5', "22222", "pass2", num, "5")
+        bank.handle_choice('5', "22222", "pass2", "11111", "3000")
+        bank.handle_choice('4', "11111", "pass1", "3500")  # needs the transfer in
+        with self.assertRaises(NotEnoughMoneyError):
+            bank.handle_choice('4', num, "newpass", "1000")
+        bank.close()
+        with open(self.TEST_FILE, 'w') as f:
+            f.write(self.start)
+    
+    def tearDown(self):
+        """Clean up test files"""
+        BankManager.DATA_FILE = self.original_file
+        for path in (self.TEST_FILE, self.LOG_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_log_has_no_passwords(self):
+        """Passwords are blanked and final balances are appended"""
+        with open(self.LOG_FILE) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 45)
+        self.assertNotIn("pass1", json.dumps(lines))
+        self.assertFalse(lines[-2]['ok'])
+        self.assertEqual(lines[-1]['final']['11111'], 70000)
+    
+    def test_replay_matches(self):
+        """Replaying fast, with workers or on the recorded clock ends the same"""
+        for timing, workers in (('fast', 1), ('fast', 4), ('fast', 4), ('original', 2)):
+            report = replay_log(self.LOG_FILE, self.TEST_FILE, timing, workers)
+            self.assertTrue(report['balances_match'], report['balance_mismatches'])
+            self.assertEqual(report['outcome_mismatches'], 0)
+            self.assertEqual(report['operations'], 44)
+        with open(self.TEST_FILE) as f:
+            self.assertEqual(f.read(), self.start)
+    
+    def test_replay_keeps_class_default(self):
+        """The replay bank gets its own data file and other banks keep the default"""
+        seen = []
+        original = BankManager.load_data
+        
+        def load_data(bank):
+            seen.append((bank.DATA_FILE, BankManager.DATA_FILE))
+            original(bank)
+        
+        BankManager.load_data = load_data
+        try:
+            report = replay_log(self.LOG_FILE, self.TEST_FILE)
+        finally:
+            BankManager.load_data = original
+        self.assertTrue(report['balances_match'], report['balance_mismatches'])
+        [(own, default)] = seen
+        self.assertNotEqual(own, self.TEST_FILE)
+        self.assertEqual(default, self.TEST_FILE)
+    
+    def test_opened_number_is_structured(self):
+        """The new account number comes from the call, not the reply text"""
+        bank = BankManager()
+        call = bank.commands.run(bank, '1', ("Business",))
+        self.assertIn(call.opened, bank.accounts)
+        self.assertIn(call.opened, call.message)
+        self.assertIsNone(bank.commands.run(bank, '6', ("11111", "pass1")).opened)
+
+class TestCommandRegistry(unittest.TestCase):
+    """Tests for the shared command table and its middleware"""
+    
+    TEST_FILE = "test_commands_data.txt"
+    
+    def setUp(self):
+        """Set up test bank"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("11111|pass1|Personal|1000|0|\n")
+            f.write("22222|pass2|Business|5000|0|\n")
+        self.bank = BankManager()
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def test_schema_checked_before_login(self):
+        """Bad or missing values fail without counting as a login attempt"""
+        for _ in range(BankManager.LOGIN_MAX_FAILURES + 1):
+            with self.assertRaises(BadInputError):
+                self.bank.handle_choice('3', "11111", "wrong", "ten")
+        with self.assertRaises(BadInputError):
+            self.bank.handle_choice('5', "11111", "pass1", "22222")
+        with self.assertRaises(BadInputError):
+            self.bank.handle_choice('1', "Savings")
+        self.assertIn("Balance: 1000", self.bank.handle_choice('6', "11111", "pass1"))
+        self.assertEqual(self.bank.handle_choice('x'), "Invalid option")
+        self.assertEqual([c.choice for c in COMMANDS if c.menu == 'account'], list("3456789"))
+    
+    def test_middleware_and_deferred_commits(self):
+        """Middleware wraps every call and deferred() commits once"""
+        seen = []
+        self.bank.commands.use(lambda call, proceed: (seen.append(call.choice), proceed()))
+        commits = []
+        original = self.bank._persist
+        self.bank._persist = lambda records: (commits.append(records), original(records))
+        with self.bank.deferred():
+            self.bank.handle_choice('3', "11111", "pass1", "5")
+            self.bank.handle_choice('4', "22222", "pass2", "5")
+            self.assertEqual(commits, [])
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(len(commits[0]), 2)
+        self.assertEqual(seen, ['3', '4'])
+        self.assertEqual(BankManager().accounts["11111"].balance, 1005)
+        self.assertEqual(COMMANDS.middleware, [])
+    
+    def test_registered_command(self):
+        """A new command is available to handle_choice once registered"""
+        self.bank.commands.register(Command('v', "Double", [], lambda bank, acc, num: (
+            str(int(acc.balance) * 2), [])))
+        self.assertEqual(self.bank.handle_choice('v', "11111", "pass1"), "2000")
+        self.assertIsNone(COMMANDS.get('v'))
+
+class TestSnapshots(unittest.TestCase):
+    """Tests for point-in-time snapshots and reports"""
+    
+    TEST_FILE = "test_snapshot_data.txt"
+    
+    def setUp(self):
+        """Set up three accounts"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("12345|pass1|Personal|1000|5|\n")
+            f.write("67890|pass2|Business|2000|0|\n")
+            f.write("11111|pass3|Personal|3000|0|\n")
+    
+    def tearDown(self):
+        """Clean up test file"""
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def view(self, snap):
+        return sorted((acc.number, acc.balance) for acc in snap)
+    
+    def test_unchanged_by_later_writes(self):
+        """Deposits, new accounts and deletes after the snapshot don't show in it"""
+        for bank in (BankManager(), BankManager(columnar=True)):
+            snap = bank.snapshot()
+            before = [("11111", 3000), ("12345", 1000), ("67890", 2000)]
+            bank.handle_choice('3', "12345", "pass1", "50")
+            bank.handle_choice('1', "Personal")
+            bank.remove_account("11111")
+            self.assertEqual(self.view(snap), before)
+            self.assertEqual(snap.get("12345").phone_credit, 5)
+            self.assertIsNone(snap.get("99999"))
+            snap.close()
+            self.assertEqual(bank.accounts["12345"].balance, 1050)
+            with bank.snapshot() as later:
+                self.assertEqual(len(list(later)), 3)
+    
+    def test_consistent_during_transfers(self):
+        """Every snapshot taken while transfers run adds up to the same total"""
+        bank = BankManager()
+        stop = threading.Event()
+        
+        def transfers():
+            while not stop.is_set():
+                bank.handle_choice('5', "12345", "pass1", "67890", "1")
+                bank.handle_choice('5', "67890", "pass2", "11111", "1")
+                bank.handle_choice('5', "11111", "pass3", "12345", "1")
+        
+        worker = threading.Thread(target=transfers)
+        worker.start()
+        try:
+            for _ in range(50):
+                report = bank.report(top=2, workers=3)
+                self.assertEqual(report['accounts'], 3)
+                self.assertEqual(report['total_balance'], 6000)
+        finally:
+            stop.set()
+            worker.join()
+        self.assertEqual(report['phone_liabilities'], 5)
+        self.assertEqual(len(report['top_balances']), 2)
+    
+    def test_waits_for_writes_in_progress(self):
+        """A transfer already holding its locks is finished before the snapshot starts"""
+        bank = BankManager()
+        taken = threading.Event()
+        real_add = BusinessAccount._add_cents
+        def slow_add(acc, cents):
+            taken.set()
+            time.sleep(0.1)
+            real_add(acc, cents)
+        BusinessAccount._add_cents = slow_add
+        try:
+            worker = threading.Thread(target=bank.handle_choice,
+                                      args=('5', "12345", "pass1", "67890", "100"))
+            worker.start()
+            taken.wait()
+            report = bank.report()
+            worker.join()
+        finally:
+            BusinessAccount._add_cents = real_add
+        self.assertEqual(report['total_balance'], 6000)
+    
+    def test_close_stops_watching(self):
+        """Closed snapshots no longer save values on writes"""
+        bank = BankManager()
+        watchers = len(bank.locks.watchers)
+        with bank.snapshot():
+            self.assertEqual(len(bank.locks.watchers), watchers + 1)
+        self.assertEqual(len(bank.locks.watchers), watchers)
+        report = bank.report()
+        self.assertEqual(report['top_balances'][0], ("11111", 3000))
+        self.assertEqual(len(bank.locks.watchers), watchers)
+    
+    def test_dropped_snapshot_stops_watching(self):
+        """An unclosed snapshot unregisters once collected, and other banks never see it"""
+        bank = BankManager()
+        other = BankManager()
+        snap = bank.snapshot()
+        self.assertEqual(len(bank.locks.watchers), 1)
+        self.assertEqual(other.locks.watchers, [])
+        other.accounts["11111"].add_money(5)
+        self.assertNotIn("11111", snap._saved)
+        del snap
+        gc.collect()
+        self.assertEqual(bank.locks.watchers, [])
+
+class FakeWidget:
+    """Stand-in for a Tk widget that remembers its options and text"""
+    
+    def __init__(self, *args, **kwargs):
+        self.options = dict(kwargs)
+        self.text = ""
+        self.inserts = []
+    
+    def config(self, **kwargs):
+        self.options.update(kwargs)
+    
+    def grid(self, *args, **kwargs):
+        pass
+    
+    pack = grid_remove = grid
+    
+    def get(self):
+        return self.text
+    
+    def delete(self, *args):
+        self.text = ""
+    
+    def insert(self, index, text):
+        self.inserts.append(text)
+        self.text += text
+
+class FakeWindow(FakeWidget):
+    """Stand-in for tk.Tk whose after() callbacks the test runs by hand"""
+    
+    def __init__(self):
+        super().__init__()
+        self.scheduled = []
+    
+    def title(self, text):
+        pass
+    
+    def after(self, ms, callback, *args):
+        self.scheduled.append((callback, args))
+
+class FakeVar:
+    def __init__(self):
+        self.value = ""
+        self.callbacks = []
+    
+    def trace(self, mode, callback):
+        self.callbacks.append(callback)
+    
+    def set(self, value):
+        self.value = value
+        for callback in self.callbacks:
+            callback()
+    
+    def get(self):
+        return self.value
+
+class TestGuiWorker(unittest.TestCase):
+    """Tests for the GUI's background worker, over a stubbed Tk module"""
+    
+    TEST_FILE = "test_gui_data.txt"
+    
+    def setUp(self):
+        """Build the window from fake widgets; no display is needed"""
+        self.original_file = BankManager.DATA_FILE
+        BankManager.DATA_FILE = self.TEST_FILE
+        with open(self.TEST_FILE, 'w') as f:
+            f.write("12345|pass1|Personal|1000|0|\n")
+        self.real_tk, self.real_messagebox = bank_module.tk, bank_module.messagebox
+        bank_module.tk = types.SimpleNamespace(
+            Tk=FakeWindow, Frame=FakeWidget, Label=FakeWidget, Entry=FakeWidget,
+            Button=FakeWidget, Radiobutton=FakeWidget, Text=FakeWidget,
+            StringVar=FakeVar, END='end')
+        self.errors = []
+        bank_module.messagebox = types.SimpleNamespace(
+            showerror=lambda title, text: self.errors.append(text))
+        self.bank = BankManager()
+        self.gui = BankAppGUI(self.bank)
+    
+    def tearDown(self):
+        """Stop the worker and put Tk back"""
+        self.gui.worker.shutdown(wait=True)
+        bank_module.tk, bank_module.messagebox = self.real_tk, self.real_messagebox
+        BankManager.DATA_FILE = self.original_file
+        if os.path.exists(self.TEST_FILE):
+            os.remove(self.TEST_FILE)
+    
+    def run_scheduled(self, until):
+        """Run after() callbacks as the Tk event loop would, until until() holds"""
+        deadline = time.monotonic() + 5
+        while not until() and time.monotonic() < deadline:
+            if self.gui.window.scheduled:
+                callback, args = self.gui.window.scheduled.pop(0)
+                callback(*args)
+            else:
+                time.sleep(0.005)
+        self.assertTrue(until())
+    
+    def login(self):
+        self.gui.num_entry.text, self.gui.pwd_entry.text = "12345", "pass1"
+        self.gui.do_login()
+        self.run_scheduled(lambda: self.gui.current_acc is not None)
+    
+    def test_work_runs_on_the_worker(self):
+        """A click hands the bank call to the worker and locks the buttons until it is done"""
+        self.login()
+        threads = []
+        real_handle = self.bank.handle_choice
+        release = threading.Event()
+        def handle_choice(*args):
+            threads.append(threading.current_thread())
+            release.wait(5)
+            return real_handle(*args)
+        self.bank.handle_choice = handle_choice
+        self.gui.action_var.set("3")
+        self.gui.input_boxes[0].text = "50"
+        self.gui.do_action()
+        self.assertTrue(self.gui.busy)
+        self.assertEqual({b.options['state'] for b in self.gui.buttons}, {'disabled'})
+        self.assertEqual(self.gui.status.options['text'], "Working...")
+        self.gui.do_action()  # ignored while busy
+        release.set()
+        self.run_scheduled(lambda: not self.gui.busy)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual({b.options['state'] for b in self.gui.buttons}, {'normal'})
+        self.assertIn("New balance: 1050", self.gui.output.text)
+    
+    def test_errors_come_back_to_the_window(self):
+        """A BankError from the worker is shown, and the buttons come back"""
+        self.login()
+        self.gui.action_var.set("4")
+        self.gui.input_boxes[0].text = "5000"
+        self.gui.do_action()
+        self.run_scheduled(lambda: not self.gui.busy)
+        self.assertEqual(self.errors, ["Not enough funds"])
+        self.assertEqual({b.options['state'] for b in self.gui.buttons}, {'normal'})
+    
+    def test_uses_the_banks_registry(self):
+        """Commands registered on the bank show up in the GUI and run from it"""
+        radios = []
+        def radio(*args, **kwargs):
+            radios.append(kwargs['text'])
+            return FakeWidget(*args, **kwargs)
+        bank_module.tk.Radiobutton = radio
+        self.bank.commands.register(Command('v', "Double", [], lambda bank, acc, num: (
+            str(int(acc.balance) * 2), [])))
+        self.gui.worker.shutdown(wait=True)
+        self.gui = BankAppGUI(self.bank)
+        self.assertIn("v. Double", radios)
+        self.login()
+        self.gui.action_var.set("v")
+        self.gui.do_action()
+        self.run_scheduled(lambda: not self.gui.busy)
+        self.assertEqual(self.gui.output.text, "2000")
+    
+    def test_history_inserted_in_chunks(self):
+        """Long output goes in HISTORY_CHUNK lines per turn, and a newer message stops it"""
+        text = "\n".join(f"line {i}" for i in range(450))
+        self.gui.show_progressively(text)
+        self.assertEqual(len(self.gui.output.inserts), 2)  # the clear, then one chunk
+        self.run_scheduled(lambda: not self.gui.window.scheduled)
+        self.assertEqual(self.gui.output.text, text)
+        self.assertEqual(len(self.gui.output.inserts), 4)
+        self.gui.show_progressively(text)
+        self.gui.show_message("done")
+        self.run_scheduled(lambda: not self.gui.window.scheduled)
+        self.assertEqual(self.gui.output.text, "done")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file